@@ -0,0 +1,105 @@
+import time
+import heapq
+import datetime
+import threading
+from itertools import count
+
+from settings import app
+
+
+def deadline_time(deadline):
+    """
+    Converts a topic deadline to a UTC timestamp. A date means the whole day is
+    included, so it expires at the following midnight; naive datetimes are taken as UTC
+
+    @param deadline: Date or datetime of the deadline
+    @return: Timestamp at which the topic expires
+    """
+    if not isinstance(deadline, datetime.datetime):
+        deadline = datetime.datetime.combine(deadline + datetime.timedelta(days=1), datetime.time())
+    if deadline.tzinfo is None:
+        deadline = deadline.replace(tzinfo=datetime.timezone.utc)
+    return deadline.timestamp()
+
+
+class DeadlineScheduler:
+    """
+    Single timer thread that expires topics at their exact deadline, keeping
+    the pending deadlines in a heap ordered by expiry
+    """
+
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self._heap = []
+        self._deadlines = {}
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name='deadline-scheduler', daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def schedule(self, topic_id, deadline):
+        """
+        Schedules a topic to expire at its deadline, replacing any previous deadline
+
+        @param self:
+        @param topic_id: Id of the topic
+        @param deadline: Date or datetime of the deadline
+        @return: None
+        """
+        expires_at = deadline_time(deadline)
+        with self._condition:
+            self._deadlines[topic_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, next(self._sequence), topic_id))
+            self._condition.notify()
+
+    def cancel(self, topic_id):
+        with self._condition:
+            self._deadlines.pop(topic_id, None)
+
+    def pending(self):
+        with self._condition:
+            return dict(self._deadlines)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                topic_id = self._next_expired()
+                if topic_id is None:
+                    return
+            try:
+                self.on_expire(topic_id)
+            except Exception:
+                app.logger.exception("Could not expire topic %s", topic_id)
+
+    def _next_expired(self):
+        """
+        Waits until the earliest deadline passes. Entries that were cancelled or
+        rescheduled are discarded when they reach the top of the heap
+
+        @param self:
+        @return: Id of the expired topic, None once the scheduler is stopped
+        """
+        while self._running:
+            if not self._heap:
+                self._condition.wait()
+                continue
+            expires_at, _, topic_id = self._heap[0]
+            remaining = expires_at - time.time()
+            if remaining > 0:
+                self._condition.wait(remaining)
+                continue
+            heapq.heappop(self._heap)
+            if self._deadlines.get(topic_id) == expires_at:
+                del self._deadlines[topic_id]
+                return topic_id
+        return None
@@ -0,0 +1,540 @@
+#!bin/python
+import os
+import json
+import argparse
+import time
+import signal
+import datetime
+import threading
+from multiprocessing import Process
+from redis import StrictRedis
+
+from DeadlineScheduler import DeadlineScheduler
+from FetcherQueue import FetcherQueue
+from Threader import Threader
+from models.tweet_store import TweetStore
+from util.matcher import TopicMatcher
+from util.profiler import SamplingProfiler
+from util.leases import LeaseManager, rebalance
+from util.metrics import metrics
+from settings import REDIS_HOST, REDIS_PORT, FETCHER_WORKERS, FETCHER_HEARTBEAT_INTERVAL, \
+    FETCHER_RESTART_BACKOFF, FETCHER_RESTART_BACKOFF_CAP, FETCHER_DRAIN_TIMEOUT, FETCHER_NODE_ID, PROFILE_SECONDS, \
+    SCHEDULER_USER_TWEETS_PER_SECOND, app
+
+RETENTION_INTERVAL = 3600
+
+# Left by the versions where a single supervisor assigned every topic
+LEGACY_ASSIGNMENTS = 'fetcher:assignments'
+PROFILES = 'fetcher:profiles'
+PROFILES_KEPT = 100
+
+
+def heartbeat_key(node, worker_id):
+    return f'fetcher:heartbeat:{node}:{worker_id}'
+
+
+def tweet_limits(topics, per_user=SCHEDULER_USER_TWEETS_PER_SECOND):
+    """
+    Tweets per second each topic may keep, the ingestion quota of its user split evenly
+    between the topics the user runs
+
+    @param topics: Dict from topic id to the dict representation of every topic to run
+    @param per_user: Tweets per second kept between all the topics of a user, 0 for no limit
+    @return: Dict from topic id to its limit, 0 for no limit
+    """
+    running = {}
+    for topic in topics.values():
+        running[topic["user_id"]] = running.get(topic["user_id"], 0) + 1
+    return {topic_id: per_user / running[topic["user_id"]] for topic_id, topic in topics.items()}
+
+
+def topic_deadline(topic):
+    if topic.get("deadline_at"):
+        return datetime.datetime.strptime(topic["deadline_at"], "%d-%m-%Y %H:%M")
+    return datetime.datetime.strptime(topic["deadline"], "%d-%m-%Y").date()
+
+
+class FetcherWorker:
+    """
+    Worker process running the streams of many topics, one thread per topic
+    """
+
+    def __init__(self, node, worker_id):
+        self.node = node
+        self.worker_id = worker_id
+        self.running = True
+        self.topics = {}
+        self.profile_requested = None
+
+    def run(self):
+        """
+        Main loop of the worker: consumes its command queue and reports its health
+
+        @param self:
+        @return: None
+        """
+        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        self.queue = FetcherQueue(self.redis)
+        self.threader = Threader(self.redis)
+        self.scheduler = DeadlineScheduler(self._expire)
+        self.scheduler.start()
+        self.profiler = SamplingProfiler(f'fetcher-{self.node}-{self.worker_id}')
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, self._on_profile_signal)
+        while self.running:
+            self._heartbeat()
+            command = self.queue.pop(FetcherQueue.worker_key(self.node, self.worker_id),
+                                     timeout=FETCHER_HEARTBEAT_INTERVAL)
+            if command is not None:
+                self._dispatch(command)
+            if self.profile_requested is not None:
+                self._profile(self.profile_requested)
+            self._reap()
+        self._drain()
+
+    def _on_signal(self, signum, frame):
+        self.running = False
+
+    def _on_profile_signal(self, signum, frame):
+        # Started from the main loop, a thread started inside a signal handler may deadlock
+        self.profile_requested = PROFILE_SECONDS
+
+    def _heartbeat(self):
+        self.redis.set(heartbeat_key(self.node, self.worker_id),
+                       json.dumps({"pid": os.getpid(), "topics": len(self.topics)}), ex=FETCHER_HEARTBEAT_INTERVAL * 3)
+
+    def _dispatch(self, command):
+        if command["command"] == "start":
+            self._start(command["topic"], command.get("limit", 0))
+        elif command["command"] == "stop":
+            self._stop(command["topic_id"])
+        elif command["command"] == "limit":
+            self._limit(command["topic_id"], command["limit"])
+        elif command["command"] == "drain":
+            self.running = False
+        elif command["command"] == "profile":
+            self._profile(command.get("seconds", PROFILE_SECONDS))
+
+    def _profile(self, seconds):
+        """
+        Samples the stacks and allocations of this worker for some seconds, while its
+        streams keep running. The paths of the written files are pushed to fetcher:profiles
+
+        @param self:
+        @param seconds: Duration of the profile
+        @return: None
+        """
+        self.profile_requested = None
+        if not self.profiler.start(seconds, self._report_profile):
+            app.logger.warning("Fetcher worker %s is already being profiled", self.worker_id)
+
+    def _report_profile(self, report):
+        report["node"] = self.node
+        report["worker"] = self.worker_id
+        app.logger.info("Profile of fetcher worker %s written to %s", self.worker_id, report["stacks"])
+        pipe = self.redis.pipeline()
+        pipe.lpush(PROFILES, json.dumps(report))
+        pipe.ltrim(PROFILES, 0, PROFILES_KEPT - 1)
+        pipe.execute()
+
+    def _start(self, topic, limit=0):
+        """
+        Starts streaming a topic in a new thread, unless it is already running. A topic
+        stopped whose stream did not exit yet is started again with a new stream
+
+        @param self:
+        @param topic: Dict representation of the topic to stream
+        @param limit: Tweets per second the topic may keep, 0 for no limit
+        @return: None
+        """
+        running = self.topics.get(topic["id"])
+        if running is not None and not running[0].stopped:
+            self._limit(topic["id"], limit)
+            return
+        if running is not None:
+            # Stopped but its stream has not exited yet, as when a lost lease is claimed again at once
+            fetcher, thread, _ = running
+            thread.join(FETCHER_DRAIN_TIMEOUT)
+            fetcher.flush()
+            del self.topics[topic["id"]]
+        deadline = topic_deadline(topic)
+        fetcher = self._fetcher(topic, deadline)
+        fetcher.sampler.limit = limit
+        thread = threading.Thread(target=self._stream, args=(fetcher, topic), name=f'topic-{topic["id"]}',
+                                  daemon=True)
+        self.topics[topic["id"]] = (fetcher, thread, topic)
+        self.threader.add_thread(topic["user_id"], {"process": os.getpid(), "node": self.node,
+                                                    "worker": self.worker_id, "topic": topic})
+        thread.start()
+        self.scheduler.schedule(topic["id"], deadline)
+
+    def _fetcher(self, topic, deadline):
+        # Deferred so the supervisor does not load tweepy and geotext before forking
+        from TwitterFetcher import TwitterFetcher
+        return TwitterFetcher(deadline, topic["id"], topic["user_id"], redis=self.redis,
+                              matcher=TopicMatcher.from_topic(topic))
+
+    @staticmethod
+    def _stream(fetcher, topic):
+        from models.sql_models import session
+        try:
+            fetcher.stream(topic.get("terms") or topic["name"],
+                           languages=topic.get("languages") or [topic["language"]])
+        except Exception:
+            app.logger.exception("Stream of topic %s failed", topic["id"])
+        finally:
+            session.remove()
+
+    def _stop(self, topic_id):
+        if topic_id in self.topics:
+            fetcher, thread, topic = self.topics[topic_id]
+            self.scheduler.cancel(topic_id)
+            fetcher.disconnect()
+
+    def _limit(self, topic_id, limit):
+        if topic_id in self.topics:
+            self.topics[topic_id][0].sampler.limit = limit
+
+    def _expire(self, topic_id):
+        """
+        Called by the deadline scheduler: stops the stream of the topic even if no
+        tweet arrives, flushes its output and removes it from the registry
+
+        @param self:
+        @param topic_id: Id of the expired topic
+        @return: None
+        """
+        running = self.topics.get(topic_id)
+        if running is None:
+            return
+        fetcher, thread, topic = running
+        fetcher.disconnect()
+        fetcher.flush()
+        self.threader.delete_thread(topic["user_id"], topic_id)
+
+    def _reap(self):
+        """
+        Forgets the topics whose stream finished. Topics past their deadline are removed
+        from the topics to run, streams that died without being stopped are sent back to
+        the supervisor of the node to be started again. The metrics of topics that ended
+        are dropped
+
+        @param self:
+        @return: None
+        """
+        for topic_id, (fetcher, thread, topic) in list(self.topics.items()):
+            if thread.is_alive():
+                continue
+            del self.topics[topic_id]
+            fetcher.flush()
+            self.threader.delete_thread(topic["user_id"], topic_id)
+            if fetcher.expired():
+                self.queue.finish(topic_id)
+                metrics.forget(topic=topic_id)
+            elif not fetcher.stopped:
+                self.queue.push({"command": "restart", "topic_id": topic_id}, FetcherQueue.node_key(self.node))
+            elif not self.redis.hexists(FetcherQueue.TOPICS, topic_id):
+                # Stopped by its user, the series of topics moved to another node keep adding up there
+                metrics.forget(topic=topic_id)
+
+    def _drain(self):
+        """
+        Disconnects every stream and flushes what it buffered
+
+        @param self:
+        @return: None
+        """
+        self.scheduler.stop()
+        for fetcher, thread, topic in self.topics.values():
+            fetcher.disconnect()
+        for fetcher, thread, topic in self.topics.values():
+            thread.join(FETCHER_DRAIN_TIMEOUT)
+            fetcher.flush()
+            self.threader.delete_thread(topic["user_id"], topic["id"])
+        self.redis.delete(heartbeat_key(self.node, self.worker_id))
+
+
+class FetcherPool:
+    """
+    Supervisor of the fixed pool of fetcher workers of one node. Every node claims
+    topics of fetcher:topics through leases until it holds its fair share, gives up
+    the ones over it when other nodes join, takes the ones left by nodes that died
+    and assigns each topic it holds to its least loaded worker. Before balancing it
+    starts the topics the scheduler kept waiting that now fit, and it tells each of
+    its workers the share of the ingestion quota of their users each topic may keep.
+    Unhealthy workers are restarted with exponential backoff and drained on shutdown
+    """
+
+    def __init__(self, size=FETCHER_WORKERS, node=FETCHER_NODE_ID, redis=None, store=None):
+        self.size = size
+        self.node = node
+        self.redis = redis or StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        self.queue = FetcherQueue(self.redis)
+        self.leases = LeaseManager(self.redis, node)
+        self.running = True
+        self.processes = {}
+        self.started_at = {}
+        self.backoff = {}
+        self.restart_at = {}
+        # Topic id to the worker running it and the topic
+        self.assignments = {}
+        # Topic id to the tweets per second its worker was told to keep
+        self.limits = {}
+        self.balance_at = 0
+        self.store = store or TweetStore()
+        self.retention_at = 0
+
+    def run(self):
+        """
+        Starts the workers, keeps the leases of the node and dispatches the commands
+        enqueued by the API
+
+        @param self:
+        @return: None
+        """
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.store.create_schema()
+        self._migrate()
+        for worker_id in range(self.size):
+            self.backoff[worker_id] = FETCHER_RESTART_BACKOFF
+            self._spawn(worker_id)
+        while self.running:
+            command = self.queue.pop([FetcherQueue.node_key(self.node), FetcherQueue.COMMANDS], timeout=1)
+            if command is not None:
+                self._dispatch(command)
+            if time.time() >= self.balance_at:
+                self._balance()
+            self._check_workers()
+            self._enforce_retention()
+        self._drain()
+
+    def _on_signal(self, signum, frame):
+        self.running = False
+
+    def _spawn(self, worker_id):
+        self.queue.clear(FetcherQueue.worker_key(self.node, worker_id))
+        self.redis.delete(heartbeat_key(self.node, worker_id))
+        process = Process(target=FetcherWorker(self.node, worker_id).run, name=f'fetcher-{worker_id}', daemon=True)
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.time()
+        app.logger.info("Started fetcher worker %s (pid %s)", worker_id, process.pid)
+        for assigned, topic in self.assignments.values():
+            if assigned == worker_id:
+                self._send_start(worker_id, topic)
+
+    def _migrate(self):
+        """
+        Adds the topics assigned by a previous version of the supervisor to the topics to run
+
+        @param self:
+        @return: None
+        """
+        for topic_id, assignment in self.redis.hgetall(LEGACY_ASSIGNMENTS).items():
+            self.redis.hsetnx(FetcherQueue.TOPICS, topic_id, json.dumps(json.loads(assignment)["topic"]))
+        self.redis.delete(LEGACY_ASSIGNMENTS)
+
+    def _balance(self):
+        """
+        Renews the leases of the node and moves it towards its fair share of the topics:
+        starts the waiting topics that fit, stops the topics removed or whose lease was
+        lost, releases the ones over its share and claims free ones, including the ones
+        of nodes that stopped renewing. Then updates the tweet limits of its topics
+
+        @param self:
+        @return: None
+        """
+        self.balance_at = time.time() + FETCHER_HEARTBEAT_INTERVAL
+        self.leases.heartbeat()
+        for topic_id in self.leases.renew(self.assignments):
+            app.logger.warning("Lost the lease of topic %s", topic_id)
+            self._unassign(topic_id, release=False)
+        for topic_id in self.queue.scheduler.promote():
+            app.logger.info("Topic %s left the queue of the scheduler", topic_id)
+        topics = self.queue.topics()
+        for topic_id in set(self.assignments) - set(topics):
+            self._unassign(topic_id)
+        owners = self.leases.owners(list(topics))
+        claim, release = rebalance(self.node, self.leases.nodes(), owners)
+        for topic_id in release:
+            app.logger.info("Releasing topic %s to balance the nodes", topic_id)
+            self._unassign(topic_id)
+        # Topics this node still holds from before a restart are taken back
+        held = [topic_id for topic_id, owner in owners.items()
+                if owner == self.node and topic_id not in self.assignments and topic_id not in release]
+        for topic_id in held + claim:
+            if self.leases.claim(topic_id):
+                self._assign(topics[topic_id])
+        self._update_limits(topics)
+
+    def _dispatch(self, command):
+        if command["command"] == "start":
+            self._balance()
+        elif command["command"] == "restart":
+            assignment = self.assignments.get(command["topic_id"])
+            if assignment is not None:
+                self._send_start(*assignment)
+        elif command["command"] == "stop":
+            self.queue.finish(command["topic_id"])
+            self._unassign(command["topic_id"])
+        elif command["command"] == "profile":
+            self._route_profile(command)
+
+    def _route_profile(self, command):
+        """
+        Sends a profile command to the worker running a topic, to a given worker or to all of them
+
+        @param self:
+        @param command: Profile command, with an optional "topic_id" or "worker"
+        @return: None
+        """
+        if command.get("topic_id") is not None:
+            if command["topic_id"] not in self.assignments:
+                app.logger.warning("Cannot profile topic %s, it is not assigned", command["topic_id"])
+                return
+            workers = [self.assignments[command["topic_id"]][0]]
+        elif command.get("worker") is not None:
+            workers = [command["worker"]]
+        else:
+            workers = list(self.processes)
+        for worker_id in workers:
+            self.queue.push({"command": "profile", "seconds": command.get("seconds", PROFILE_SECONDS)},
+                            FetcherQueue.worker_key(self.node, worker_id))
+
+    def _assign(self, topic):
+        """
+        Assigns a topic whose lease the node holds to the worker running the fewest topics
+
+        @param self:
+        @param topic: Dict representation of the topic to stream
+        @return: Id of the chosen worker
+        """
+        if topic["id"] in self.assignments:
+            return self.assignments[topic["id"]][0]
+        load = {worker_id: 0 for worker_id in self.processes}
+        for worker_id, _ in self.assignments.values():
+            load[worker_id] += 1
+        worker_id = min(load, key=load.get)
+        self.assignments[topic["id"]] = (worker_id, topic)
+        self._send_start(worker_id, topic)
+        return worker_id
+
+    def _send_start(self, worker_id, topic):
+        self.queue.push({"command": "start", "topic": topic, "limit": self.limits.get(topic["id"], 0)},
+                        FetcherQueue.worker_key(self.node, worker_id))
+
+    def _update_limits(self, topics):
+        """
+        Sends the tweet limit of each topic of the node to its worker when it changed,
+        as topics of the same user start or finish on any node
+
+        @param self:
+        @param topics: Dict from topic id to the dict representation of every topic to run
+        @return: None
+        """
+        if not SCHEDULER_USER_TWEETS_PER_SECOND:
+            return
+        limits = tweet_limits(topics)
+        for topic_id, (worker_id, topic) in self.assignments.items():
+            limit = limits.get(topic_id, 0)
+            if self.limits.get(topic_id, 0) != limit:
+                self.limits[topic_id] = limit
+                self.queue.push({"command": "limit", "topic_id": topic_id, "limit": limit},
+                                FetcherQueue.worker_key(self.node, worker_id))
+
+    def _unassign(self, topic_id, release=True):
+        """
+        Stops a topic in its worker and gives up its lease
+
+        @param self:
+        @param topic_id: Id of the topic
+        @param release: Whether to free the lease, not when it was already lost
+        @return: None
+        """
+        assignment = self.assignments.pop(topic_id, None)
+        self.limits.pop(topic_id, None)
+        if assignment is not None:
+            self.queue.push({"command": "stop", "topic_id": topic_id},
+                            FetcherQueue.worker_key(self.node, assignment[0]))
+        if release:
+            self.leases.release(topic_id)
+
+    def _healthy(self, worker_id):
+        process = self.processes[worker_id]
+        if not process.is_alive():
+            return False
+        if time.time() - self.started_at[worker_id] < FETCHER_HEARTBEAT_INTERVAL * 3:
+            return True
+        return self.redis.exists(heartbeat_key(self.node, worker_id))
+
+    def _check_workers(self):
+        """
+        Restarts the workers that died or stopped sending heartbeats, doubling the
+        wait between restarts of the same slot until it stays healthy for a while
+
+        @param self:
+        @return: None
+        """
+        now = time.time()
+        for worker_id in list(self.processes):
+            if self._healthy(worker_id):
+                if now - self.started_at[worker_id] > FETCHER_RESTART_BACKOFF_CAP:
+                    self.backoff[worker_id] = FETCHER_RESTART_BACKOFF
+                continue
+            if worker_id not in self.restart_at:
+                app.logger.error("Fetcher worker %s is unhealthy, restarting in %ss", worker_id,
+                                 self.backoff[worker_id])
+                if self.processes[worker_id].is_alive():
+                    self.processes[worker_id].terminate()
+                self.restart_at[worker_id] = now + self.backoff[worker_id]
+            elif now >= self.restart_at[worker_id]:
+                del self.restart_at[worker_id]
+                self.backoff[worker_id] = min(self.backoff[worker_id] * 2, FETCHER_RESTART_BACKOFF_CAP)
+                self._spawn(worker_id)
+
+    def _enforce_retention(self):
+        if time.time() < self.retention_at:
+            return
+        self.retention_at = time.time() + RETENTION_INTERVAL
+        try:
+            dropped = self.store.drop_expired()
+            if dropped:
+                app.logger.info("Dropped tweet partitions of %s", dropped)
+        except Exception:
+            app.logger.exception("Could not drop expired tweet partitions")
+
+    def _drain(self):
+        """
+        Asks every worker to disconnect its streams, waits for them to exit and
+        releases the leases of the node so other nodes take its topics right away
+
+        @param self:
+        @return: None
+        """
+        for worker_id in self.processes:
+            self.queue.push({"command": "drain"}, FetcherQueue.worker_key(self.node, worker_id))
+        deadline = time.time() + FETCHER_DRAIN_TIMEOUT
+        for process in self.processes.values():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                process.terminate()
+        for topic_id in list(self.assignments):
+            self.leases.release(topic_id)
+        self.leases.leave()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Supervisor of the fetcher workers")
+    commands = parser.add_subparsers(dest="command")
+    profile = commands.add_parser("profile", help="Profile running fetcher workers")
+    profile.add_argument("--topic", type=int, help="Profile the worker running this topic")
+    profile.add_argument("--node", help="Profile the workers of this node, of every node by default")
+    profile.add_argument("--worker", type=int, help="Profile this worker of the node, all of them by default")
+    profile.add_argument("--seconds", type=int, default=PROFILE_SECONDS)
+    args = parser.parse_args()
+    if args.command == "profile":
+        FetcherQueue().profile(args.seconds, topic_id=args.topic, node=args.node, worker_id=args.worker)
+    else:
+        FetcherPool().run()
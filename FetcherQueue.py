@@ -0,0 +1,119 @@
+import json
+from redis import StrictRedis
+
+from settings import REDIS_HOST, REDIS_PORT
+from util.leases import lease_key, live_nodes, owners
+from util.scheduler import Scheduler
+
+
+class FetcherQueue:
+    """
+    Topics to run and command queues between the API workers and the fetcher nodes.
+    fetcher:topics holds every topic that should be streaming, the nodes split them
+    among themselves through leases. Topics get there through the scheduler, which
+    keeps them waiting while their user or the fetchers are at their quota
+    """
+    COMMANDS = 'fetcher:commands'
+    TOPICS = 'fetcher:topics'
+
+    def __init__(self, redis=None):
+        self.redis = redis or StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        self.scheduler = Scheduler(self.redis)
+
+    @staticmethod
+    def node_key(node):
+        return f'{FetcherQueue.COMMANDS}:{node}'
+
+    @staticmethod
+    def worker_key(node, worker_id):
+        return f'{FetcherQueue.COMMANDS}:{node}:{worker_id}'
+
+    def start_topic(self, topic):
+        """
+        Adds a topic to the topics to run, or to the queue of the scheduler when its user
+        or the fetchers are at their quota. Tells the nodes to start it and the pending
+        topics started before it
+
+        @param self:
+        @param topic: Dict representation of the topic
+        @return: Admission of the topic, see Scheduler.admit, without the pending topics started
+        """
+        admission = self.scheduler.admit(topic)
+        started = admission.pop("started")
+        if admission["state"] == "running" and topic["id"] not in started:
+            started.append(topic["id"])
+        for topic_id in started:
+            # Any node may take it, the first one to pop the command does not wait for its next rebalance
+            self.push({"command": "start", "topic_id": topic_id})
+        return admission
+
+    def stop_topic(self, topic_id):
+        """
+        Removes a topic from the topics to run or waiting to run and tells the node running it, if any
+
+        @param self:
+        @param topic_id: Id of the topic
+        @return: Id of the node running the topic, None if it was not running
+        """
+        self.scheduler.cancel(topic_id)
+        _, node = self.redis.pipeline() \
+            .hdel(FetcherQueue.TOPICS, topic_id) \
+            .get(lease_key(topic_id)) \
+            .execute()
+        if node is None:
+            return None
+        node = node.decode()
+        self.push({"command": "stop", "topic_id": topic_id}, self.node_key(node))
+        return node
+
+    def profile(self, seconds, topic_id=None, node=None, worker_id=None):
+        """
+        Asks the node running a topic, a given node or every live node to profile its workers
+
+        @param self:
+        @param seconds: Duration of the profile
+        @param topic_id: Profile only the worker running this topic
+        @param node: Profile only the workers of this node
+        @param worker_id: Profile only this worker of the node
+        @return: List of the nodes asked
+        """
+        if topic_id is not None:
+            nodes = [owner for owner in [self.owners([topic_id])[topic_id]] if owner is not None]
+        else:
+            nodes = [node] if node is not None else live_nodes(self.redis)
+        for node in nodes:
+            self.push({"command": "profile", "seconds": seconds, "topic_id": topic_id, "worker": worker_id},
+                      self.node_key(node))
+        return nodes
+
+    def topics(self):
+        return {int(topic_id): json.loads(topic) for topic_id, topic in self.redis.hgetall(FetcherQueue.TOPICS).items()}
+
+    def finish(self, topic_id):
+        self.redis.hdel(FetcherQueue.TOPICS, topic_id)
+
+    def owners(self, topic_ids):
+        return owners(self.redis, topic_ids)
+
+    def admissions(self, topics):
+        return self.scheduler.admissions(topics)
+
+    def push(self, command, key=COMMANDS):
+        self.redis.lpush(key, json.dumps(command))
+
+    def pop(self, key=COMMANDS, timeout=1):
+        """
+        Next command of one of the queues, waiting up to timeout seconds
+
+        @param self:
+        @param key: Key of the queue, or list of keys to pop from the first one not empty
+        @param timeout: Seconds to wait
+        @return: Command, None if none arrived
+        """
+        item = self.redis.brpop(key, timeout=timeout)
+        if item is None:
+            return None
+        return json.loads(item[1])
+
+    def clear(self, key):
+        self.redis.delete(key)
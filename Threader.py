@@ -3,38 +3,106 @@ from redis import StrictRedis
 
 from settings import REDIS_HOST, REDIS_PORT
 
+# KEYS: hash of the user's threads, active index
+DELETE_THREADS = """
+local topics = redis.call('HKEYS', KEYS[1])
+for i = 1, #topics, 1000 do
+    redis.call('HDEL', KEYS[2], unpack(topics, i, math.min(i + 999, #topics)))
+end
+redis.call('DEL', KEYS[1])
+return #topics
+"""
+
+# KEYS: hash of the user's threads under the old key, hash under the new one, active index
+# ARGV: user id. Threads already under the new key are newer and kept
+MIGRATE_THREADS = """
+local threads = redis.call('HGETALL', KEYS[1])
+for i = 1, #threads, 2 do
+    redis.call('HSETNX', KEYS[2], threads[i], threads[i + 1])
+    redis.call('HSETNX', KEYS[3], threads[i], ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+return #threads / 2
+"""
+
 
 class Threader:
+    """
+    Registry of running topics. Each user has a hash of their threads keyed by topic id,
+    and threads:active maps every running topic id to its user
+    """
+    ACTIVE = 'threads:active'
 
-    def __init__(self):
-        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+    def __init__(self, redis=None):
+        self.redis = redis or StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        self._delete_threads = self.redis.register_script(DELETE_THREADS)
+        self._migrate_threads = self.redis.register_script(MIGRATE_THREADS)
+
+    @staticmethod
+    def _key(client):
+        return f'threads:user:{client}'
 
     def add_thread(self, client, thread):
-        self.redis.lpush(f'threads:{client}', json.dumps(thread))
+        topic_id = thread["topic"]["id"]
+        self.redis.pipeline() \
+            .hset(self._key(client), topic_id, json.dumps(thread)) \
+            .hset(Threader.ACTIVE, topic_id, client) \
+            .execute()
 
     def get_threads(self, client):
-        return self.redis.lrange(f'threads:{client}', 0, -1)
+        return [json.loads(thread) for thread in self.redis.hvals(self._key(client))]
 
     def get_thread(self, client, topic):
-        threads = self.get_threads(client)
-        for thread in threads:
-            th = json.loads(thread)
-            if th["topic"]["id"] == topic:
-                return th
-        return "Topic not found"
+        thread = self.redis.hget(self._key(client), topic)
+        if thread is None:
+            return "Topic not found"
+        return json.loads(thread)
+
+    def get_active(self):
+        return {int(topic): int(client) for topic, client in self.redis.hgetall(Threader.ACTIVE).items()}
+
+    def get_threads_by_topics(self, topics):
+        """
+        Fetches the threads of many topics, of any user, in two round trips
+
+        @param topics: List of topic ids
+        @return: Dict from topic id to its thread, only for running topics
+        """
+        if not topics:
+            return {}
+        clients = self.redis.hmget(Threader.ACTIVE, topics)
+        running = [(topic, client) for topic, client in zip(topics, clients) if client is not None]
+        pipe = self.redis.pipeline(transaction=False)
+        for topic, client in running:
+            pipe.hget(self._key(int(client)), topic)
+        threads = pipe.execute()
+        return {topic: json.loads(thread) for (topic, client), thread in zip(running, threads) if thread is not None}
 
     def delete_threads(self, client):
-        self.redis.delete(f'threads:{client}')
+        # In one script, a thread added between reading the topics and deleting the hash stays in the index otherwise
+        self._delete_threads(keys=[self._key(client), Threader.ACTIVE])
 
     def delete_thread(self, client, topic):
-        threads = self.get_threads(client)
-        self.delete_threads(client)
-        deleted_thread = None
-        for thread in threads:
-            th = json.loads(thread)
-            if th["topic"]["id"] != topic:
-                self.add_thread(client, th)
-            else:
-                deleted_thread = th
-        return deleted_thread
+        thread, _, _ = self.redis.pipeline() \
+            .hget(self._key(client), topic) \
+            .hdel(self._key(client), topic) \
+            .hdel(Threader.ACTIVE, topic) \
+            .execute()
+        if thread is None:
+            return None
+        return json.loads(thread)
+
+    def migrate(self):
+        """
+        Moves the threads kept under threads:<user id>, before threads:active existed, to
+        the current keys and adds them to the index
 
+        @param self:
+        @return: Number of threads moved
+        """
+        moved = 0
+        for key in self.redis.scan_iter('threads:*'):
+            client = key.decode().split(':', 1)[1]
+            if client.isdigit():
+                moved += self._migrate_threads(keys=[key, self._key(client), Threader.ACTIVE], args=[client])
+        return moved
@@ -1,47 +1,102 @@
 #!bin/python
 from tweepy.streaming import StreamListener
-from tweepy import API
 from tweepy import OAuthHandler
 from tweepy import Stream
-from twitter import Twitter, OAuth
-from geotext import GeoText
+from twitter import Twitter, OAuth, TwitterHTTPError
 
 import re
 import time
 import json
 import datetime
+import threading
+from collections import deque
+from urllib.parse import parse_qsl
 from redis import StrictRedis
-from BotMeter import BotMeter
+from DeadlineScheduler import deadline_time
+from util.backoff import ReconnectPolicy
+from util.matcher import search_query
+from util.sampler import AdaptiveSampler
+from util.ratelimit import RateLimiter
+from util.scheduler import user_weight
+from util.dedup import Deduplicator
+from util.geo import locate, location_keys, from_profile
+from util.metrics import metrics
 from models.sql_models import GeneralResult, LocationResult, EvolutionResult, SourceResult
-from settings import CONSUMER_SECRET, CONSUMER_KEY, ACCESS_TOKEN_SECRET, ACCESS_TOKEN, REDIS_HOST, REDIS_PORT, app
+from models.tweet_store import get_writer
+from models.tweet_record import TopicInfo, TweetRecord
+from settings import CONSUMER_SECRET, CONSUMER_KEY, ACCESS_TOKEN_SECRET, ACCESS_TOKEN, REDIS_HOST, REDIS_PORT, \
+    STREAM_BACKFILL_COUNT, STREAM_DEDUP_WINDOW, RATELIMIT_WINDOW, \
+    TWITTER_STREAM_HOST, TWITTER_STREAM_VERIFY, TWITTER_API_HOST, TWITTER_API_SECURE, app
 
 
 PAGE_SIZE = 100
 
 
-class TwitterFetcher(StreamListener):
+class ClosingStream(Stream):
     """
-    Fields to filter from tweet and user objects
+    Tweepy reconnects at once when Twitter closes the connection; stopping instead
+    lets the fetcher reconnect with its backoff, rate limit and backfill
     """
-    tweet_fields = ["id", "full_text", "text", "created_at", "geo", "coordinates", "place", "lang", "extended"]
-    user_fields = ["id", "name", "location"]
 
-    def __init__(self, deadline, topic_id, user_id):
+    def on_closed(self, resp):
+        self.running = False
+
+
+class TwitterFetcher(StreamListener):
+
+    def __init__(self, deadline, topic_id, user_id, redis=None, matcher=None):
         """
         Initialize connections with Redis and Twitter API
 
         @param self:
+        @param redis: Redis connection to share with other fetchers of the same process
+        @param matcher: TopicMatcher deciding which of the streamed tweets belong to the topic
         @return: None
         """
-        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        self.redis = redis or StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
         self.auth = OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
         self.auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-        self.twitter = Twitter(auth=OAuth(ACCESS_TOKEN, ACCESS_TOKEN_SECRET, CONSUMER_KEY, CONSUMER_SECRET))
-        self.bom = BotMeter()
+        self.twitter = Twitter(auth=OAuth(ACCESS_TOKEN, ACCESS_TOKEN_SECRET, CONSUMER_KEY, CONSUMER_SECRET),
+                               domain=TWITTER_API_HOST, secure=TWITTER_API_SECURE)
+        self.writer = get_writer()
         self.deadline = deadline
-        self.topic = ""
+        self.expires_at = deadline_time(deadline)
         self.topic_id = topic_id
         self.user_id = user_id
+        self.topic = ""
+        self.stopped = False
+        self.last_id = None
+        self.reconnect = ReconnectPolicy()
+        self._stream = None
+        self._status = None
+        self._wakeup = threading.Event()
+        self._seen = deque(maxlen=STREAM_DEDUP_WINDOW)
+        self._seen_ids = set()
+        self._bom = None
+        self.matcher = matcher
+        self.sampler = AdaptiveSampler(topic_id, self.redis)
+        self.dedup = Deduplicator(topic_id, self.redis)
+        self.search_limiter = RateLimiter(self.redis, 'search')
+        self.connect_limiter = RateLimiter(self.redis, 'connect')
+        # Share of the user in the shared budgets, read once per stream
+        self.weight = user_weight(self.redis, user_id)
+
+    @property
+    def topic(self):
+        return self.info.topic
+
+    @topic.setter
+    def topic(self, topic):
+        # Tweets already filtered keep the metadata they were filtered with
+        self.info = TopicInfo(topic, self.topic_id, self.user_id)
+
+    @property
+    def bom(self):
+        # Botometer is only needed to check accounts, not to stream
+        if self._bom is None:
+            from BotMeter import BotMeter
+            self._bom = BotMeter()
+        return self._bom
 
     def on_data(self, data):
         """
@@ -51,38 +106,59 @@ class TwitterFetcher(StreamListener):
         @param data: Data received from Twitter Stream
         @return: True
         """
-        tweet = json.loads(data)
+        with metrics.time('fetcher_stage_seconds', stage='decode', topic=self.topic_id):
+            tweet = json.loads(data)
 
         if 'limit' in tweet.keys():
+            metrics.inc('fetcher_limit_notices_total', topic=self.topic_id)
+            return True
+        elif 'created_at' not in tweet.keys():
             return True
         else:
-            format_date = datetime.datetime.strptime(tweet["created_at"], "%a %b %d %X %z %Y").date()
-            if time.mktime(format_date.timetuple()) > time.mktime(self.deadline.timetuple()):
+            metrics.inc('fetcher_tweets_in_total', topic=self.topic_id)
+            created_at = datetime.datetime.strptime(tweet["created_at"], "%a %b %d %X %z %Y")
+            if created_at.timestamp() >= self.expires_at:
+                self.stopped = True
                 return False
-            else:
-                filtered_tweet = self._filter_tweet(tweet)
-                print(json.dumps(filtered_tweet))
+            elif not self._is_new(tweet):
+                metrics.inc('fetcher_tweets_dropped_total', topic=self.topic_id, reason='duplicate')
+                return True
+            elif not self._matches(tweet):
+                metrics.inc('fetcher_tweets_dropped_total', topic=self.topic_id, reason='filter')
+                return True
+            weight = self.sampler.sample(float(tweet["timestamp_ms"]) / 1000 if "timestamp_ms" in tweet
+                                         else created_at.timestamp(), self.writer.pending())
+            if not weight:
+                metrics.inc('fetcher_tweets_dropped_total', topic=self.topic_id, reason='sampled')
                 return True
+            self._filter_tweet(tweet, weight)
+            return True
+
+    def on_connect(self):
+        self.reconnect.reset()
 
     def on_error(self, status):
         """
-        TODO: Handle error
+        Stops tweepy's own retries so the stream reconnects through the reconnect policy
 
         @param self:
         @param status: Status received from Twitter Stream stating the error
-        @return: None
+        @return: False
         """
-        app.logger.error(status)
+        app.logger.error("Stream of topic %s failed with status %s", self.topic_id, status)
+        self._status = status
+        return False
 
-    def stream(self, track, follow=None, async=False, locations=None,
+    def stream(self, track, follow=None, locations=None,
                stall_warnings=False, languages=['es'], encoding='utf8', filter_level="none"):
         """
-        Starts listener for Twitter Stream with specified parameters
+        Starts listener for Twitter Stream with specified parameters. Blocks until the
+        fetcher is disconnected or expires, reconnecting with backoff when the stream
+        drops and backfilling the gap through the search API
 
         @param self:
-        @param track: Topic to track in the Twitter Stream
+        @param track: Topic to track in the Twitter Stream, or list of phrases to track
         @param follow: Dont remember
-        @param async: Flag specifying whether it should be async or not
         @param locations: List of locations to restrict the Stream of tweets
         @param stall_warnings: Flag specifying whether to receive stall warnings or not
         @param languages: List of languages accepted for the Stream
@@ -90,12 +166,101 @@ class TwitterFetcher(StreamListener):
         @param filter_level: Dont remember
         @return: None
         """
-        self.topic = track.lower()
-        stream = Stream(self.auth, self)
-        stream.filter(follow=follow, track=[track], async=async, locations=locations, stall_warnings=stall_warnings,
-                      languages=languages, encoding=encoding, filter_level=filter_level)
+        track = [track] if isinstance(track, str) else list(track)
+        self.topic = ','.join(track).lower()
+        while not self.stopped and not self.expired():
+            if not self.connect_limiter.acquire(self.topic_id, sleep=self._wakeup.wait, user_id=self.user_id,
+                                                weight=self.weight):
+                return
+            self._stream = ClosingStream(self.auth, self, host=TWITTER_STREAM_HOST, verify=TWITTER_STREAM_VERIFY)
+            if self.stopped:
+                return
+            self._status = None
+            try:
+                self._stream.filter(follow=follow, track=track, locations=locations,
+                                    stall_warnings=stall_warnings, languages=languages, encoding=encoding,
+                                    filter_level=filter_level)
+            except Exception as e:
+                app.logger.warning("Stream of topic %s dropped: %s", self.topic_id, e)
+            if self.stopped or self.expired():
+                return
+            metrics.inc('fetcher_reconnects_total', topic=self.topic_id, status=self._status or 'network')
+            delay = self.reconnect.delay(self._status)
+            app.logger.info("Reconnecting topic %s in %.2fs", self.topic_id, delay)
+            if self._wakeup.wait(delay):
+                return
+            # Search takes a single language, the matcher drops the others
+            self._backfill(track, languages[0] if languages and len(languages) == 1 else None)
+
+    def _backfill(self, track, lang):
+        """
+        Searches the tweets published since the last one seen, to cover the time
+        the stream was down. Tweets already ingested are skipped
+
+        @param self:
+        @param track: List of phrases tracked in the Twitter Stream
+        @param lang: Language for the tweets
+        @return: None
+        """
+        if self.last_id is None:
+            return
+        query = {'q': search_query(track), 'count': PAGE_SIZE, 'lang': lang, 'since_id': self.last_id}
+        try:
+            self._search(query, STREAM_BACKFILL_COUNT // PAGE_SIZE, STREAM_BACKFILL_COUNT % PAGE_SIZE)
+        except Exception as e:
+            app.logger.warning("Backfill of topic %s failed: %s", self.topic_id, e)
+
+    def _matches(self, tweet):
+        with metrics.time('fetcher_stage_seconds', stage='match', topic=self.topic_id):
+            return self.matcher is None or self.matcher.matches(tweet)
+
+    def _is_new(self, tweet):
+        """
+        Remembers the ids of the last tweets ingested to skip the ones seen again
+        after a backfill
+
+        @param self:
+        @param tweet: Raw tweet object
+        @return: Whether the tweet was not seen before
+        """
+        tweet_id = tweet["id"]
+        if tweet_id in self._seen_ids:
+            return False
+        if len(self._seen) == self._seen.maxlen:
+            self._seen_ids.discard(self._seen[0])
+        self._seen.append(tweet_id)
+        self._seen_ids.add(tweet_id)
+        if self.last_id is None or tweet_id > self.last_id:
+            self.last_id = tweet_id
+        return True
+
+    def disconnect(self):
+        """
+        Stops the listener, closing the connection with the Twitter Stream
+
+        @param self:
+        @return: None
+        """
+        self.stopped = True
+        self._wakeup.set()
+        if self._stream is not None:
+            self._stream.disconnect()
+
+    def expired(self):
+        return time.time() >= self.expires_at
 
-    def search(self, query, count=100, lang='es', max_id=None):
+    def flush(self):
+        """
+        Writes the tweets buffered for the tweets table and the pending sampling counts
+
+        @param self:
+        @return: None
+        """
+        self.writer.flush()
+        self.sampler.flush()
+        self.dedup.flush()
+
+    def search(self, query, count=100, lang='es', max_id=None, since_id=None):
         """
         Searches for tweets matching query and other filter parameters
 
@@ -103,12 +268,14 @@ class TwitterFetcher(StreamListener):
         @param query: Topic to match in the search (mentions, hashtags, plain strings)
         @param count: Maximum amount of tweets to search
         @param lang: Language for the tweets
+        @param max_id: Only search tweets up to this id
+        @param since_id: Only search tweets newer than this id
         @return: List of tweets with their fields filtered
         """
         self.topic = query.lower()
         pages = count // PAGE_SIZE
         last_page = count % PAGE_SIZE
-        query = {'q': query, 'count': PAGE_SIZE, 'lang': lang, 'max_id': max_id}
+        query = {'q': query, 'count': PAGE_SIZE, 'lang': lang, 'max_id': max_id, 'since_id': since_id}
         self._search(query, pages, last_page)
         return None
 
@@ -131,7 +298,7 @@ class TwitterFetcher(StreamListener):
         if last_page != 0 and query is not None:
             query['count'] = last_page
             self._search_and_extend(query, tweets)
-        return [self._filter_tweet(tweet) for tweet in tweets]
+        return [self._filter_tweet(tweet) for tweet in tweets if self._is_new(tweet) and self._matches(tweet)]
 
     def _search_and_extend(self, query, tweets):
         """
@@ -142,8 +309,17 @@ class TwitterFetcher(StreamListener):
         @param tweets: List of tweets where to store searched tweets
         @return: The Result of the search
         """
-        result = self.twitter.search.tweets(q=query['q'], count=query['count'],
-                                            lang=query['lang'], max_id=query['max_id'], tweet_mode="extended")
+        params = {key: value for key, value in query.items() if value is not None}
+        if not self.search_limiter.acquire(self.topic_id, sleep=self._wakeup.wait, user_id=self.user_id,
+                                           weight=self.weight):
+            return {'statuses': [], 'search_metadata': {}}
+        try:
+            result = self.twitter.search.tweets(tweet_mode="extended", **params)
+        except TwitterHTTPError as e:
+            if e.e.code == 429:
+                reset = e.e.headers.get('x-rate-limit-reset')
+                self.search_limiter.drain(float(reset) if reset else time.time() + RATELIMIT_WINDOW)
+            raise
         tweets.extend(result['statuses'])
         return result
 
@@ -156,35 +332,42 @@ class TwitterFetcher(StreamListener):
         @return: Dictionary with a query for the next page of tweets
         """
         if "next_results" in metadata.keys():
-            params = metadata['next_results'].split('&')
-            query = {}
-            for p in params:
-                p = p.replace('?', '')
-                key, value = p.split('=')
-                query[key] = value
-            return query
+            return dict(parse_qsl(metadata['next_results'].lstrip('?')))
 
-    def _filter_tweet(self, tweet):
+    def _filter_tweet(self, tweet, weight=1):
         """
         Filters fields from a tweet and stores it in Redis
 
         @param self:
         @param tweet: Raw tweet object
-        @return: Filtered tweet
-        """
-        if "extended_tweet" in tweet.keys():
-            tweet["text"] = tweet["extended_tweet"]["full_text"]
-        elif "retweeted_status" in tweet.keys() and "full_text" in tweet["retweeted_status"].keys():
-            tweet["text"] = "RT " + tweet["retweeted_status"]["full_text"]
-
-        filtered_data = self._extract(tweet, TwitterFetcher.tweet_fields)
-        filtered_data["user"] = self._extract(tweet["user"], TwitterFetcher.user_fields)
-        filtered_data["CC"] = self._get_location(tweet["user"]["location"])
-        filtered_data["social"] = {"topic": self.topic, "topic_id": self.topic_id, "user_id": self.user_id}
-        filtered_data["source"] = self._get_source(tweet["source"])
-        self.redis.publish(f'twitter:stream', json.dumps(filtered_data))
-        self._initialize_results(filtered_data)
-        return filtered_data
+        @param weight: Amount of tweets this one stands for when the stream is being sampled
+        @return: TweetRecord of the filtered tweet
+        """
+        with metrics.time('fetcher_stage_seconds', stage='filter', topic=self.topic_id):
+            if "extended_tweet" in tweet.keys():
+                tweet["text"] = tweet["extended_tweet"]["full_text"]
+            elif "retweeted_status" in tweet.keys() and "full_text" in tweet["retweeted_status"].keys():
+                tweet["text"] = "RT " + tweet["retweeted_status"]["full_text"]
+
+            record = TweetRecord(tweet, self.info, weight)
+        with metrics.time('fetcher_stage_seconds', stage='dedup', topic=self.topic_id):
+            record.cluster, record.copy = self.dedup.cluster(tweet, record.text or "", weight)
+        with metrics.time('fetcher_stage_seconds', stage='location', topic=self.topic_id):
+            location = locate(tweet)
+            if location is None:
+                location = from_profile(self._get_location(record.user_location))
+        record.location = location
+        record.location_keys = location_keys(location)
+        with metrics.time('fetcher_stage_seconds', stage='source', topic=self.topic_id):
+            record.source = self._get_source(tweet["source"])
+        with metrics.time('fetcher_stage_seconds', stage='publish', topic=self.topic_id):
+            # Copies go without their text, their sentiment is the one of the first tweet of the cluster
+            self.redis.publish(f'twitter:stream', json.dumps(record.to_dict(text=not record.copy)))
+        self.writer.add(record)
+        with metrics.time('fetcher_stage_seconds', stage='results', topic=self.topic_id):
+            self._initialize_results(record)
+        metrics.inc('fetcher_tweets_out_total', topic=self.topic_id)
+        return record
 
     @staticmethod
     def _get_location(location):
@@ -195,22 +378,13 @@ class TwitterFetcher(StreamListener):
         @return: Matched country code ('UN' if not matched)
         """
         if location is not None:
+            # Deferred, loading the cities of geotext takes a while and a lot of memory
+            from geotext import GeoText
             p = GeoText(location)
             if p.country_mentions:
                 return list(p.country_mentions.items())[0][0]
         return "UN"
 
-    @staticmethod
-    def _extract(json_fields, fields):
-        """
-        Extracts specified fields from a jason 13th object
-
-        @param jason_killer: Dict object representing the Jason to filter
-        @param fields: Fields to filter from Jason
-        @return: Dict with filtered fields of Jason
-        """
-        return {key: value for key, value in json_fields.items() if key in fields}
-
     @staticmethod
     def _get_source(source):
         if "Twitter Lite" in source:
@@ -243,9 +417,10 @@ class TwitterFetcher(StreamListener):
     def _initialize_results(self, tweet):
         if not GeneralResult.is_in(self.topic_id):
             GeneralResult.create(self.topic_id)
-        if not EvolutionResult.is_in(self.topic_id, tweet["created_at"]):
-            EvolutionResult.create(self.topic_id, tweet["created_at"])
-        if not LocationResult.is_in(self.topic_id, tweet["CC"]):
-            LocationResult.create(self.topic_id, tweet["CC"])
-        if not SourceResult.is_in(self.topic_id, tweet["source"]):
-            SourceResult.create(self.topic_id, tweet["source"])
+        if not EvolutionResult.is_in(self.topic_id, tweet.created_at):
+            EvolutionResult.create(self.topic_id, tweet.created_at)
+        for location in tweet.location_keys:
+            if not LocationResult.is_in(self.topic_id, location):
+                LocationResult.create(self.topic_id, location)
+        if not SourceResult.is_in(self.topic_id, tweet.source):
+            SourceResult.create(self.topic_id, tweet.source)
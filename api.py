@@ -1,31 +1,51 @@
 import datetime
 import json
-import os
-import signal
-import threading
-from multiprocessing import Process
 
 import jwt
-from flask import request, url_for, render_template, redirect
-from flask_sqlalchemy import SQLAlchemy
+from flask import request, url_for, render_template, redirect, Response, stream_with_context
 from flask_cors import CORS, cross_origin
 
-from TwitterFetcher import TwitterFetcher
+from FetcherQueue import FetcherQueue
 from Threader import Threader
-from models.models import User, Topic, GeneralResult, EvolutionResult, LocationResult, SourceResult
+from models.models import User, Topic, GeneralResult, EvolutionResult, LocationResult, SourceResult, Tweet
 from oauth import default_provider
-from settings import app
-from models.models import db
+from settings import app, TOPICS_PAGE_SIZE, TOPICS_MAX_PAGE_SIZE, RESULTS_MAX_TOPICS, METRICS_TOKEN, \
+    EXPORT_BATCH_SIZE
+from models.models import db, add_missing_columns
 from util.security import ts
+from util.hashing import HasherOverloaded
+from util.matcher import TopicMatcher, QueryError, validate_terms
+from util.sampler import sampling_stats
+from util.dedup import dedup_stats
+from util.geo import SEPARATOR
 from util.mailers import ResetPasswordMailer
+from util import export
+from util import metrics
 
 oauth = default_provider(app)
 cors = CORS(app)
+metrics.init_app(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
-db.create_all()
-db = SQLAlchemy(app)
 EXPIRATION_HOURS = 24
+fetcher_queue = FetcherQueue()
 threader = Threader()
+RESULT_FIELDS = ('general', 'locations', 'evolution', 'sources', 'sampling', 'duplicates')
+TWEET_COLUMNS = tuple(column.name for column in Tweet.__table__.columns)
+RESULT_COLUMNS = ('kind', 'day', 'location', 'source', 'positive', 'negative', 'neutral')
+
+
+@app.cli.command('create-db')
+def create_db():
+    """Creates the tables of the API models that do not exist yet, adds the columns they lack and moves old threads"""
+    db.create_all()
+    for column in add_missing_columns():
+        app.logger.info("Added column %s", column)
+    app.logger.info("Moved %s threads to the current keys", threader.migrate())
+
+
+@app.errorhandler(HasherOverloaded)
+def hasher_overloaded(error):
+    return json.dumps({'error': 'Servidor ocupado, intente nuevamente', 'code': 503}), 503, {'Retry-After': '1'}
 
 
 @app.route("/api/ping", methods=['GET'])
@@ -33,6 +53,16 @@ def ping():
     return "pong"
 
 
+@app.route("/api/metrics", methods=['GET'])
+def get_metrics():
+    # Disabled unless a token is configured, series are labeled by topic
+    if not METRICS_TOKEN:
+        return 'Not found', 404
+    if request.headers.get('token') != METRICS_TOKEN:
+        return 'Invalid token', 401
+    return metrics.render(threader.redis), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route("/api/topics", methods=['POST'])
 def create_topic():
     token, error = validate_token(request.headers)
@@ -40,23 +70,39 @@ def create_topic():
         return error
     req = request.get_json(force=True)
     app.logger.debug("Token: %s, request: %s", token, req)
-    req['deadline'] = datetime.datetime.strptime(req['deadline'], "%d-%m-%Y").date()
-    topic = Topic.create(token['user_id'], req['name'], req['deadline'], req['language'])
-    thread = threading.Thread(target=init_process, args=(start_fetching, [req["name"], topic.id,
-                                                                          token['user_id'], req["deadline"],
-                                                                          req["language"], topic]),
-                              daemon=True)
-    thread.start()
-    # p = init_process(target=start_fetching, args=(req["name"], topic.id, token['user_id'], req["deadline"], req["language"]))
-    return json.dumps(topic.to_dict())
+    deadline, deadline_at = parse_deadline(req['deadline'])
+    languages = req.get('languages') or [req['language']]
+    try:
+        terms = validate_terms(req.get('terms') or [req['name']])
+        TopicMatcher(req.get('include'), req.get('exclude'), languages)
+    except QueryError as e:
+        return json.dumps({'error': str(e), 'code': 400}), 400
+    topic = Topic.create(token['user_id'], req['name'], deadline, req.get('language') or languages[0], deadline_at,
+                         terms, languages, req.get('include'), req.get('exclude'))
+    admission = fetcher_queue.start_topic(topic.to_dict())
+    if admission['state'] == 'rejected':
+        # Nothing was queued, the topic is not kept either
+        db.session.delete(topic)
+        db.session.commit()
+        return json.dumps({'error': 'Too many topics waiting to run', 'code': 429, 'admission': admission}), 429
+    return json.dumps(dict(topic.to_dict(), admission=admission))
 
 
 @app.route("/api/topics", methods=['DELETE'])
-def finish_topic():
-    req = request.get_json(force=True)
-    app.logger.debug("Request: %s", req)
-    os.kill(req["process"], signal.SIGTERM)
-    response = {"process": req["process"], "status": "killed"}
+@app.route("/api/topics/<int:topic_id>", methods=['DELETE'])
+def finish_topic(topic_id=None):
+    token, error = validate_token(request.headers)
+    if error:
+        return error
+    if topic_id is None:
+        req = request.get_json(force=True)
+        app.logger.debug("Request: %s", req)
+        topic_id = req["topic_id"]
+    topic = Topic.query.filter_by(id=topic_id, user_id=token['user_id']).first()
+    if not topic:
+        return json.dumps({'error': 'Topic not found', 'code': 404}), 404
+    node = fetcher_queue.stop_topic(topic.id)
+    response = {"topic_id": topic.id, "status": "stopping" if node else "stopped"}
     return json.dumps(response)
 
 
@@ -84,12 +130,13 @@ def reset_with_token():
         password = req["password"]
 
         user = User.query.filter_by(email=email).first()
-        user.password = password
-        db.session.commit()
+        user.set_password(password)
         expiration_date, token = generateToken(user)
 
         return json.dumps(
             {"status": "ok", 'name': user.name, 'token': token.decode('utf-8'), 'expire_utc': int(expiration_date.timestamp() * 1000)}), 200
+    except HasherOverloaded:
+        raise
     except:
         return "Expired token", 404
 
@@ -149,17 +196,111 @@ def get_topics():
     if error:
         return error
     app.logger.debug("Token: %s", token)
-    topics = Topic.query.filter_by(user_id=token['user_id']).all()
-    return json.dumps([topic.to_dict() for topic in topics])
-
-
-@app.route("/api/topics/<topic_id>/results", methods=['GET'])
+    after = request.args.get('after', type=int)
+    limit = min(request.args.get('limit', TOPICS_PAGE_SIZE, type=int), TOPICS_MAX_PAGE_SIZE)
+    if limit < 1:
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    include = request.args.get('include', '').split(',')
+    topics = list_topics(token['user_id'], after, limit, 'status' in include, 'summary' in include)
+    headers = {}
+    if len(topics) == limit:
+        headers['X-Next-After'] = str(topics[-1]['id'])
+    return json.dumps(topics), 200, headers
+
+
+@app.route("/api/topics/<int:topic_id>/results", methods=['GET'])
 def get_results(topic_id):
     token, error = validate_token(request.headers)
     if error:
         return error
     app.logger.debug("Topic: %s", topic_id)
-    return json.dumps(query_results(topic_id=topic_id))
+    topic = Topic.query.filter_by(id=topic_id, user_id=token['user_id']).first()
+    if not topic:
+        return json.dumps({'error': 'Topic not found', 'code': 404}), 404
+    return json.dumps(query_results(topic))
+
+
+@app.route("/api/topics/<int:topic_id>/locations", methods=['GET'])
+def get_locations(topic_id):
+    """
+    Location results under a country or a province: ?country=AR or ?country=AR&province=Buenos Aires
+    (?country=AR&province= for the cities whose province is not known)
+    """
+    token, error = validate_token(request.headers)
+    if error:
+        return error
+    country = request.args.get('country')
+    province = request.args.get('province')
+    if not country:
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    if not Topic.query.filter_by(id=topic_id, user_id=token['user_id']).first():
+        return json.dumps({'error': 'Topic not found', 'code': 404}), 404
+    parent = country.upper() if province is None else country.upper() + SEPARATOR + province
+    return json.dumps([result.to_dict() for result in LocationResult.children(topic_id, parent)])
+
+
+@app.route("/api/results", methods=['GET'])
+def get_many_results():
+    """
+    Results of many topics: ?topics=1,2,3&fields=general,locations,evolution,sources,sampling,duplicates
+    &from=01-09-2018&to=30-09-2018
+    """
+    token, error = validate_token(request.headers)
+    if error:
+        return error
+    try:
+        topic_ids = [int(topic_id) for topic_id in request.args.get('topics', '').split(',') if topic_id]
+        since = request.args.get('from')
+        until = request.args.get('to')
+        since = datetime.datetime.strptime(since, "%d-%m-%Y").date() if since else None
+        until = datetime.datetime.strptime(until, "%d-%m-%Y").date() if until else None
+    except ValueError:
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    fields = request.args.get('fields', ','.join(RESULT_FIELDS)).split(',')
+    if not topic_ids or len(topic_ids) > RESULTS_MAX_TOPICS or not set(fields) <= set(RESULT_FIELDS):
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    topics = Topic.query.filter(Topic.id.in_(topic_ids), Topic.user_id == token['user_id']).all()
+    missing = set(topic_ids) - {topic.id for topic in topics}
+    if missing:
+        return json.dumps({'error': 'Topic not found', 'topics': sorted(missing), 'code': 404}), 404
+    return json.dumps(query_results_bulk(topics, fields, since, until))
+
+
+@app.route("/api/topics/<int:topic_id>/export", methods=['GET'])
+def export_topic(topic_id):
+    """
+    Stored tweets or result rows of a topic, streamed with constant memory:
+    ?data=tweets|results&format=ndjson|csv&from=01-09-2018&to=30-09-2018
+    Gzipped when the client accepts it
+    """
+    token, error = validate_token(request.headers)
+    if error:
+        return error
+    data = request.args.get('data', 'tweets')
+    format = request.args.get('format', 'ndjson')
+    try:
+        since = request.args.get('from')
+        until = request.args.get('to')
+        since = datetime.datetime.strptime(since, "%d-%m-%Y").date() if since else None
+        until = datetime.datetime.strptime(until, "%d-%m-%Y").date() if until else None
+    except ValueError:
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    if data not in ('tweets', 'results') or format not in export.FORMATS:
+        return json.dumps({'error': 'Parametros invalidos', 'code': 400}), 400
+    topic = Topic.query.filter_by(id=topic_id, user_id=token['user_id']).first()
+    if not topic:
+        return json.dumps({'error': 'Topic not found', 'code': 404}), 404
+    if data == 'tweets':
+        body = export.encode(TWEET_COLUMNS, tweet_rows(topic_id, since, until), format)
+    else:
+        body = export.encode(RESULT_COLUMNS, result_rows(topic_id, since, until), format)
+    headers = {'Content-Disposition': f'attachment; filename=topic-{topic_id}-{data}.{format}',
+               # So nginx passes chunks on as they come instead of buffering the whole export
+               'X-Accel-Buffering': 'no'}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = export.gzipped(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype=export.FORMATS[format], headers=headers)
 
 
 # Auxiliar
@@ -177,41 +318,165 @@ def validate_token(headers):
     return token, None
 
 
-def start_fetching(topic, topic_id, user_id, deadline=datetime.date.today(), lang='es'):
-    twitter_fetcher = TwitterFetcher(deadline, topic_id, user_id)
-    twitter_fetcher.stream(topic, languages=[lang])
-    threader.delete_thread(user_id, topic_id)
-
-
-def init_process(target, args):
-    p = Process(target=target, args=args[0:5])
-    p.daemon = True
-    p.start()
-    threader.add_thread(args[2], {"process": p.pid, "topic": args[5].to_dict()})
-    return p
+def list_topics(user_id, after=None, limit=TOPICS_PAGE_SIZE, status=False, summary=False):
+    """
+    Page of the topics of a user ordered by id, starting after the given id
+
+    @param user_id: Owner of the topics
+    @param after: Id of the last topic of the previous page
+    @param limit: Maximum amount of topics in the page
+    @param status: Whether to include the running status, from the leases of the fetcher nodes, and the admission
+    @param summary: Whether to include the general results, joined in the same query
+    @return: List of topic dicts
+    """
+    query = Topic.query.filter(Topic.user_id == user_id)
+    if after is not None:
+        query = query.filter(Topic.id > after)
+    if summary:
+        query = query.add_entity(GeneralResult).outerjoin(GeneralResult, GeneralResult.topic_id == Topic.id)
+    rows = query.order_by(Topic.id).limit(limit).all()
+    if not summary:
+        rows = [(topic, None) for topic in rows]
+    if status:
+        topic_ids = [topic.id for topic, _ in rows]
+        threads = threader.get_threads_by_topics(topic_ids)
+        # A topic runs where its lease is held, the registry may still have threads of nodes that died
+        owners = fetcher_queue.owners(topic_ids)
+        admissions = fetcher_queue.admissions([topic for topic, _ in rows])
+    topics = []
+    for topic, general_result in rows:
+        topic_dict = topic.to_dict()
+        if summary:
+            topic_dict['summary'] = general_result.to_dict() if general_result else {}
+        if status:
+            node, thread = owners[topic.id], threads.get(topic.id)
+            topic_dict['status'] = {'running': node is not None, 'node': node,
+                                    'worker': thread.get('worker') if thread and thread.get('node') == node else None,
+                                    'admission': admissions[topic.id]}
+        topics.append(topic_dict)
+    return topics
+
+
+def parse_deadline(deadline):
+    """
+    Deadlines are either a whole day ('%d-%m-%Y') or an exact UTC time ('%d-%m-%Y %H:%M')
+    """
+    try:
+        deadline_at = datetime.datetime.strptime(deadline, "%d-%m-%Y %H:%M")
+    except ValueError:
+        return datetime.datetime.strptime(deadline, "%d-%m-%Y").date(), None
+    return deadline_at.date(), deadline_at
 
 
-def query_results(topic_id):
-    topic = Topic.query.filter_by(id=topic_id).first()
+def query_results(topic):
+    topic_id = topic.id
     gr = GeneralResult.query.filter_by(topic_id=topic_id).all()
     if gr != []:
         gr = gr[0].to_dict()
     else:
         gr = {}
     lrs = []
-    lr = LocationResult.query.filter_by(topic_id=topic_id).all()
+    lr = LocationResult.countries().filter_by(topic_id=topic_id).all()
     for l in lr:
         lrs.append(l.to_dict())
     ers = []
-    er = EvolutionResult.query.filter_by(topic_id=topic_id).order_by("day asc").all()
+    er = EvolutionResult.query.filter_by(topic_id=topic_id).order_by(EvolutionResult.day.asc()).all()
     for e in er:
         ers.append(e.to_dict())
     srs = []
     sr = SourceResult.query.filter_by(topic_id=topic_id).all()
     for s in sr:
         srs.append(s.to_dict())
+    sampling = sampling_stats(threader.redis, [topic_id])[topic_id]
+    duplicates = dedup_stats(threader.redis, [topic_id])[topic_id]
     return {"topic": topic.to_dict(), "generalResults": gr, "locationResults": lrs,
-            "evolutionResults": ers, "sourceResults": srs}
+            "evolutionResults": ers, "sourceResults": srs, "sampling": sampling, "duplicates": duplicates}
+
+
+def query_results_bulk(topics, fields=RESULT_FIELDS, since=None, until=None):
+    """
+    Results of many topics with one IN (...) query per kind of result
+
+    @param topics: List of topics
+    @param fields: Kinds of results to include, from RESULT_FIELDS
+    @param since: First day of the evolution results to include
+    @param until: Last day of the evolution results to include
+    @return: Dict from topic id to its results, shaped like query_results
+    """
+    topic_ids = [topic.id for topic in topics]
+    results = {topic.id: {"topic": topic.to_dict()} for topic in topics}
+    if 'general' in fields:
+        for result in results.values():
+            result["generalResults"] = {}
+        for gr in GeneralResult.query.filter(GeneralResult.topic_id.in_(topic_ids)):
+            results[gr.topic_id]["generalResults"] = gr.to_dict()
+    if 'locations' in fields:
+        _group_results(results, "locationResults",
+                       LocationResult.countries().filter(LocationResult.topic_id.in_(topic_ids)))
+    if 'evolution' in fields:
+        query = EvolutionResult.query.filter(EvolutionResult.topic_id.in_(topic_ids))
+        if since:
+            query = query.filter(EvolutionResult.day >= since)
+        if until:
+            query = query.filter(EvolutionResult.day <= until)
+        _group_results(results, "evolutionResults", query.order_by(EvolutionResult.day.asc()))
+    if 'sources' in fields:
+        _group_results(results, "sourceResults", SourceResult.query.filter(SourceResult.topic_id.in_(topic_ids)))
+    if 'sampling' in fields:
+        for topic_id, stats in sampling_stats(threader.redis, topic_ids, since, until).items():
+            results[topic_id]["sampling"] = stats
+    if 'duplicates' in fields:
+        for topic_id, stats in dedup_stats(threader.redis, topic_ids).items():
+            results[topic_id]["duplicates"] = stats
+    return results
+
+
+def tweet_rows(topic_id, since=None, until=None):
+    """
+    Stored tweets of a topic in order, fetched EXPORT_BATCH_SIZE at a time through a server side cursor
+
+    @param topic_id: Id of the topic
+    @param since: First day of the tweets
+    @param until: Last day of the tweets
+    @return: Iterable of tuples with the values of TWEET_COLUMNS
+    """
+    query = db.session.query(*Tweet.__table__.columns).filter(Tweet.topic_id == topic_id)
+    if since:
+        query = query.filter(Tweet.created_at >= since)
+    if until:
+        query = query.filter(Tweet.created_at < until + datetime.timedelta(days=1))
+    return query.order_by(Tweet.created_at).execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def result_rows(topic_id, since=None, until=None):
+    """
+    Result rows of a topic of every kind
+
+    @param topic_id: Id of the topic
+    @param since: First day of the evolution results
+    @param until: Last day of the evolution results
+    @return: Generator of tuples with the values of RESULT_COLUMNS
+    """
+    evolution = EvolutionResult.query.filter(EvolutionResult.topic_id == topic_id)
+    if since:
+        evolution = evolution.filter(EvolutionResult.day >= since)
+    if until:
+        evolution = evolution.filter(EvolutionResult.day <= until)
+    queries = (('general', GeneralResult.query.filter(GeneralResult.topic_id == topic_id)),
+               ('evolution', evolution.order_by(EvolutionResult.day.asc())),
+               ('locations', LocationResult.query.filter(LocationResult.topic_id == topic_id)),
+               ('sources', SourceResult.query.filter(SourceResult.topic_id == topic_id)))
+    for kind, query in queries:
+        for result in query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE):
+            yield (kind, getattr(result, 'day', None), getattr(result, 'location', None),
+                   getattr(result, 'source', None), result.positive, result.negative, result.neutral)
+
+
+def _group_results(results, key, rows):
+    for result in results.values():
+        result[key] = []
+    for row in rows:
+        results[row.topic_id][key].append(row.to_dict())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+import random
+import datetime
+
+LOCATIONS = ["Buenos Aires, Argentina", "Montevideo", "CABA", "Santiago de Chile", "Madrid, España",
+             "Rosario", "en mi casa", None, "Lima, Peru", "Cordoba, Argentina", "Bogotá", "Mexico DF", ""]
+SOURCES = ["Twitter for Android", "Twitter for iPhone", "Twitter Web Client", "Twitter Lite", "TweetDeck",
+           "Hootsuite Inc.", "IFTTT", "Facebook", "Tweetbot for iΟS", "Buffer"]
+PLACES = [{"place_type": "city", "name": "Palermo", "full_name": "Palermo, Buenos Aires", "country_code": "AR",
+           "country": "Argentina"},
+          {"place_type": "admin", "name": "Montevideo", "full_name": "Montevideo, Uruguay", "country_code": "UY",
+           "country": "Uruguay"}]
+POINTS = [[-58.38, -34.60], [-64.18, -31.42], [-3.70, 40.42], [-99.13, 19.43]]
+WORDS = ["messi", "seleccion", "sampaoli", "gol", "partido", "mundial", "argentina", "hoy", "que", "la",
+         "de", "el", "un", "vamos", "nunca", "siempre", "futbol", "equipo", "jugar", "copa"]
+
+
+def tweets(amount=2000, seed=42):
+    """
+    Fixed synthetic stream of raw tweets shaped like the ones of the Twitter API
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2018, 9, 16, tzinfo=datetime.timezone.utc)
+    corpus = []
+    for i in range(amount):
+        created_at = start + datetime.timedelta(seconds=i * 7)
+        source = rng.choice(SOURCES)
+        tweet = {
+            "id": 1041000000000000000 + i,
+            "created_at": created_at.strftime("%a %b %d %X %z %Y"),
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 25))),
+            "lang": "es",
+            "geo": None,
+            "coordinates": None,
+            "place": None,
+            "source": f'<a href="http://example.com" rel="nofollow">{source}</a>',
+            "user": {"id": rng.randint(1, 10 ** 9), "name": f"user{i}", "location": rng.choice(LOCATIONS),
+                     "screen_name": f"user{i}", "followers_count": rng.randint(0, 10000)},
+        }
+        # Few tweets are geotagged, some with only their coordinates
+        if i % 10 == 0:
+            tweet["place"] = PLACES[i // 10 % len(PLACES)]
+        elif i % 10 == 5:
+            tweet["coordinates"] = {"type": "Point", "coordinates": POINTS[i // 10 % len(POINTS)]}
+        if rng.random() < 0.3:
+            # Retweets of a few popular tweets
+            tweet["retweeted_status"] = {"id": 1040000000000000000 + i % 97,
+                                         "full_text": tweet["text"] + " " + rng.choice(WORDS)}
+        elif rng.random() < 0.2:
+            tweet["extended_tweet"] = {"full_text": tweet["text"] * 2}
+        corpus.append(tweet)
+    return corpus
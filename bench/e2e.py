@@ -0,0 +1,141 @@
+"""
+End to end run of real fetchers against the local Twitter stand-in, from the repository root:
+
+    python -m bench.e2e --seconds 30 --topics 4 --rate 500 --disconnect-after 10
+
+Streams through tweepy over https, backfills through the search API after every
+reconnection and runs the whole filtering path, with SQLite for the results and the
+in-memory Redis stand-in. Reports the tweets served and processed per second, the
+reconnections, the backfill searches and the tweets dropped by reason.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import defaultdict
+
+from mock.twitter_server import Scenario, start, stop, self_signed
+
+DROPPED = re.compile(r'fetcher_tweets_dropped_total\{reason="(\w+)"')
+
+
+class LineCounter:
+    """
+    Stand-in for stdout, where fetchers print every processed tweet
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def configure(servers, cert, directory):
+    http, https = servers
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{directory}/e2e.sqlite',
+        'TWITTER_STREAM_HOST': f'localhost:{https.server_address[1]}',
+        'TWITTER_STREAM_VERIFY': cert,
+        'TWITTER_API_HOST': f'127.0.0.1:{http.server_address[1]}',
+        'TWITTER_API_SECURE': 'false',
+    })
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    for variable in ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_TOKEN',
+                     'TWITTER_ACCESS_TOKEN_SECRET'):
+        os.environ.setdefault(variable, 'bench')
+
+
+def run(topics, seconds):
+    from util.metrics import metrics
+    from TwitterFetcher import TwitterFetcher
+    from models.sql_models import Base, get_engine
+    from bench.stand_ins import InMemoryRedis, NullWriter
+
+    # No flush thread, counters stay in this process
+    metrics._pid = os.getpid()
+    Base.metadata.create_all(get_engine())
+    redis = InMemoryRedis()
+    deadline = datetime.date.today() + datetime.timedelta(days=2)
+    fetchers = []
+    for topic_id in range(1, topics + 1):
+        fetcher = TwitterFetcher(deadline, topic_id, 1, redis=redis)
+        fetcher.writer = NullWriter()
+        fetchers.append(fetcher)
+    threads = [threading.Thread(target=fetcher.stream, args=(['messi', 'copa america'],), name=f'topic-{topic_id}')
+               for topic_id, fetcher in enumerate(fetchers, 1)]
+    counter, stdout = LineCounter(), sys.stdout
+    sys.stdout = counter
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        for fetcher in fetchers:
+            fetcher.disconnect()
+        for thread in threads:
+            thread.join(30)
+    finally:
+        sys.stdout = stdout
+    dropped = defaultdict(int)
+    for key, value in metrics._counters.items():
+        match = DROPPED.match(key)
+        if match:
+            dropped[match.group(1)] += int(value)
+    return counter.lines, dict(dropped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end run against the local Twitter stand-in")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--topics", type=int, default=1, help="Fetchers streaming at once")
+    parser.add_argument("--rate", type=float, default=200, help="Tweets per second of each stream")
+    parser.add_argument("--burst-every", type=float, default=0, help="Seconds between bursts")
+    parser.add_argument("--burst-seconds", type=float, default=5, help="Length of each burst")
+    parser.add_argument("--burst-factor", type=float, default=10, help="Rate multiplier during bursts")
+    parser.add_argument("--limit-every", type=float, default=5, help="Seconds between limit notices")
+    parser.add_argument("--disconnect-after", type=float, default=0, help="Seconds before closing each stream")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of stream connections rejected")
+    parser.add_argument("--error-status", type=int, default=503, help="Status of rejected connections")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="e2e-")
+    cert, key = self_signed(directory)
+    scenario = Scenario(rate=args.rate, burst_every=args.burst_every, burst_seconds=args.burst_seconds,
+                        burst_factor=args.burst_factor, limit_every=args.limit_every,
+                        disconnect_after=args.disconnect_after, error_status=args.error_status,
+                        error_rate=args.error_rate, search_limit=0, seed=1)
+    twitter, servers = start(scenario, port=0, tls_port=0, cert=cert, key=key)
+    configure(servers, cert, directory)
+    processed, dropped = run(args.topics, args.seconds)
+    stop(twitter, servers)
+
+    stats = dict(twitter.stats)
+    report = {
+        "seconds": args.seconds,
+        "topics": args.topics,
+        "served_per_second": stats["tweets"] / args.seconds,
+        "processed_per_second": processed / args.seconds,
+        "connections": stats["connections"],
+        "rejected": stats["rejected"],
+        "backfill_searches": stats["searches"],
+        "dropped": dropped,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
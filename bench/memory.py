@@ -0,0 +1,88 @@
+"""
+Memory of the filtered tweets a fetcher holds, from the repository root:
+
+    python -m bench.memory                  2000 tweets
+    python -m bench.memory --tweets 20000
+
+Filters the same synthetic corpus twice, keeping every filtered tweet like a backfill
+does: once as the TweetRecord the fetcher passes around, once as the nested dicts it is
+serialized to. Reports the bytes retained per tweet, the peak traced memory and the
+collections of the garbage collector in each case.
+"""
+import os
+import gc
+import copy
+import json
+import argparse
+import datetime
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'bench')
+for variable in ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_TOKEN',
+                 'TWITTER_ACCESS_TOKEN_SECRET'):
+    os.environ.setdefault(variable, 'bench')
+
+from bench.corpus import tweets
+from bench.stand_ins import InMemoryRedis, NullWriter
+from util.metrics import metrics
+
+metrics._pid = os.getpid()
+
+SHAPES = {"records": lambda record: record, "dicts": lambda record: record.to_dict()}
+
+
+def fetcher():
+    from TwitterFetcher import TwitterFetcher
+    fetcher = TwitterFetcher(datetime.date(2018, 9, 30), 1000, 1, redis=InMemoryRedis())
+    fetcher.writer = NullWriter()
+    fetcher.topic = "messi"
+    return fetcher
+
+
+def measure(shape, corpus):
+    """
+    Memory of filtering a corpus keeping every tweet in a shape
+
+    @param shape: Function from the filtered TweetRecord to what is kept
+    @param corpus: List of raw tweets, consumed
+    @return: Dict with the retained bytes per tweet, the peak in bytes and the collections of each generation
+    """
+    filtering = fetcher()
+    # Warm up the caches and lazy tables outside of the measurement
+    filtering._filter_tweet(copy.deepcopy(corpus[0]))
+    # Only the kept tweets are measured, not the window of texts of the deduplicator or the results
+    filtering.dedup.window = 0
+    filtering._initialize_results = lambda tweet: None
+    gc.collect()
+    collections = [stats['collections'] for stats in gc.get_stats()]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [shape(filtering._filter_tweet(tweet)) for tweet in corpus]
+    del corpus[:]
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    collections = [stats['collections'] - previous for stats, previous in zip(gc.get_stats(), collections)]
+    return {"bytes_per_tweet": (retained - before) / len(kept), "peak_bytes": peak - before,
+            "collections": collections[:2]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=2000)
+    args = parser.parse_args()
+    from TwitterFetcher import TwitterFetcher
+    from models.sql_models import Base, get_engine
+    from util.geo import towns
+    Base.metadata.create_all(get_engine())
+    # Tables loaded once per process, before measuring
+    towns()
+    TwitterFetcher._get_location("Buenos Aires")
+    corpus = tweets(args.tweets)
+    report = {name: measure(shape, copy.deepcopy(corpus)) for name, shape in SHAPES.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Benchmarks of the hot paths of the fetcher and the API, over fixed synthetic corpora.
+Runs against SQLite and an in-memory Redis stand-in, from the repository root:
+
+    python -m bench.run                     compare with bench/baseline.json
+    python -m bench.run --save-baseline     store the current timings as the baseline
+
+Exits with status 1 when a benchmark is slower than the baseline by more than its threshold,
+also when measured again. Each run of a benchmark follows a run of a calibration workload and
+timings are compared relative to it, so changes in the speed of the machine cancel out.
+"""
+import os
+import sys
+import copy
+import json
+import re
+import time
+import sqlite3
+import argparse
+import statistics
+import datetime
+import platform
+
+# In memory, so commits do not measure the disk
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'bench')
+for variable in ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_TOKEN',
+                 'TWITTER_ACCESS_TOKEN_SECRET'):
+    os.environ.setdefault(variable, 'bench')
+
+from bench.corpus import tweets
+from bench.stand_ins import InMemoryRedis, NullWriter
+from util.metrics import metrics
+
+# Measurements still accumulate in memory, but no thread flushes them to Redis
+metrics._pid = os.getpid()
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+REPEAT = 15
+MIN_TIME = 0.1
+# Allowed slowdown of the paths whose timings vary the most between runs of the same tree:
+# the ones that go through SQLite, copy or allocate a lot. The others use --threshold
+THRESHOLDS = {
+    "dedup": 0.4,
+    "filter_tweet": 0.4,
+    "query_results": 0.4,
+    "threader_add": 0.4,
+    "threader_get_many": 0.4,
+    "topic_matcher": 0.4,
+}
+
+
+def timed(function, inputs):
+    """
+    Time per operation of function over fresh inputs, as many times as needed to last at
+    least MIN_TIME seconds
+
+    @param function: Function to measure, called with each input
+    @param inputs: Function returning a fresh list of inputs for each pass
+    @return: Seconds per operation
+    """
+    elapsed, operations = 0, 0
+    while elapsed < MIN_TIME:
+        items = inputs()
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed += time.perf_counter() - start
+        operations += len(items)
+    return elapsed / operations
+
+
+def measure(benchmark, reference):
+    """
+    Runs a benchmark REPEAT times, each right after a run of the calibration workload
+
+    @param benchmark: (function, inputs) to measure, see timed
+    @param reference: (function, inputs) of the calibration workload
+    @return: Median of the microseconds per operation and median of the ratios to the calibration
+    """
+    times, ratios = [], []
+    for _ in range(REPEAT):
+        reference_time = timed(*reference)
+        elapsed = timed(*benchmark)
+        times.append(elapsed)
+        ratios.append(elapsed / reference_time)
+    return statistics.median(times) * 1e6, statistics.median(ratios)
+
+
+def calibration():
+    """
+    Workload mixing what the benchmarks spend their time on, JSON, dicts, regular
+    expressions and SQLite queries, using only the standard library so it does not
+    change with the code being measured
+    """
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE results (topic_id INTEGER, day INTEGER, positive INTEGER)")
+    connection.executemany("INSERT INTO results VALUES (?, ?, ?)",
+                           [(topic, day, day) for topic in range(10) for day in range(30)])
+    words = re.compile(r'\w+')
+    document = {"id": 1, "text": "calibration de la copa america con messi " * 3,
+                "user": {"location": "Buenos Aires", "id": 2}}
+
+    def work(item):
+        loaded = json.loads(json.dumps(item))
+        loaded["words"] = words.findall(loaded["text"].lower())
+        connection.execute("SELECT day, positive FROM results WHERE topic_id = ? ORDER BY day",
+                           (loaded["id"],)).fetchall()
+    return work, lambda: [document] * 200
+
+
+def fetcher_benchmarks():
+    from TwitterFetcher import TwitterFetcher
+    from util.matcher import TopicMatcher
+    from util.dedup import Deduplicator
+    from util.geo import locate, towns
+    from models.sql_models import Base, get_engine
+
+    Base.metadata.create_all(get_engine())
+    # Loaded once per process, not part of what is measured
+    towns()
+    fetcher = TwitterFetcher(datetime.date(2018, 9, 30), 1000, 1, redis=InMemoryRedis())
+    fetcher.writer = NullWriter()
+    fetcher.topic = "messi"
+    corpus = tweets(2000)
+    filtered = [fetcher._filter_tweet(copy.deepcopy(tweet)) for tweet in corpus[:500]]
+    matcher = TopicMatcher('messi ("copa america" OR mundial OR barcelona) OR gol', "sorteo OR fake", ["es", "en"])
+    dedup = []
+
+    def fresh_dedup():
+        # Every pass starts with an empty window, otherwise all the texts are exact copies
+        dedup[:] = [Deduplicator(1, InMemoryRedis())]
+        return corpus
+    return {
+        "filter_tweet": (fetcher._filter_tweet, lambda: copy.deepcopy(corpus[:500])),
+        "get_location": (TwitterFetcher._get_location, lambda: [t["user"]["location"] for t in corpus]),
+        "get_source": (TwitterFetcher._get_source, lambda: [t["source"] for t in corpus]),
+        "initialize_results": (fetcher._initialize_results, lambda: filtered),
+        "topic_matcher": (matcher.matches, lambda: corpus),
+        "locate": (locate, lambda: corpus),
+        "dedup": (lambda tweet: dedup[0].cluster(tweet, tweet["text"]), fresh_dedup),
+    }
+
+
+def api_benchmarks():
+    import api
+    api.threader.redis = InMemoryRedis()
+    from models.models import db, User, Topic, GeneralResult, EvolutionResult, LocationResult, SourceResult
+
+    db.create_all()
+    user = User(name="bench", email="bench@example.com", password="bench")
+    db.session.add(user)
+    db.session.commit()
+    topic = Topic(user=user, name="messi", deadline=datetime.date(2018, 9, 30), language="es")
+    db.session.add(topic)
+    db.session.add(GeneralResult(topic=topic, positive=10, negative=5, neutral=3))
+    for day in range(30):
+        db.session.add(EvolutionResult(topic=topic, day=datetime.date(2018, 9, 1) + datetime.timedelta(days=day),
+                                       positive=day, negative=day, neutral=day))
+    for location in ("AR", "UY", "CL", "ES", "MX", "PE", "CO", "UN"):
+        db.session.add(LocationResult(topic=topic, location=location, positive=1, negative=1, neutral=1))
+    for source in ("Android", "iPhone", "Web Client", "TweetDeck"):
+        db.session.add(SourceResult(topic=topic, source=source, positive=1, negative=1, neutral=1))
+    db.session.commit()
+    _, token = api.generateToken(user)
+    headers = {'token': token}
+    return {
+        "query_results": (api.query_results, lambda: [topic.id] * 200),
+        "validate_token": (api.validate_token, lambda: [headers] * 2000),
+    }
+
+
+def threader_benchmarks():
+    from Threader import Threader
+
+    threader = Threader(InMemoryRedis())
+    threads = [(topic % 50, {"process": 1000 + topic, "worker": topic % 4,
+                             "topic": {"id": topic, "name": f"topic{topic}", "user_id": topic % 50}})
+               for topic in range(1000)]
+    for client, thread in threads:
+        threader.add_thread(client, thread)
+    topic_ids = [[topic for topic in range(start, start + 100)] for start in range(0, 1000, 100)]
+    return {
+        "threader_add": (lambda item: threader.add_thread(*item), lambda: threads),
+        "threader_get": (lambda item: threader.get_thread(item[0], item[1]["topic"]["id"]), lambda: threads),
+        "threader_get_many": (threader.get_threads_by_topics, lambda: topic_ids),
+        "threader_delete": (lambda item: threader.delete_thread(item[0], item[1]["topic"]["id"]), lambda: threads),
+    }
+
+
+def ratio(name, report, baseline):
+    """
+    Time of a benchmark relative to the baseline, None when the baseline does not have it
+    """
+    reference = baseline.get("relative", {}).get(name)
+    if reference:
+        return report["relative"][name] / reference
+    # Baselines stored before the calibration ran with every benchmark
+    reference = baseline.get("results", {}).get(name)
+    if reference:
+        return (report["results"][name] / report["calibration"]) / (reference / baseline["calibration"])
+    return None
+
+
+def compare(report, baseline, threshold):
+    regressions = []
+    for name, value in sorted(report["results"].items()):
+        slowdown = ratio(name, report, baseline)
+        status = ""
+        if slowdown is not None and slowdown > 1 + THRESHOLDS.get(name, threshold):
+            status = "REGRESSION"
+            regressions.append(name)
+        slowdown = f"{slowdown:.2f}x" if slowdown is not None else "-"
+        print(f"{name:<22} {value:>12.2f} us/op {slowdown:>8} {status}")
+    return regressions
+
+
+def run(benchmarks, reference, names, report):
+    for name in names:
+        report["results"][name], report["relative"][name] = measure(benchmarks[name], reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown of the benchmarks not in THRESHOLDS, 0.25 is 25%%")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline")
+    args = parser.parse_args()
+
+    reference = calibration()
+    benchmarks = {}
+    benchmarks.update(fetcher_benchmarks())
+    benchmarks.update(api_benchmarks())
+    benchmarks.update(threader_benchmarks())
+    report = {"python": platform.python_version(), "machine": platform.machine(),
+              "calibration": statistics.median(timed(*reference) for _ in range(REPEAT)) * 1e6,
+              "results": {}, "relative": {}}
+    run(benchmarks, reference, benchmarks, report)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)
+    regressions = compare(report, baseline, args.threshold)
+    if regressions:
+        # A regression has to show up twice, a burst of load on the machine rarely lasts that long
+        print(f"Measuring again: {', '.join(regressions)}")
+        first = {name: (report["results"][name], report["relative"][name]) for name in regressions}
+        run(benchmarks, reference, regressions, report)
+        for name in regressions:
+            if first[name][1] < report["relative"][name]:
+                report["results"][name], report["relative"][name] = first[name]
+        regressions = compare({**report, "results": {name: report["results"][name] for name in regressions}},
+                              baseline, args.threshold)
+    with open(args.baseline if args.save_baseline else args.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    if regressions:
+        print(f"Slower than the baseline by more than the threshold: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
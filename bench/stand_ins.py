@@ -0,0 +1,126 @@
+from collections import defaultdict
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class InMemoryRedis:
+    """
+    Stand-in for the subset of Redis used by Threader and TwitterFetcher, so the
+    benchmarks measure our code instead of the network
+    """
+
+    def __init__(self):
+        self.hashes = defaultdict(dict)
+        self.sorted_sets = defaultdict(dict)
+        self.published = 0
+
+    def publish(self, channel, message):
+        self.published += 1
+        return 0
+
+    def hset(self, key, field, value):
+        self.hashes[key][_bytes(field)] = _bytes(value)
+        return self
+
+    def hincrby(self, key, field, amount=1):
+        value = int(self.hashes[key].get(_bytes(field), 0)) + amount
+        self.hashes[key][_bytes(field)] = _bytes(value)
+        return value
+
+    def hmset(self, key, mapping):
+        for field, value in mapping.items():
+            self.hset(key, field, value)
+        return True
+
+    def expire(self, key, seconds):
+        return True
+
+    def pexpire(self, key, milliseconds):
+        return True
+
+    def hget(self, key, field):
+        return self.hashes[key].get(_bytes(field))
+
+    def hmget(self, key, fields):
+        return [self.hashes[key].get(_bytes(field)) for field in fields]
+
+    def hdel(self, key, *fields):
+        return sum(self.hashes[key].pop(_bytes(field), None) is not None for field in fields)
+
+    def hgetall(self, key):
+        return dict(self.hashes[key])
+
+    def hvals(self, key):
+        return list(self.hashes[key].values())
+
+    def hkeys(self, key):
+        return list(self.hashes[key].keys())
+
+    def execute_command(self, command, *args):
+        if command == 'ZINCRBY':
+            key, amount, member = args
+            members = self.sorted_sets[key]
+            members[_bytes(member)] = members.get(_bytes(member), 0) + float(amount)
+            return members[_bytes(member)]
+        raise NotImplementedError(command)
+
+    def zrevrange(self, key, start, end, withscores=False):
+        ranked = sorted(self.sorted_sets[key].items(), key=lambda item: (-item[1], item[0]))
+        ranked = ranked[start:None if end == -1 else end + 1]
+        return ranked if withscores else [member for member, _ in ranked]
+
+    def zremrangebyrank(self, key, start, end):
+        ranked = sorted(self.sorted_sets[key].items(), key=lambda item: (item[1], item[0]))
+        removed = ranked[start:None if end == -1 else end + 1]
+        for member, _ in removed:
+            del self.sorted_sets[key][member]
+        return len(removed)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.sorted_sets.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+    def register_script(self, script):
+        # Scripts are the rate limiter, which never makes the benchmarks wait
+        return lambda keys=None, args=None: 0
+
+
+class InMemoryPipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class NullWriter:
+    """
+    Stand-in for the tweet writer, the COPY path needs PostgreSQL
+    """
+
+    def add(self, tweet):
+        pass
+
+    def pending(self):
+        return 0
+
+    def flush(self):
+        pass
@@ -0,0 +1,67 @@
+"""
+Cold import time and memory of the entry points, each measured in a fresh interpreter:
+
+    python -m bench.startup                 api, FetcherPool and TwitterFetcher
+    python -m bench.startup api             only some modules
+
+Reports the wall time of the import, the peak RSS of the process and the heavy
+third party packages the import pulled in.
+"""
+import os
+import sys
+import json
+import subprocess
+
+MODULES = ("api", "FetcherPool", "TwitterFetcher")
+HEAVY = ("tweepy", "twitter", "geotext", "botometer", "flask_sqlalchemy", "flask_oauthlib", "passlib")
+REPEAT = 5
+
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{"seconds": elapsed, "rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "heavy": heavy}}))
+"""
+
+
+def environment():
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    env.setdefault('SECRET_KEY', 'bench')
+    for variable in ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET', 'TWITTER_ACCESS_TOKEN',
+                     'TWITTER_ACCESS_TOKEN_SECRET'):
+        env.setdefault(variable, 'bench')
+    return env
+
+
+def measure(module):
+    """
+    Median import time and RSS of a module over REPEAT fresh interpreters
+
+    @param module: Name of the module to import
+    @return: Dict with seconds, rss_kib and the heavy packages loaded
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    runs = []
+    for _ in range(REPEAT):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)], cwd=root,
+                                env=environment(), stdout=subprocess.PIPE, check=True).stdout
+        runs.append(json.loads(output.decode().splitlines()[-1]))
+    runs.sort(key=lambda run: run["seconds"])
+    median = runs[len(runs) // 2]
+    median["rss_kib"] = sorted(run["rss_kib"] for run in runs)[len(runs) // 2]
+    return median
+
+
+def main():
+    for module in sys.argv[1:] or MODULES:
+        result = measure(module)
+        print(f"{module:<16} {result['seconds'] * 1000:>8.1f} ms {result['rss_kib'] / 1024:>8.1f} MiB  "
+              f"{', '.join(result['heavy']) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
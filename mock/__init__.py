@@ -0,0 +1,5 @@
+"""
+Stand-ins for external services, to run the whole pipeline locally. From the repository root:
+
+    python -m mock.twitter_server --tls-port 8443      Twitter stream and search APIs
+"""
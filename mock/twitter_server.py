@@ -0,0 +1,436 @@
+"""
+Local stand-in for the endpoints of the Twitter API used by the fetchers, to load
+test the whole pipeline without hitting Twitter:
+
+* POST /1.1/statuses/filter.json: chunked stream of generated tweets matching the
+  tracked phrases, at a configurable rate with periodic bursts, limit notices,
+  keep-alive newlines, disconnect messages and failed connections
+* GET /1.1/search/tweets.json: pages of older tweets with next_results, honouring
+  max_id and since_id, with the rate limit headers and 429s of the real one
+* GET /stats: counters of what was served
+
+Tweepy always connects to the stream with https, so the stream needs --tls-port.
+Without --cert a self-signed certificate for localhost is made with openssl.
+
+Usage: python -m mock.twitter_server --port 8080 --tls-port 8443 --rate 200
+"""
+import os
+import ssl
+import json
+import time
+import random
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+from bench.corpus import LOCATIONS, SOURCES, WORDS
+
+STREAM_PATH = '/1.1/statuses/filter.json'
+SEARCH_PATH = '/1.1/search/tweets.json'
+STATS_PATH = '/stats'
+# Epoch of Twitter's snowflake ids, in ms
+TWEPOCH = 1288834974657
+TICK = 0.02
+
+
+def snowflake(ms, sequence=0):
+    return ((int(ms) - TWEPOCH) << 22) | sequence
+
+
+def snowflake_ms(tweet_id):
+    return (tweet_id >> 22) + TWEPOCH
+
+
+class Scenario:
+    """
+    What the server sends. Rates are tweets per second; periods are in seconds and 0
+    turns the behaviour off
+    """
+
+    def __init__(self, rate=50, burst_every=0, burst_seconds=5, burst_factor=10, limit_every=0,
+                 keepalive=30, disconnect_after=0, error_status=420, error_rate=0, search_spacing=1,
+                 search_history=3600, search_limit=180, search_window=900, seed=None):
+        self.rate = rate
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.burst_factor = burst_factor
+        self.limit_every = limit_every
+        self.keepalive = keepalive
+        self.disconnect_after = disconnect_after
+        self.error_status = error_status
+        self.error_rate = error_rate
+        self.search_spacing = search_spacing
+        self.search_history = search_history
+        self.search_limit = search_limit
+        self.search_window = search_window
+        self.random = random.Random(seed)
+
+    def rate_at(self, elapsed):
+        if self.burst_every and elapsed % self.burst_every < self.burst_seconds:
+            return self.rate * self.burst_factor
+        return self.rate
+
+
+class MockTwitter:
+    """
+    State shared by the http and https listeners
+    """
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.started_at = time.time()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "active": 0, "rejected": 0, "tweets": 0, "limit_notices": 0,
+                      "disconnects": 0, "searches": 0, "throttled": 0}
+        self._last_ms = 0
+        self._sequence = 0
+        self._window_start = 0
+        self._window_calls = 0
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def next_id(self):
+        # Stream ids use sequences from 1, the grid of search tweets uses 0
+        with self.lock:
+            ms = int(time.time() * 1000)
+            if ms == self._last_ms:
+                self._sequence += 1
+            else:
+                self._last_ms, self._sequence = ms, 1
+            return snowflake(ms, self._sequence)
+
+    def take_search(self, now):
+        """
+        Counts a search call in the current window
+
+        @param self:
+        @param now: Current timestamp
+        @return: Tuple of whether the call is allowed, calls remaining and reset timestamp
+        """
+        scenario = self.scenario
+        with self.lock:
+            if now >= self._window_start + scenario.search_window:
+                self._window_start, self._window_calls = now, 0
+            reset = int(self._window_start + scenario.search_window)
+            if scenario.search_limit and self._window_calls >= scenario.search_limit:
+                return False, 0, reset
+            self._window_calls += 1
+            return True, max(scenario.search_limit - self._window_calls, 0), reset
+
+    def stop(self):
+        self.stopping.set()
+
+
+def phrases(track):
+    return [phrase.strip() for phrase in track.split(',') if phrase.strip()]
+
+
+def query_phrases(query):
+    # Inverse of util.matcher.search_query
+    return [phrase.strip().strip('()') for phrase in query.split(' OR ') if phrase.strip()]
+
+
+def make_tweet(tweet_id, track, lang, rng):
+    """
+    Tweet shaped like the ones of the API, with the text containing one of the tracked phrases
+
+    @param tweet_id: Id of the tweet, its time is taken from it
+    @param track: List of tracked phrases
+    @param lang: Language of the tweet
+    @param rng: Random generator
+    @return: Tweet dict
+    """
+    ms = snowflake_ms(tweet_id)
+    created_at = datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 20))]
+    if track:
+        words.insert(rng.randint(0, len(words)), rng.choice(track))
+    user_id = rng.randint(1, 10 ** 9)
+    source = rng.choice(SOURCES)
+    return {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "created_at": created_at.strftime("%a %b %d %X %z %Y"),
+        "timestamp_ms": str(ms),
+        "text": " ".join(words),
+        "lang": lang,
+        "geo": None,
+        "coordinates": None,
+        "place": None,
+        "source": f'<a href="http://example.com" rel="nofollow">{source}</a>',
+        "user": {"id": user_id, "id_str": str(user_id), "name": f"user{user_id}", "screen_name": f"user{user_id}",
+                 "location": rng.choice(LOCATIONS), "followers_count": rng.randint(0, 10000)},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == SEARCH_PATH:
+            self._search(dict(parse_qsl(url.query)))
+        elif url.path == STATS_PATH:
+            self._json(200, self.server.twitter.stats)
+        else:
+            self._json(404, {"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        if url.path == STREAM_PATH:
+            self._stream(form, dict(parse_qsl(url.query)).get("delimited") == "length")
+        else:
+            self._json(404, {"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]})
+
+    def _json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _search(self, params):
+        """
+        Pages back in time over a grid of one tweet every search_spacing seconds,
+        from now to search_history seconds before the server started
+
+        @param self:
+        @param params: Query parameters of the request
+        @return: None
+        """
+        twitter = self.server.twitter
+        scenario = twitter.scenario
+        now = time.time()
+        allowed, remaining, reset = twitter.take_search(now)
+        headers = {"x-rate-limit-limit": str(scenario.search_limit), "x-rate-limit-reset": str(reset),
+                   "x-rate-limit-remaining": str(remaining)}
+        if not allowed:
+            twitter.count("throttled")
+            self._json(429, {"errors": [{"code": 88, "message": "Rate limit exceeded"}]}, headers)
+            return
+        twitter.count("searches")
+        track = query_phrases(params.get("q", ""))
+        count = min(int(params.get("count", 15)), 100)
+        spacing = int(scenario.search_spacing * 1000)
+        newest = int(now * 1000)
+        if "max_id" in params:
+            newest = min(newest, snowflake_ms(int(params["max_id"])))
+        oldest = int((twitter.started_at - scenario.search_history) * 1000)
+        if "since_id" in params:
+            oldest = max(oldest, snowflake_ms(int(params["since_id"])) + 1)
+        statuses = []
+        ms = newest // spacing * spacing
+        while ms >= oldest and len(statuses) < count:
+            tweet_id = snowflake(ms)
+            statuses.append(make_tweet(tweet_id, track, params.get("lang", "es"), random.Random(tweet_id)))
+            ms -= spacing
+        metadata = {"count": count, "query": params.get("q", "")}
+        if "since_id" in params:
+            metadata["since_id"] = int(params["since_id"])
+        if statuses and ms >= oldest:
+            next_params = {"max_id": statuses[-1]["id"] - 1, "q": params.get("q", ""), "count": count,
+                           "include_entities": 1}
+            for key in ("lang", "since_id"):
+                if key in params:
+                    next_params[key] = params[key]
+            metadata["next_results"] = "?" + urlencode(next_params)
+        self._json(200, {"statuses": statuses, "search_metadata": metadata}, headers)
+
+    def _stream(self, form, delimited):
+        """
+        Sends tweets until the client leaves, the server stops or the connection
+        reaches disconnect_after seconds
+
+        @param self:
+        @param form: Body of the request, with track and language
+        @param delimited: Whether each message is preceded by its length
+        @return: None
+        """
+        twitter = self.server.twitter
+        scenario = twitter.scenario
+        twitter.count("connections")
+        if scenario.error_rate and scenario.random.random() < scenario.error_rate:
+            twitter.count("rejected")
+            self._json(scenario.error_status, {"errors": [{"message": "Exceeded connection limit for user"}]})
+            return
+        track = phrases(form.get("track", ""))
+        languages = phrases(form.get("language", "")) or ["es"]
+        rng = random.Random(scenario.random.random())
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        twitter.count("active")
+        start = last_tick = last_write = time.time()
+        next_limit = start + scenario.limit_every
+        due = skipped = 0
+        try:
+            while not twitter.stopping.is_set():
+                now = time.time()
+                elapsed = now - start
+                messages = []
+                if scenario.disconnect_after and elapsed >= scenario.disconnect_after:
+                    twitter.count("disconnects")
+                    messages.append({"disconnect": {"code": 7, "stream_name": "mock",
+                                                    "reason": "Stream disconnected by the mock server"}})
+                    self._send(messages, delimited)
+                    break
+                due += scenario.rate_at(elapsed) * (now - last_tick)
+                last_tick = now
+                while due >= 1:
+                    due -= 1
+                    messages.append(make_tweet(twitter.next_id(), track, rng.choice(languages), rng))
+                if scenario.limit_every and now >= next_limit:
+                    next_limit += scenario.limit_every
+                    skipped += rng.randint(1, max(1, int(scenario.rate_at(elapsed))))
+                    messages.append({"limit": {"track": skipped, "timestamp_ms": str(int(now * 1000))}})
+                if messages:
+                    self._send(messages, delimited)
+                    last_write = now
+                elif now - last_write >= scenario.keepalive:
+                    self._chunk(b"\r\n")
+                    last_write = now
+                twitter.stopping.wait(TICK)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError, ssl.SSLError):
+            pass
+        finally:
+            twitter.count("active", -1)
+            self.close_connection = True
+
+    def _send(self, messages, delimited):
+        twitter = self.server.twitter
+        data = []
+        for message in messages:
+            body = (json.dumps(message) + "\r\n").encode()
+            data.append(f"{len(body)}\r\n".encode() + body if delimited else body)
+            if "limit" in message:
+                twitter.count("limit_notices")
+            elif "id" in message:
+                twitter.count("tweets")
+        self._chunk(b"".join(data))
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, twitter, address, context=None):
+        super().__init__(address, Handler)
+        self.twitter = twitter
+        if context is not None:
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+def self_signed(directory):
+    """
+    Makes a certificate for localhost with openssl, to use as TWITTER_STREAM_VERIFY
+
+    @param directory: Where to write cert.pem and key.pem
+    @return: Tuple of paths of the certificate and the key
+    """
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30", "-subj",
+                    "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1", "-keyout", key,
+                    "-out", cert], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def start(scenario, host="127.0.0.1", port=0, tls_port=None, cert=None, key=None):
+    """
+    Starts the listeners in daemon threads
+
+    @param scenario: Scenario to serve
+    @param host: Address to listen on
+    @param port: Port for http, None to skip it, 0 for any free one
+    @param tls_port: Port for https, None to skip it, 0 for any free one
+    @param cert: Certificate for https
+    @param key: Key of the certificate
+    @return: Tuple of the shared MockTwitter and the list of servers
+    """
+    twitter = MockTwitter(scenario)
+    servers = []
+    if port is not None:
+        servers.append(Server(twitter, (host, port)))
+    if tls_port is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        servers.append(Server(twitter, (host, tls_port), context))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return twitter, servers
+
+
+def stop(twitter, servers):
+    twitter.stop()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Twitter stream and search APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="Port for http (search and stats)")
+    parser.add_argument("--tls-port", type=int, help="Port for https (stream, search and stats)")
+    parser.add_argument("--cert", help="Certificate for https, a self-signed one is made if missing")
+    parser.add_argument("--key", help="Key of the certificate")
+    parser.add_argument("--rate", type=float, default=50, help="Tweets per second of each stream")
+    parser.add_argument("--burst-every", type=float, default=0, help="Seconds between bursts")
+    parser.add_argument("--burst-seconds", type=float, default=5, help="Length of each burst")
+    parser.add_argument("--burst-factor", type=float, default=10, help="Rate multiplier during bursts")
+    parser.add_argument("--limit-every", type=float, default=0, help="Seconds between limit notices")
+    parser.add_argument("--keepalive", type=float, default=30, help="Idle seconds before a keep-alive newline")
+    parser.add_argument("--disconnect-after", type=float, default=0, help="Seconds before closing each stream")
+    parser.add_argument("--error-status", type=int, default=420, help="Status of rejected connections")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of stream connections rejected")
+    parser.add_argument("--search-spacing", type=float, default=1, help="Seconds between searchable tweets")
+    parser.add_argument("--search-history", type=float, default=3600, help="Seconds of searchable tweets")
+    parser.add_argument("--search-limit", type=int, default=180, help="Searches per window, 0 for no limit")
+    parser.add_argument("--search-window", type=float, default=900, help="Seconds of the search rate limit window")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    cert, key = args.cert, args.key
+    if args.tls_port is not None and cert is None:
+        cert, key = self_signed(tempfile.mkdtemp(prefix="mock-twitter-"))
+        print(f"Self-signed certificate: {cert}")
+    scenario = Scenario(rate=args.rate, burst_every=args.burst_every, burst_seconds=args.burst_seconds,
+                        burst_factor=args.burst_factor, limit_every=args.limit_every, keepalive=args.keepalive,
+                        disconnect_after=args.disconnect_after, error_status=args.error_status,
+                        error_rate=args.error_rate, search_spacing=args.search_spacing,
+                        search_history=args.search_history, search_limit=args.search_limit,
+                        search_window=args.search_window, seed=args.seed)
+    twitter, servers = start(scenario, args.host, args.port, args.tls_port, cert, key)
+    for server in servers:
+        print(f"Listening on {server.server_address[0]}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(twitter.stats))
+    except KeyboardInterrupt:
+        stop(twitter, servers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,39 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 from settings import app
-from passlib.hash import bcrypt
+from util.hashing import hasher
+from util.geo import SEPARATOR
 
 import datetime
 
 db = SQLAlchemy(app)
 
 
+def add_missing_columns(engine=None):
+    """
+    Adds the nullable columns of the models that tables created by older versions lack,
+    create_all only creates the missing tables
+
+    @param engine: Engine of the database, the one of db by default
+    @return: List of the columns added, as table.column
+    """
+    engine = engine or db.engine
+    existing = set(inspect(engine).get_table_names())
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {column['name'] for column in inspect(conn).get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns or not column.nullable:
+                    continue
+                conn.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                             f'{column.type.compile(dialect=engine.dialect)}')
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
 class User(db.Model):
     __tablename__ = "users"
 
@@ -18,7 +45,7 @@ class User(db.Model):
 
     def __init__(self, name, password, email):
         self.name = name
-        self.password = bcrypt.encrypt(password)
+        self.password = hasher.hash(password)
         self.email = email
 
     @staticmethod
@@ -33,9 +60,21 @@ class User(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    def set_password(self, password):
+        self.password = hasher.hash(password)
+        db.session.add(self)
+        db.session.commit()
+
     @staticmethod
     def validate_password(user, password):
-        return bcrypt.verify(password, user.password)
+        """
+        Checks a password, rehashing it when the configured bcrypt cost changed
+        """
+        if not hasher.verify(password, user.password):
+            return False
+        if hasher.needs_rehash(user.password):
+            user.set_password(password)
+        return True
 
     topics = db.relationship("Topic", back_populates="user", cascade="all,delete")
 
@@ -50,7 +89,14 @@ class Topic(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     name = db.Column(db.String)
     deadline = db.Column(db.Date)
+    deadline_at = db.Column(db.DateTime)
     language = db.Column(db.String)
+    # Comma separated, as the track and languages parameters of the Twitter Stream
+    terms = db.Column(db.Text)
+    languages = db.Column(db.String)
+    # Boolean expressions evaluated by util.matcher.TopicMatcher
+    include = db.Column(db.Text)
+    exclude = db.Column(db.Text)
 
     user = db.relationship("User", back_populates="topics")
     general_result = db.relationship("GeneralResult", uselist=False, backref="topic", cascade="all,delete")
@@ -63,15 +109,22 @@ class Topic(db.Model):
                f"owner='{self.user_id}', language='{self.language})>"
 
     @staticmethod
-    def create(user_id, name, deadline, lang):
-        topic = Topic(user_id=user_id, name=name, deadline=deadline, language=lang)
+    def create(user_id, name, deadline, lang, deadline_at=None, terms=None, languages=None, include=None,
+               exclude=None):
+        topic = Topic(user_id=user_id, name=name, deadline=deadline, deadline_at=deadline_at, language=lang,
+                      terms=','.join(terms) if terms else None, languages=','.join(languages) if languages else None,
+                      include=include, exclude=exclude)
         db.session.add(topic)
         db.session.commit()
         return topic
 
     def to_dict(self):
         return {'id': self.id, 'name': self.name, 'user_id': self.user_id,
-                'deadline': self.deadline.strftime('%d-%m-%Y'), 'language': self.language}
+                'deadline': self.deadline.strftime('%d-%m-%Y'), 'language': self.language,
+                'deadline_at': self.deadline_at.strftime('%d-%m-%Y %H:%M') if self.deadline_at else None,
+                'terms': self.terms.split(',') if self.terms else [self.name],
+                'languages': self.languages.split(',') if self.languages else [self.language],
+                'include': self.include, 'exclude': self.exclude}
 
 
 class GeneralResult(db.Model):
@@ -176,6 +229,30 @@ class LocationResult(db.Model):
             .all()
         return len(results) > 0
 
+    @staticmethod
+    def countries():
+        """
+        Location results of whole countries, the others are the provinces and cities under them
+        """
+        return LocationResult.query.filter(~LocationResult.location.contains(SEPARATOR))
+
+    @staticmethod
+    def children(topic_id, parent):
+        """
+        Location results one level under another, like the provinces of 'AR' or the cities of 'AR/Cordoba'
+
+        @param topic_id: Id of the topic
+        @param parent: Key of the location result to drill down
+        @return: List of location results
+        """
+        prefix = parent + SEPARATOR
+        results = LocationResult.query \
+            .filter(LocationResult.topic_id == topic_id) \
+            .filter(LocationResult.location.startswith(prefix, autoescape=True)) \
+            .order_by(LocationResult.location) \
+            .all()
+        return [result for result in results if SEPARATOR not in result.location[len(prefix):]]
+
     def __repr__(self):
         return f"<LocationResult(topic='{self.topic}', positive='{self.positive}', " \
                f"negative='{self.negative}', neutral='{self.neutral}', location='{self.location}')>"
@@ -230,6 +307,29 @@ class SourceResult(db.Model):
         }
 
 
+# Partitioned by day and by topic, created by models.tweet_store.TweetStore and
+# written with COPY, so it is kept out of the metadata of db.create_all()
+tweets = db.Table(
+    "tweets", db.MetaData(),
+    db.Column("id", db.BigInteger, primary_key=True),
+    db.Column("topic_id", db.Integer, primary_key=True),
+    db.Column("created_at", db.DateTime(timezone=True), nullable=False),
+    db.Column("user_id", db.BigInteger),
+    db.Column("user_name", db.Text),
+    db.Column("text", db.Text),
+    db.Column("lang", db.Text),
+    db.Column("location", db.Text),
+    db.Column("source", db.Text),
+)
+
+
+class Tweet(db.Model):
+    __table__ = tweets
+
+    def __repr__(self):
+        return f"<Tweet(id='{self.id}', topic='{self.topic_id}', created_at='{self.created_at}')>"
+
+
 # OAuth Models
 
 
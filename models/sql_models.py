@@ -1,18 +1,61 @@
-from settings import POSTGRESQL_USER, POSTGRESQL_PORT, POSTGRESQL_PASSWORD, POSTGRESQL_HOST, POSTGRESQL_DB
+from settings import DATABASE_URL, SQL_ECHO, SQL_POOL_SIZE, SQL_MAX_OVERFLOW, SQL_POOL_RECYCLE, \
+    SQL_POOL_PRE_PING, SQL_STATEMENT_CACHE_SIZE
 from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean, Text, DateTime
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, bindparam
 from sqlalchemy.exc import NoSuchColumnError
-from passlib.hash import bcrypt
+from util.hashing import hasher
 
+import os
 import datetime
+import threading
 
 Base = declarative_base()
-engine = create_engine(f'postgresql+psycopg2://{POSTGRESQL_USER}:{POSTGRESQL_PASSWORD}@{POSTGRESQL_HOST}/{POSTGRESQL_DB}', echo=True)
-Session = sessionmaker(bind=engine)
-session = Session()
+Session = sessionmaker()
+bakery = baked.bakery(size=SQL_STATEMENT_CACHE_SIZE)
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+_inherited_engines = []
+
+
+def get_engine():
+    """
+    Returns the engine of the current process, creating it on first use. A forked
+    child gets its own engine and pool; the one inherited from the parent is kept
+    referenced, never used nor disposed, so the child doesn't close sockets the
+    parent is still using
+
+    @return: Engine of the current process
+    """
+    global _engine, _engine_pid
+    if _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engine_pid != os.getpid():
+                if _engine is not None:
+                    _inherited_engines.append(_engine)
+                _engine = _create_engine()
+                _engine_pid = os.getpid()
+    return _engine
+
+
+def _create_engine():
+    options = {'echo': SQL_ECHO, 'pool_pre_ping': SQL_POOL_PRE_PING}
+    if not DATABASE_URL.startswith('sqlite'):
+        options.update(pool_size=SQL_POOL_SIZE, max_overflow=SQL_MAX_OVERFLOW, pool_recycle=SQL_POOL_RECYCLE)
+    return create_engine(DATABASE_URL, **options)
+
+
+def _new_session():
+    return Session(bind=get_engine())
+
+
+# One session per process and thread, fetcher workers stream many topics on threads
+session = scoped_session(_new_session, scopefunc=lambda: (os.getpid(), threading.get_ident()))
 
 
 class User(Base):
@@ -26,7 +69,7 @@ class User(Base):
 
     def __init__(self, name, password, email):
         self.name = name
-        self.password = bcrypt.encrypt(password)
+        self.password = hasher.hash(password)
         self.email = email
 
     @staticmethod
@@ -41,9 +84,21 @@ class User(Base):
         session.add(self)
         session.commit()
 
+    def set_password(self, password):
+        self.password = hasher.hash(password)
+        session.add(self)
+        session.commit()
+
     @staticmethod
     def validate_password(user, password):
-        return bcrypt.verify(password, user.password)
+        """
+        Checks a password, rehashing it when the configured bcrypt cost changed
+        """
+        if not hasher.verify(password, user.password):
+            return False
+        if hasher.needs_rehash(user.password):
+            user.set_password(password)
+        return True
 
     topics = relationship("Topic", back_populates="user", cascade="all,delete")
 
@@ -58,7 +113,14 @@ class Topic(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     name = Column(String)
     deadline = Column(Date)
+    deadline_at = Column(DateTime)
     language = Column(String)
+    # Comma separated, as the track and languages parameters of the Twitter Stream
+    terms = Column(Text)
+    languages = Column(String)
+    # Boolean expressions evaluated by util.matcher.TopicMatcher
+    include = Column(Text)
+    exclude = Column(Text)
 
     user = relationship("User", back_populates="topics")
     general_result = relationship("GeneralResult", uselist=False, backref="topic", cascade="all,delete")
@@ -71,15 +133,22 @@ class Topic(Base):
                f"owner='{self.user_id}', language='{self.language})>"
 
     @staticmethod
-    def create(user_id, name, deadline, lang):
-        topic = Topic(user_id=user_id, name=name, deadline=deadline, language=lang)
+    def create(user_id, name, deadline, lang, deadline_at=None, terms=None, languages=None, include=None,
+               exclude=None):
+        topic = Topic(user_id=user_id, name=name, deadline=deadline, deadline_at=deadline_at, language=lang,
+                      terms=','.join(terms) if terms else None, languages=','.join(languages) if languages else None,
+                      include=include, exclude=exclude)
         session.add(topic)
         session.commit()
         return topic
 
     def to_dict(self):
         return {'id': self.id, 'name': self.name, 'user_id': self.user_id,
-                'deadline': self.deadline.strftime('%d-%m-%Y'), 'language': self.language}
+                'deadline': self.deadline.strftime('%d-%m-%Y'), 'language': self.language,
+                'deadline_at': self.deadline_at.strftime('%d-%m-%Y %H:%M') if self.deadline_at else None,
+                'terms': self.terms.split(',') if self.terms else [self.name],
+                'languages': self.languages.split(',') if self.languages else [self.language],
+                'include': self.include, 'exclude': self.exclude}
 
 
 class GeneralResult(Base):
@@ -100,10 +169,9 @@ class GeneralResult(Base):
     @staticmethod
     def is_in(topic_id):
         try:
-            results = session.query(GeneralResult) \
-                .filter(GeneralResult.topic_id == topic_id) \
-                .all()
-            return len(results) > 0
+            query = bakery(lambda s: s.query(GeneralResult.topic_id))
+            query += lambda q: q.filter(GeneralResult.topic_id == bindparam('topic_id'))
+            return query(session()).params(topic_id=topic_id).first() is not None
         except NoSuchColumnError:
             print(f"Error de columna: {topic_id}")
 
@@ -141,11 +209,11 @@ class EvolutionResult(Base):
 
     @staticmethod
     def is_in(topic_id, day):
-        results = session.query(EvolutionResult) \
-            .filter(EvolutionResult.topic_id == topic_id)\
-            .filter(EvolutionResult.day == datetime.datetime.strptime(day, "%a %b %d %X %z %Y").date())\
-            .all()
-        return len(results) > 0
+        query = bakery(lambda s: s.query(EvolutionResult.topic_id))
+        query += lambda q: q.filter(EvolutionResult.topic_id == bindparam('topic_id')) \
+            .filter(EvolutionResult.day == bindparam('day'))
+        day = datetime.datetime.strptime(day, "%a %b %d %X %z %Y").date()
+        return query(session()).params(topic_id=topic_id, day=day).first() is not None
 
     def __repr__(self):
         return f"<EvolutionResult(topic='{self.topic}', positive='{self.positive}', " \
@@ -181,11 +249,10 @@ class LocationResult(Base):
 
     @staticmethod
     def is_in(topic_id, location):
-        results = session.query(LocationResult) \
-            .filter(LocationResult.topic_id == topic_id) \
-            .filter(LocationResult.location == location) \
-            .all()
-        return len(results) > 0
+        query = bakery(lambda s: s.query(LocationResult.topic_id))
+        query += lambda q: q.filter(LocationResult.topic_id == bindparam('topic_id')) \
+            .filter(LocationResult.location == bindparam('location'))
+        return query(session()).params(topic_id=topic_id, location=location).first() is not None
 
     def __repr__(self):
         return f"<LocationResult(topic='{self.topic}', positive='{self.positive}', " \
@@ -221,11 +288,10 @@ class SourceResult(Base):
 
     @staticmethod
     def is_in(topic_id, source):
-        results = session.query(SourceResult) \
-            .filter(SourceResult.topic_id == topic_id) \
-            .filter(SourceResult.source == source) \
-            .all()
-        return len(results) > 0
+        query = bakery(lambda s: s.query(SourceResult.topic_id))
+        query += lambda q: q.filter(SourceResult.topic_id == bindparam('topic_id')) \
+            .filter(SourceResult.source == bindparam('source'))
+        return query(session()).params(topic_id=topic_id, source=source).first() is not None
 
     def __repr__(self):
         return f"<SourceResult(topic='{self.topic}', positive='{self.positive}', " \
@@ -0,0 +1,71 @@
+class TopicInfo:
+    """
+    Metadata of the topic of a fetcher, shared by every tweet it filters instead of copied into each
+    """
+    __slots__ = ('topic', 'topic_id', 'user_id')
+
+    def __init__(self, topic, topic_id, user_id):
+        self.topic = topic
+        self.topic_id = topic_id
+        self.user_id = user_id
+
+
+class TweetRecord:
+    """
+    Filtered tweet as it goes through the fetcher, the writer and the results. Only
+    turned into a dict, with the shape published to twitter:stream, by to_dict
+    """
+    __slots__ = ('id', 'created_at', 'text', 'lang', 'geo', 'coordinates', 'place', 'user_id', 'user_name',
+                 'user_location', 'location', 'location_keys', 'source', 'weight', 'cluster', 'copy', 'info')
+
+    def __init__(self, tweet, info, weight=1):
+        """
+        @param self:
+        @param tweet: Raw tweet object, with the full text already in its text
+        @param info: TopicInfo of the fetcher
+        @param weight: Amount of tweets this one stands for when the stream is being sampled
+        """
+        self.id = tweet["id"]
+        self.created_at = tweet["created_at"]
+        # Searched tweets only have full_text
+        self.text = tweet.get("text") or tweet.get("full_text")
+        self.lang = tweet.get("lang")
+        self.geo = tweet.get("geo")
+        self.coordinates = tweet.get("coordinates")
+        self.place = tweet.get("place")
+        user = tweet["user"]
+        self.user_id = user.get("id")
+        self.user_name = user.get("name")
+        self.user_location = user.get("location")
+        self.location = None
+        self.location_keys = None
+        self.source = None
+        self.weight = weight
+        self.cluster = None
+        self.copy = False
+        self.info = info
+
+    def to_dict(self, text=True):
+        """
+        Dict of the tweet to serialize
+
+        @param self:
+        @param text: Whether to include the text, copies of a cluster are published without it
+        @return: Dict with the fields of the tweet, its user, location and topic
+        """
+        info = self.info
+        return {
+            "id": self.id,
+            "created_at": self.created_at,
+            "text": self.text if text else None,
+            "lang": self.lang,
+            "geo": self.geo,
+            "coordinates": self.coordinates,
+            "place": self.place,
+            "user": {"id": self.user_id, "name": self.user_name, "location": self.user_location},
+            "CC": self.location.country,
+            "location": dict(self.location._asdict(), keys=self.location_keys),
+            "social": {"topic": info.topic, "topic_id": info.topic_id, "user_id": info.user_id,
+                       "weight": self.weight, "cluster": self.cluster, "copy": self.copy},
+            "source": self.source,
+        }
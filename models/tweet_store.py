@@ -0,0 +1,228 @@
+from settings import TWEET_FLUSH_SIZE, TWEET_FLUSH_INTERVAL, TWEET_RETENTION_DAYS, TWEET_TOPIC_PARTITIONS, app
+from models.sql_models import get_engine
+from util.metrics import metrics
+
+import io
+import os
+import csv
+import datetime
+import threading
+
+COLUMNS = ("id", "topic_id", "created_at", "user_id", "user_name", "text", "lang", "location", "source")
+
+
+def partition_name(day):
+    return f'tweets_{day.strftime("%Y%m%d")}'
+
+
+class TweetStore:
+    """
+    Raw tweets table, partitioned by day and, inside each day, by hash of the topic
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or get_engine()
+        self._partitions = set()
+
+    def create_schema(self):
+        with self.engine.begin() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tweets (
+                    id BIGINT NOT NULL,
+                    topic_id INTEGER NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL,
+                    user_id BIGINT,
+                    user_name TEXT,
+                    text TEXT,
+                    lang TEXT,
+                    location TEXT,
+                    source TEXT
+                ) PARTITION BY RANGE (created_at)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS tweets_topic_created_at ON tweets (topic_id, created_at)")
+
+    def ensure_partition(self, day):
+        """
+        Creates the partition of a day, split in TWEET_TOPIC_PARTITIONS by topic
+
+        @param self:
+        @param day: Date of the partition
+        @return: None
+        """
+        if day in self._partitions:
+            return
+        name = partition_name(day)
+        with self.engine.begin() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name} PARTITION OF tweets
+                FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + datetime.timedelta(days=1)).isoformat()}')
+                PARTITION BY HASH (topic_id)""")
+            for remainder in range(TWEET_TOPIC_PARTITIONS):
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {name}_{remainder} PARTITION OF {name}
+                    FOR VALUES WITH (MODULUS {TWEET_TOPIC_PARTITIONS}, REMAINDER {remainder})""")
+        self._partitions.add(day)
+
+    def partitions(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute("""
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                WHERE parent.relname = 'tweets'""")
+            return [datetime.datetime.strptime(row[0], 'tweets_%Y%m%d').date() for row in rows]
+
+    def drop_expired(self, retention_days=TWEET_RETENTION_DAYS):
+        """
+        Drops the day partitions older than the retention period
+
+        @param self:
+        @param retention_days: Amount of days of tweets to keep
+        @return: List of the dropped days
+        """
+        oldest = datetime.datetime.utcnow().date() - datetime.timedelta(days=retention_days)
+        dropped = [day for day in self.partitions() if day < oldest]
+        with self.engine.begin() as conn:
+            for day in dropped:
+                conn.execute(f"DROP TABLE IF EXISTS {partition_name(day)}")
+        self._partitions.difference_update(dropped)
+        return dropped
+
+    def copy(self, rows):
+        """
+        Writes rows with a single COPY FROM STDIN in CSV format
+
+        @param self:
+        @param rows: List of tuples with the values of COLUMNS
+        @return: None
+        """
+        for day in {row[2].date() for row in rows}:
+            self.ensure_partition(day)
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(f"COPY tweets ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", data)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def rejects(self, error):
+        """
+        Whether an error of copy was caused by the data of the rows, not by the database
+
+        @param self:
+        @param error: Exception raised by copy
+        @return: True for data and integrity errors of the driver
+        """
+        dbapi = self.engine.dialect.dbapi
+        return isinstance(error, (dbapi.DataError, dbapi.IntegrityError))
+
+
+class TweetWriter:
+    """
+    Buffers the tweets of every fetcher of a process and writes them in batches,
+    when TWEET_FLUSH_SIZE tweets are pending or every TWEET_FLUSH_INTERVAL seconds.
+    Batches that fail are retried on the next flush, unless the store rejected their
+    data: then the batch is split until the bad rows are found and dropped
+    """
+
+    def __init__(self, store=None, size=TWEET_FLUSH_SIZE, interval=TWEET_FLUSH_INTERVAL):
+        self.store = store or TweetStore()
+        self.size = size
+        self.interval = interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='tweet-writer', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def row(tweet):
+        created_at = datetime.datetime.strptime(tweet.created_at, "%a %b %d %X %z %Y")
+        # Text columns cannot hold NUL characters
+        return (tweet.id, tweet.info.topic_id, created_at, tweet.user_id, _strip_nul(tweet.user_name),
+                _strip_nul(tweet.text), tweet.lang, tweet.location.country, tweet.source)
+
+    def add(self, tweet):
+        with self._lock:
+            self._rows.append(self.row(tweet))
+            pending = len(self._rows)
+        metrics.gauge('fetcher_writer_queue_depth', pending)
+        if pending >= self.size:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._rows)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+            failed = self._write(rows)
+            if failed:
+                with self._lock:
+                    # Keep them for the next flush, up to ten batches
+                    self._rows = (failed + self._rows)[-self.size * 10:]
+
+    def _write(self, rows):
+        """
+        Copies rows to the store, splitting them in halves while the store rejects their
+        data, down to single rows that are dropped
+
+        @param self:
+        @param rows: List of rows
+        @return: List of the rows to retry, when the store failed for other reasons
+        """
+        try:
+            with metrics.time('fetcher_stage_seconds', stage='copy'):
+                self.store.copy(rows)
+            metrics.inc('fetcher_tweets_stored_total', len(rows))
+            return []
+        except Exception as e:
+            if not self.store.rejects(e):
+                app.logger.exception("Could not write %s tweets", len(rows))
+                return rows
+            if len(rows) == 1:
+                app.logger.error("Dropped tweet %s of topic %s, rejected by the store: %s", rows[0][0], rows[0][1], e)
+                metrics.inc('fetcher_tweets_dropped_total', topic=rows[0][1], reason='store')
+                return []
+        middle = len(rows) // 2
+        failed = self._write(rows[:middle])
+        if failed:
+            return failed + rows[middle:]
+        return self._write(rows[middle:])
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def _strip_nul(text):
+    return text.replace('\x00', '') if text else text
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Returns the tweet writer of the current process, creating it on first use
+
+    @return: TweetWriter of the current process
+    """
+    global _writer, _writer_pid
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _writer = TweetWriter()
+                _writer_pid = os.getpid()
+    return _writer
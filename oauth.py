@@ -1,6 +1,123 @@
 from flask_oauthlib.provider import OAuth2Provider
 from datetime import datetime, timedelta
+from redis import StrictRedis
+from sqlalchemy import event, or_
+from sqlalchemy.orm import object_session
 from models.models import Client, Token, Grant, User, db
+from settings import OAUTH_CACHE_SIZE, OAUTH_CACHE_TTL, OAUTH_CLEANUP_INTERVAL, OAUTH_CLEANUP_BATCH, \
+    OAUTH_REFRESH_TOKEN_DAYS, REDIS_HOST, REDIS_PORT
+from util.cache import TTLCache, SharedInvalidation
+
+clients = TTLCache(OAUTH_CACHE_SIZE, OAUTH_CACHE_TTL)
+tokens = TTLCache(OAUTH_CACHE_SIZE, OAUTH_CACHE_TTL)
+# Deleted and rotated tokens and changed clients are evicted from the caches of every API process
+invalidation = SharedInvalidation(StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0), 'oauth:invalidations',
+                                  {'clients': clients, 'tokens': tokens})
+# Deletions are published once the transaction that made them commits
+PENDING_DELETIONS = 'oauth_cache_deletions'
+_cleanup = {"next": datetime.utcnow()}
+
+
+def _cached(cache, key, query, ttl=None):
+    """
+    Returns the object cached under key or loads it with query. Cached objects are
+    kept detached and merged into the current session, so they can be shared
+    between requests and still lazy load their relationships
+
+    @param cache: TTLCache to look in
+    @param key: Key of the object in the cache
+    @param query: Function loading the object from the database
+    @param ttl: Function returning the time to live of a loaded object
+    @return: Object attached to the current session, None if it does not exist
+    """
+    usable = invalidation.usable()
+    obj = cache.get(key) if usable else None
+    if obj is None:
+        version = invalidation.version
+        obj = query()
+        if obj is None:
+            return None
+        db.session.expunge(obj)
+        # Not cached if it may have been deleted by another process while it was loaded
+        if usable and invalidation.version == version:
+            cache.set(key, obj, ttl(obj) if ttl else None)
+    return db.session.merge(obj, load=False)
+
+
+def _token_ttl(token):
+    if token.expires is None:
+        return None
+    return (token.expires - datetime.utcnow()).total_seconds()
+
+
+def _invalidate(session, name, key):
+    """
+    Deletes a key from the cache of this process now and from the ones of every process
+    when the session commits
+    """
+    invalidation.caches[name].delete(key)
+    session.info.setdefault(PENDING_DELETIONS, []).append((name, key))
+
+
+def invalidate_token(token, session=None):
+    session = session or object_session(token) or db.session
+    _invalidate(session, 'tokens', ('access', token.access_token))
+    _invalidate(session, 'tokens', ('refresh', token.refresh_token))
+
+
+@event.listens_for(Token, 'after_delete')
+def _token_deleted(mapper, connection, token):
+    invalidate_token(token)
+
+
+@event.listens_for(Client, 'after_delete')
+@event.listens_for(Client, 'after_update')
+def _client_changed(mapper, connection, client):
+    _invalidate(object_session(client) or db.session, 'clients', client.client_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_deletions(session):
+    deletions = session.info.pop(PENDING_DELETIONS, None)
+    if deletions:
+        invalidation.publish(deletions)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_deletions(session):
+    session.info.pop(PENDING_DELETIONS, None)
+
+
+def cleanup_expired(batch_size=OAUTH_CLEANUP_BATCH):
+    """
+    Deletes expired grants and tokens in batches. Tokens are kept while their refresh
+    token may still be used
+
+    @param batch_size: Maximum amount of rows deleted per statement
+    @return: Amount of deleted rows
+    """
+    now = datetime.utcnow()
+    stale_tokens = or_(Token.refresh_token.is_(None),
+                       Token.expires < now - timedelta(days=OAUTH_REFRESH_TOKEN_DAYS))
+    deleted = 0
+    for model, condition in ((Grant, Grant.expires < now), (Token, (Token.expires < now) & stale_tokens)):
+        while True:
+            ids = db.session.query(model.id).filter(condition).limit(batch_size).subquery()
+            count = model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += count
+            if count < batch_size:
+                break
+    if deleted:
+        invalidation.publish([('tokens', None)])
+    return deleted
+
+
+def _maybe_cleanup():
+    if datetime.utcnow() < _cleanup["next"]:
+        return
+    _cleanup["next"] = datetime.utcnow() + timedelta(seconds=OAUTH_CLEANUP_INTERVAL)
+    cleanup_expired()
 
 
 def default_provider(app):
@@ -8,7 +125,7 @@ def default_provider(app):
 
     @oauth.clientgetter
     def get_client(client_id):
-        return Client.query.filter_by(client_id=client_id).first()
+        return _cached(clients, client_id, lambda: Client.query.filter_by(client_id=client_id).first())
 
     @oauth.grantgetter
     def get_grant(client_id, code):
@@ -17,9 +134,11 @@ def default_provider(app):
     @oauth.tokengetter
     def get_token(access_token=None, refresh_token=None):
         if access_token:
-            return Token.query.filter_by(access_token=access_token).first()
+            return _cached(tokens, ('access', access_token),
+                           lambda: Token.query.filter_by(access_token=access_token).first(), _token_ttl)
         if refresh_token:
-            return Token.query.filter_by(refresh_token=refresh_token).first()
+            return _cached(tokens, ('refresh', refresh_token),
+                           lambda: Token.query.filter_by(refresh_token=refresh_token).first())
         return None
 
     @oauth.grantsetter
@@ -35,16 +154,24 @@ def default_provider(app):
         )
         db.session.add(grant)
         db.session.commit()
+        _maybe_cleanup()
 
     @oauth.tokensetter
     def set_token(token, request, *args, **kwargs):
-        # In real project, a token is unique bound to user and client.
-        # Which means, you don't need to create a token every time.
-        tok = Token(**token)
-        tok.user_id = request.user.id
-        tok.client_id = request.client.client_id
+        # A token is unique bound to user and client, so it is renewed in place
+        tok = Token.query.filter_by(user_id=request.user.id, client_id=request.client.client_id).first()
+        if tok is None:
+            tok = Token(user_id=request.user.id, client_id=request.client.client_id)
+        else:
+            invalidate_token(tok)
+        tok.access_token = token['access_token']
+        tok.refresh_token = token.get('refresh_token', tok.refresh_token)
+        tok.token_type = token['token_type']
+        tok._scopes = token['scope']
+        tok.expires = datetime.utcnow() + timedelta(seconds=token['expires_in'])
         db.session.add(tok)
         db.session.commit()
+        _maybe_cleanup()
 
     @oauth.usergetter
     def get_user(username, password, *args, **kwargs):
@@ -3,6 +3,7 @@ from pathlib import Path
 from flask import Flask
 
 import os
+import socket
 
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
@@ -11,6 +12,14 @@ CONSUMER_KEY = os.getenv("TWITTER_CONSUMER_KEY")
 CONSUMER_SECRET = os.getenv("TWITTER_CONSUMER_SECRET")
 ACCESS_TOKEN = os.getenv("TWITTER_ACCESS_TOKEN")
 ACCESS_TOKEN_SECRET = os.getenv("TWITTER_ACCESS_TOKEN_SECRET")
+# Point the fetchers to a stand-in like mock/twitter_server.py instead of Twitter
+TWITTER_STREAM_HOST = os.getenv("TWITTER_STREAM_HOST", "stream.twitter.com")
+TWITTER_API_HOST = os.getenv("TWITTER_API_HOST", "api.twitter.com")
+TWITTER_API_SECURE = os.getenv("TWITTER_API_SECURE", "true").lower() == "true"
+# true, false or the path of a CA bundle to check the certificate of the stream host
+TWITTER_STREAM_VERIFY = os.getenv("TWITTER_STREAM_VERIFY", "true")
+if TWITTER_STREAM_VERIFY.lower() in ("true", "false"):
+    TWITTER_STREAM_VERIFY = TWITTER_STREAM_VERIFY.lower() == "true"
 
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
@@ -20,15 +29,110 @@ POSTGRESQL_PORT = os.getenv("POSTGRESQL_PORT")
 POSTGRESQL_USER = os.getenv("POSTGRESQL_USER")
 POSTGRESQL_PASSWORD = os.getenv("POSTGRESQL_PASSWORD")
 POSTGRESQL_DB = os.getenv("POSTGRESQL_DB")
+DATABASE_URL = os.getenv("DATABASE_URL") or \
+    f'postgresql+psycopg2://{POSTGRESQL_USER}:{POSTGRESQL_PASSWORD}@{POSTGRESQL_HOST}/{POSTGRESQL_DB}'
+
+SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() == "true"
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", 5))
+SQL_MAX_OVERFLOW = int(os.getenv("SQL_MAX_OVERFLOW", 10))
+SQL_POOL_RECYCLE = int(os.getenv("SQL_POOL_RECYCLE", 1800))
+SQL_POOL_PRE_PING = os.getenv("SQL_POOL_PRE_PING", "true").lower() == "true"
+SQL_STATEMENT_CACHE_SIZE = int(os.getenv("SQL_STATEMENT_CACHE_SIZE", 200))
 
 MASHAPE_KEY = os.getenv("MASHAPE_TEST_KEY")
 
+TOPICS_PAGE_SIZE = int(os.getenv("TOPICS_PAGE_SIZE", 100))
+TOPICS_MAX_PAGE_SIZE = int(os.getenv("TOPICS_MAX_PAGE_SIZE", 500))
+RESULTS_MAX_TOPICS = int(os.getenv("RESULTS_MAX_TOPICS", 50))
+
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+# /api/metrics answers 404 unless a token is set, and then only to requests with it in the token header
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# Threads hashing and hashes waiting for one in each API process, and seconds a hash waits for a thread
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", 2))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", 8))
+HASH_TIMEOUT = float(os.getenv("HASH_TIMEOUT", 2))
+
+OAUTH_CACHE_SIZE = int(os.getenv("OAUTH_CACHE_SIZE", 1024))
+OAUTH_CACHE_TTL = int(os.getenv("OAUTH_CACHE_TTL", 300))
+OAUTH_CLEANUP_INTERVAL = int(os.getenv("OAUTH_CLEANUP_INTERVAL", 600))
+OAUTH_CLEANUP_BATCH = int(os.getenv("OAUTH_CLEANUP_BATCH", 500))
+OAUTH_REFRESH_TOKEN_DAYS = int(os.getenv("OAUTH_REFRESH_TOKEN_DAYS", 30))
+
+FETCHER_WORKERS = int(os.getenv("FETCHER_WORKERS", 4))
+FETCHER_HEARTBEAT_INTERVAL = int(os.getenv("FETCHER_HEARTBEAT_INTERVAL", 5))
+FETCHER_RESTART_BACKOFF = int(os.getenv("FETCHER_RESTART_BACKOFF", 1))
+FETCHER_RESTART_BACKOFF_CAP = int(os.getenv("FETCHER_RESTART_BACKOFF_CAP", 300))
+FETCHER_DRAIN_TIMEOUT = int(os.getenv("FETCHER_DRAIN_TIMEOUT", 30))
+# Unique per supervisor; a node restarted with the same id takes back the topics it still holds
+FETCHER_NODE_ID = os.getenv("FETCHER_NODE_ID") or socket.gethostname()
+FETCHER_LEASE_TTL = int(os.getenv("FETCHER_LEASE_TTL", 15))
+
+# Topics a user runs at once, topics of a user waiting for a slot and topics run by all users (0 for no limit)
+SCHEDULER_USER_TOPICS = int(os.getenv("SCHEDULER_USER_TOPICS", 10))
+SCHEDULER_USER_QUEUED = int(os.getenv("SCHEDULER_USER_QUEUED", 20))
+SCHEDULER_CAPACITY = int(os.getenv("SCHEDULER_CAPACITY", 0))
+# Tweets kept per second between all the topics of a user, the rest is sampled out (0 for no limit)
+SCHEDULER_USER_TWEETS_PER_SECOND = float(os.getenv("SCHEDULER_USER_TWEETS_PER_SECOND", 0))
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", 30))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 300))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", 25))
+
+STREAM_BACKFILL_COUNT = int(os.getenv("STREAM_BACKFILL_COUNT", 500))
+STREAM_DEDUP_WINDOW = int(os.getenv("STREAM_DEDUP_WINDOW", 10000))
+
+# Budgets shared by every fetcher using the same credentials, per window of RATELIMIT_WINDOW seconds
+RATELIMIT_WINDOW = int(os.getenv("RATELIMIT_WINDOW", 900))
+RATELIMIT_SEARCH_PER_WINDOW = int(os.getenv("RATELIMIT_SEARCH_PER_WINDOW", 180))
+RATELIMIT_SEARCH_BURST = int(os.getenv("RATELIMIT_SEARCH_BURST", 10))
+RATELIMIT_CONNECT_PER_WINDOW = int(os.getenv("RATELIMIT_CONNECT_PER_WINDOW", 60))
+RATELIMIT_CONNECT_BURST = int(os.getenv("RATELIMIT_CONNECT_BURST", 5))
+RATELIMIT_MAX_POLL = float(os.getenv("RATELIMIT_MAX_POLL", 1))
+
+SAMPLER_LAG_THRESHOLD = float(os.getenv("SAMPLER_LAG_THRESHOLD", 10))
+SAMPLER_QUEUE_THRESHOLD = int(os.getenv("SAMPLER_QUEUE_THRESHOLD", 5000))
+SAMPLER_MIN_RATE = float(os.getenv("SAMPLER_MIN_RATE", 1 / 64))
+SAMPLER_BUCKET_SECONDS = int(os.getenv("SAMPLER_BUCKET_SECONDS", 60))
+SAMPLER_ADJUST_INTERVAL = float(os.getenv("SAMPLER_ADJUST_INTERVAL", 1))
+
+# Clusters remembered per topic, about 1.5 KB each
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 2000))
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", 3600))
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+DEDUP_PERMUTATIONS = int(os.getenv("DEDUP_PERMUTATIONS", 32))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", 8))
+DEDUP_TRACKED_CLUSTERS = int(os.getenv("DEDUP_TRACKED_CLUSTERS", 1000))
+DEDUP_TOP_CLUSTERS = int(os.getenv("DEDUP_TOP_CLUSTERS", 20))
+DEDUP_FLUSH_INTERVAL = float(os.getenv("DEDUP_FLUSH_INTERVAL", 5))
+
+# Coordinates farther than this from every town are left to the location of the profile
+GEO_MAX_DISTANCE_KM = float(os.getenv("GEO_MAX_DISTANCE_KM", 150))
+GEO_CITY_DISTANCE_KM = float(os.getenv("GEO_CITY_DISTANCE_KM", 15))
+
+TWEET_FLUSH_SIZE = int(os.getenv("TWEET_FLUSH_SIZE", 500))
+TWEET_FLUSH_INTERVAL = float(os.getenv("TWEET_FLUSH_INTERVAL", 2))
+TWEET_RETENTION_DAYS = int(os.getenv("TWEET_RETENTION_DAYS", 30))
+TWEET_TOPIC_PARTITIONS = int(os.getenv("TWEET_TOPIC_PARTITIONS", 8))
+
+# Rows fetched per round trip of the export cursor and bytes per chunk of the response
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 64 * 1024))
+
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    f'postgresql+psycopg2://{POSTGRESQL_USER}:{POSTGRESQL_PASSWORD}@{POSTGRESQL_HOST}/{POSTGRESQL_DB}'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ECHO'] = SQL_ECHO
 app.secret_key = os.getenv("SECRET_KEY")
 app.config["MAIL_SERVER"] = os.getenv("MAIL_SERVER")
 app.config["MAIL_PORT"] = os.getenv("MAIL_PORT")
 app.config["MAIL_USE_SSL"] = os.getenv("MAIL_USE_SSL")
 app.config["MAIL_USERNAME"] = os.getenv("MAIL_USERNAME")
 app.config["MAIL_PASSWORD"] = os.getenv("MAIL_PASSWORD")
+
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", 20))
+MAIL_BATCH_WAIT = float(os.getenv("MAIL_BATCH_WAIT", 0.5))
+MAIL_RETRIES = int(os.getenv("MAIL_RETRIES", 5))
@@ -0,0 +1,205 @@
+import sys
+import os
+import json
+import datetime
+import tempfile
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+import jwt
+import api
+from api import app
+from models.models import db, Topic, GeneralResult, EvolutionResult, LocationResult, SourceResult
+from FetcherQueue import FetcherQueue
+from Threader import Threader
+from util.leases import lease_key
+from settings import TOPICS_MAX_PAGE_SIZE, RESULTS_MAX_TOPICS, METRICS_TOKEN
+
+
+class ApiTestCase(TestCase):
+    """
+    API on a sqlite database with topics 1 to 7, all of user 1 but 4, and fakeredis for the fetchers
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database = tempfile.NamedTemporaryFile(suffix='.db')
+        cls.saved = (app.config['SQLALCHEMY_DATABASE_URI'], app.secret_key, api.fetcher_queue, api.threader)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + cls.database.name
+        app.secret_key = 'secret'
+
+    @classmethod
+    def tearDownClass(cls):
+        app.config['SQLALCHEMY_DATABASE_URI'], app.secret_key, api.fetcher_queue, api.threader = cls.saved
+        cls.database.close()
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        api.fetcher_queue = FetcherQueue(self.redis)
+        api.threader = Threader(self.redis)
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        # Users are inserted directly, creating them hashes their password
+        for user_id in (1, 2):
+            db.session.execute(f"INSERT INTO users (id, name, email, password, confirmed) "
+                               f"VALUES ({user_id}, 'user {user_id}', 'user@mail.com', 'x', 1)")
+        for topic_id in range(1, 8):
+            db.session.add(Topic(id=topic_id, user_id=1 if topic_id != 4 else 2, name=f'topic {topic_id}',
+                                 deadline=datetime.date(2018, 9, 30), language='es'))
+        db.session.add(GeneralResult(topic_id=1, positive=3, negative=2, neutral=1))
+        db.session.add(EvolutionResult(topic_id=1, day=datetime.date(2018, 9, 1), positive=1, negative=0, neutral=0))
+        db.session.add(EvolutionResult(topic_id=1, day=datetime.date(2018, 9, 2), positive=2, negative=2, neutral=1))
+        db.session.add(LocationResult(topic_id=1, location='AR', positive=1, negative=1, neutral=0))
+        db.session.add(LocationResult(topic_id=1, location='AR/Cordoba', positive=1, negative=0, neutral=0))
+        db.session.add(SourceResult(topic_id=2, source='Android', positive=1, negative=0, neutral=0))
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def get(self, url, user_id=1):
+        return self.client.get(url, headers={'token': self.token(user_id)})
+
+    def post(self, url, body, user_id=1):
+        return self.client.post(url, data=json.dumps(body), headers={'token': self.token(user_id)})
+
+    def token(self, user_id):
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        return jwt.encode({'user_id': user_id, 'exp': expiration}, app.secret_key, algorithm='HS256')
+
+
+class TestTopicsApi(ApiTestCase):
+
+    def test_pages_by_id(self):
+        response = self.get('/api/topics?limit=3')
+        assert response.status_code == 200
+        assert [topic['id'] for topic in json.loads(response.data)] == [1, 2, 3]
+        assert response.headers['X-Next-After'] == '3'
+        # Topics of other users are skipped
+        response = self.get('/api/topics?limit=3&after=3')
+        assert [topic['id'] for topic in json.loads(response.data)] == [5, 6, 7]
+        assert response.headers['X-Next-After'] == '7'
+        response = self.get('/api/topics?limit=3&after=7')
+        assert json.loads(response.data) == [] and 'X-Next-After' not in response.headers
+
+    def test_last_page_has_no_next(self):
+        response = self.get('/api/topics?limit=4&after=3')
+        assert [topic['id'] for topic in json.loads(response.data)] == [5, 6, 7]
+        assert 'X-Next-After' not in response.headers
+
+    def test_invalid_limits(self):
+        for limit in (0, -1):
+            response = self.get(f'/api/topics?limit={limit}')
+            assert response.status_code == 400
+            assert json.loads(response.data)['code'] == 400
+
+    def test_limit_is_capped(self):
+        for topic_id in range(8, TOPICS_MAX_PAGE_SIZE + 10):
+            db.session.add(Topic(id=topic_id, user_id=1, name='topic', deadline=datetime.date(2018, 9, 30),
+                                 language='es'))
+        db.session.commit()
+        response = self.get(f'/api/topics?limit={TOPICS_MAX_PAGE_SIZE + 100}')
+        assert len(json.loads(response.data)) == TOPICS_MAX_PAGE_SIZE
+        assert 'X-Next-After' in response.headers
+
+    def test_include_status_and_summary(self):
+        api.fetcher_queue.start_topic(Topic.query.get(1).to_dict())
+        self.redis.set(lease_key(1), 'a')
+        api.threader.add_thread(1, {"node": 'a', "worker": 2, "topic": {"id": 1}})
+        topics = json.loads(self.get('/api/topics?limit=2&include=status,summary').data)
+        assert topics[0]['summary'] == {'topic_id': 1, 'positive': 3, 'negative': 2, 'neutral': 1}
+        assert topics[0]['status']['running'] and topics[0]['status']['node'] == 'a'
+        assert topics[0]['status']['worker'] == 2
+        assert topics[0]['status']['admission']['state'] == 'running'
+        assert topics[1]['summary'] == {}
+        assert topics[1]['status'] == {'running': False, 'node': None, 'worker': None,
+                                       'admission': {'state': 'finished', 'position': None, 'reason': None}}
+
+    def test_without_include(self):
+        topics = json.loads(self.get('/api/topics?limit=1').data)
+        assert 'status' not in topics[0] and 'summary' not in topics[0]
+
+    def test_token_required(self):
+        assert self.client.get('/api/topics').status_code == 400
+
+
+class TestCreateTopicApi(ApiTestCase):
+
+    def test_terms_must_be_a_list_of_strings(self):
+        body = {'name': 'copa', 'deadline': '30-09-2030', 'language': 'es'}
+        for terms in ('messi', ['messi', 10], {'messi': 1}):
+            response = self.post('/api/topics', dict(body, terms=terms))
+            assert response.status_code == 400
+            assert json.loads(response.data)['code'] == 400
+        assert Topic.query.count() == 7
+
+
+class TestResultsApi(ApiTestCase):
+
+    def test_many_topics(self):
+        results = json.loads(self.get('/api/results?topics=1,2').data)
+        assert sorted(results) == ['1', '2']
+        assert results['1']['generalResults']['positive'] == 3 and results['2']['generalResults'] == {}
+        # Only whole countries, like /api/topics/<id>/results
+        assert [result['location'] for result in results['1']['locationResults']] == ['AR']
+        assert [result['day'] for result in results['1']['evolutionResults']] == ['01-09-2018', '02-09-2018']
+        assert [result['source'] for result in results['2']['sourceResults']] == ['Android']
+        assert 'sampling' in results['1'] and 'duplicates' in results['1']
+
+    def test_fields_and_days(self):
+        results = json.loads(self.get('/api/results?topics=1&fields=evolution&from=02-09-2018').data)
+        assert sorted(results['1']) == ['evolutionResults', 'topic']
+        assert [result['day'] for result in results['1']['evolutionResults']] == ['02-09-2018']
+
+    def test_invalid_parameters(self):
+        too_many = ','.join(str(topic_id) for topic_id in range(1, RESULTS_MAX_TOPICS + 2))
+        for query in ('', 'topics=a', 'topics=1&fields=tweets', 'topics=1&from=2018-09-01', 'topics=' + too_many):
+            assert self.get('/api/results?' + query).status_code == 400
+
+    def test_topics_of_other_users(self):
+        response = self.get('/api/results?topics=1,4')
+        assert response.status_code == 404
+        assert json.loads(response.data)['topics'] == [4]
+
+
+class TestTopicResultsApi(ApiTestCase):
+
+    def test_results(self):
+        results = json.loads(self.get('/api/topics/1/results').data)
+        assert results['topic']['id'] == 1 and results['generalResults']['positive'] == 3
+        assert [result['location'] for result in results['locationResults']] == ['AR']
+        assert 'sampling' in results and 'duplicates' in results
+
+    def test_missing_topic(self):
+        response = self.get('/api/topics/100/results')
+        assert response.status_code == 404
+        assert json.loads(response.data)['code'] == 404
+
+    def test_topic_of_other_user(self):
+        assert self.get('/api/topics/4/results').status_code == 404
+        assert self.get('/api/topics/4/results', user_id=2).status_code == 200
+
+
+class TestMetricsApi(ApiTestCase):
+
+    def tearDown(self):
+        api.METRICS_TOKEN = METRICS_TOKEN
+        super().tearDown()
+
+    def test_disabled_without_token(self):
+        api.METRICS_TOKEN = None
+        assert self.client.get('/api/metrics').status_code == 404
+
+    def test_requires_token(self):
+        api.METRICS_TOKEN = 'scraper'
+        assert self.client.get('/api/metrics').status_code == 401
+        assert self.client.get('/api/metrics', headers={'token': 'other'}).status_code == 401
+        self.redis.hincrbyfloat('metrics:counters', 'fetcher_tweets_in_total{topic="1"}', 3)
+        response = self.client.get('/api/metrics', headers={'token': 'scraper'})
+        assert response.status_code == 200
+        assert b'fetcher_tweets_in_total{topic="1"} 3' in response.data
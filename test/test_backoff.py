@@ -0,0 +1,41 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.backoff import Backoff, ReconnectPolicy
+
+
+class TestBackoff(TestCase):
+
+    def test_exponential_with_cap(self):
+        backoff = Backoff(5, 20)
+        delays = [backoff.next() for _ in range(5)]
+        steps = [5, 10, 20, 20, 20]
+        for delay, step in zip(delays, steps):
+            assert step <= delay <= min(step * 1.5, 20)
+        # Once the step reaches the cap the jitter cannot take the delay over it
+        assert delays[2:] == [20, 20, 20]
+
+    def test_linear(self):
+        backoff = Backoff(0.25, 1, factor=1, increment=0.25)
+        steps = [0.25, 0.5, 0.75, 1, 1]
+        for step in steps:
+            assert step <= backoff.next() <= min(step * 1.5, 1)
+
+    def test_reset(self):
+        backoff = Backoff(5, 320)
+        backoff.next()
+        backoff.next()
+        backoff.reset()
+        assert backoff.next() <= 7.5
+
+    def test_rate_limit_starts_at_one_minute(self):
+        policy = ReconnectPolicy()
+        assert 60 <= policy.delay(420) <= 90
+        assert 120 <= policy.delay(429) <= 180
+        assert 5 <= policy.delay(503) <= 7.5
+        assert 0.25 <= policy.delay() <= 0.375
+
+    def test_never_over_the_cap(self):
+        backoff = Backoff(10, 12)
+        assert all(10 <= backoff.next() <= 12 for _ in range(100))
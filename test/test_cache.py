@@ -0,0 +1,42 @@
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+
+    def test_get_and_set(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+
+    def test_expires(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1, ttl=0.05)
+        time.sleep(0.1)
+        assert cache.get("a") is None
+
+    def test_does_not_cache_already_expired(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1, ttl=-5)
+        assert len(cache) == 0
+
+    def test_delete(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        cache.delete("a")
+        cache.delete("b")
+        assert cache.get("a") is None
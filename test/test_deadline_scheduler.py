@@ -0,0 +1,63 @@
+import sys
+import os
+import time
+import datetime
+import threading
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from DeadlineScheduler import DeadlineScheduler, deadline_time
+
+
+class TestDeadlineScheduler(TestCase):
+
+    def setUp(self):
+        self.expired = []
+        self.event = threading.Event()
+        self.scheduler = DeadlineScheduler(self._on_expire)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_date_deadline_includes_whole_day(self):
+        day = datetime.date(2018, 9, 16)
+        end_of_day = datetime.datetime(2018, 9, 17, tzinfo=datetime.timezone.utc)
+        assert deadline_time(day) == end_of_day.timestamp()
+
+    def test_naive_datetime_is_utc(self):
+        naive = datetime.datetime(2018, 9, 16, 12, 30)
+        assert deadline_time(naive) == naive.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def test_expires_in_deadline_order(self):
+        now = datetime.datetime.utcnow()
+        self.scheduler.schedule(2, now + datetime.timedelta(milliseconds=200))
+        self.scheduler.schedule(1, now + datetime.timedelta(milliseconds=100))
+        self._wait_for(2)
+        assert self.expired == [1, 2]
+
+    def test_cancel(self):
+        now = datetime.datetime.utcnow()
+        self.scheduler.schedule(1, now + datetime.timedelta(milliseconds=100))
+        self.scheduler.schedule(2, now + datetime.timedelta(milliseconds=200))
+        self.scheduler.cancel(1)
+        self._wait_for(1)
+        assert self.expired == [2]
+
+    def test_reschedule_replaces_deadline(self):
+        now = datetime.datetime.utcnow()
+        self.scheduler.schedule(1, now + datetime.timedelta(milliseconds=100))
+        self.scheduler.schedule(1, now + datetime.timedelta(milliseconds=300))
+        time.sleep(0.2)
+        assert self.expired == []
+        self._wait_for(1)
+        assert self.expired == [1]
+
+    def _on_expire(self, topic_id):
+        self.expired.append(topic_id)
+        self.event.set()
+
+    def _wait_for(self, amount):
+        timeout = time.time() + 2
+        while len(self.expired) < amount and time.time() < timeout:
+            self.event.wait(0.1)
+            self.event.clear()
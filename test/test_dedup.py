@@ -0,0 +1,95 @@
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from bench.stand_ins import InMemoryRedis
+from util.dedup import Deduplicator, MinHash, similarity, tokens, dedup_stats
+
+TEXT = "Increible el gol de Messi en la final de la Copa America, nunca vi algo asi en mi vida"
+
+
+def tweet(tweet_id, original=None):
+    tweet = {"id": tweet_id}
+    if original is not None:
+        tweet["retweeted_status"] = {"id": original}
+    return tweet
+
+
+class TestDeduplicator(TestCase):
+
+    def setUp(self):
+        self.redis = InMemoryRedis()
+        self.dedup = Deduplicator(1, self.redis, window=100)
+
+    def test_retweets_join_their_original(self):
+        assert self.dedup.cluster(tweet(1), TEXT) == (1, False)
+        assert self.dedup.cluster(tweet(2, original=1), "RT @messi: " + TEXT) == (1, True)
+        # Retweet of a tweet not seen starts the cluster of the original
+        assert self.dedup.cluster(tweet(3, original=50), "RT @otro: hoy juega la seleccion") == (50, False)
+        assert self.dedup.cluster(tweet(4, original=50), "RT @otro: hoy juega la seleccion") == (50, True)
+
+    def test_exact_copies(self):
+        self.dedup.cluster(tweet(1), TEXT + " https://t.co/abc")
+        assert self.dedup.cluster(tweet(2), "increíble el GOL de messi en la final de la copa américa, nunca vi "
+                                            "algo así en mi vida https://t.co/xyz") == (1, True)
+
+    def test_near_copies(self):
+        self.dedup.cluster(tweet(1), TEXT)
+        assert self.dedup.cluster(tweet(2), TEXT + " #vamos") == (1, True)
+        assert self.dedup.cluster(tweet(3), "Que partido aburrido, la seleccion no juega a nada y Sampaoli "
+                                            "no sabe que hacer") == (3, False)
+
+    def test_window(self):
+        self.dedup.cluster(tweet(1), TEXT)
+        for tweet_id in range(2, 102):
+            self.dedup.cluster(tweet(tweet_id), f"texto numero {tweet_id} sin nada en comun")
+        assert self.dedup.cluster(tweet(200), TEXT) == (200, False)
+
+    def test_window_of_time(self):
+        dedup = Deduplicator(1, self.redis, window=100, window_seconds=60)
+        dedup.cluster(tweet(1), TEXT)
+        dedup.cluster(tweet(2), "hoy juega la seleccion contra brasil")
+        # Copies keep their cluster in the window
+        dedup._clusters[1] = dedup._clusters[1][:3] + (time.time() - 50,)
+        dedup._clusters[2] = dedup._clusters[2][:3] + (time.time() - 50,)
+        assert dedup.cluster(tweet(3), TEXT) == (1, True)
+        dedup._clusters[2] = dedup._clusters[2][:3] + (time.time() - 61,)
+        dedup.cluster(tweet(4), "texto sin nada en comun con los demas")
+        assert list(dedup._clusters) == [1, 4]
+        assert dedup.cluster(tweet(5), "hoy juega la seleccion contra brasil") == (5, False)
+        assert len(dedup._texts) == 3 and set(dedup._buckets.values()) == {1, 4, 5}
+
+    def test_compact_signatures(self):
+        self.dedup.cluster(tweet(1), TEXT)
+        key, signature, sample, seen = self.dedup._clusters[1]
+        assert isinstance(key, int) and signature.typecode == 'Q' and len(signature) == 32
+        assert all(isinstance(band, int) for band in self.dedup._buckets) and len(self.dedup._buckets) == 8
+
+    def test_stats(self):
+        self.dedup.cluster(tweet(1), TEXT)
+        for tweet_id in range(2, 5):
+            self.dedup.cluster(tweet(tweet_id, original=1), "RT @messi: " + TEXT)
+        self.dedup.cluster(tweet(5), "hoy juega la seleccion contra brasil")
+        self.dedup.cluster(tweet(6), "hoy juega la seleccion contra brasil", weight=4)
+        self.dedup.flush()
+        stats = dedup_stats(self.redis, [1])[1]
+        assert stats['tweets'] == 9 and stats['unique'] == 2 and stats['copies'] == 7
+        assert stats['by'] == {'retweet': 3, 'exact': 4, 'near': 0}
+        assert [(cluster['id'], cluster['tweets']) for cluster in stats['clusters']] == [('5', 5), ('1', 4)]
+        assert stats['clusters'][1]['text'] == TEXT
+
+    def test_minhash_estimates_jaccard(self):
+        minhash = MinHash(permutations=256)
+        rng = random.Random(1)
+        vocabulary = [f"palabra{i}" for i in range(200)]
+        first = [rng.choice(vocabulary) for _ in range(60)]
+        second = first[:40] + [rng.choice(vocabulary) for _ in range(20)]
+        shingles = [{' '.join(text[i:i + 3]) for i in range(len(text) - 2)} for text in (first, second)]
+        jaccard = len(shingles[0] & shingles[1]) / len(shingles[0] | shingles[1])
+        estimate = similarity(minhash.signature(first), minhash.signature(second))
+        assert abs(estimate - jaccard) < 0.1
+
+    def test_tokens(self):
+        assert tokens("RT @user: Gol de Messi https://t.co/abc") == ["gol", "de", "messi"]
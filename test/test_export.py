@@ -0,0 +1,48 @@
+import sys
+import os
+import io
+import csv
+import gzip
+import json
+import datetime
+import itertools
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.export import encode, gzipped
+
+COLUMNS = ('id', 'created_at', 'text')
+
+
+def rows(amount):
+    start = datetime.datetime(2018, 9, 16, tzinfo=datetime.timezone.utc)
+    return ((i, start + datetime.timedelta(seconds=i), f'gol de "messi", ñ\n{i}') for i in range(amount))
+
+
+class TestExport(TestCase):
+
+    def test_ndjson(self):
+        lines = b''.join(encode(COLUMNS, rows(3))).decode().splitlines()
+        assert len(lines) == 3
+        assert json.loads(lines[2]) == {'id': 2, 'created_at': '2018-09-16T00:00:02+00:00',
+                                        'text': 'gol de "messi", ñ\n2'}
+
+    def test_csv(self):
+        data = b''.join(encode(COLUMNS, rows(3), 'csv')).decode()
+        parsed = list(csv.reader(io.StringIO(data)))
+        assert parsed[0] == list(COLUMNS)
+        assert parsed[3] == ['2', '2018-09-16T00:00:02+00:00', 'gol de "messi", ñ\n2']
+
+    def test_chunks(self):
+        chunks = list(encode(COLUMNS, rows(1000), chunk_size=4096))
+        assert len(chunks) > 10
+        assert all(4096 <= len(chunk) < 4096 + 200 for chunk in chunks[:-1])
+
+    def test_lazy(self):
+        # Rows are only read as chunks are asked for, an endless source gives a first chunk
+        endless = ((i, None, 'x') for i in itertools.count())
+        chunk = next(encode(COLUMNS, endless, chunk_size=1024))
+        assert 1024 <= len(chunk) < 2048
+
+    def test_gzip(self):
+        chunks = encode(COLUMNS, rows(500), 'csv', chunk_size=1024)
+        assert gzip.decompress(b''.join(gzipped(chunks))) == b''.join(encode(COLUMNS, rows(500), 'csv'))
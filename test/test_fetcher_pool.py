@@ -0,0 +1,298 @@
+import sys
+import os
+import json
+import time
+import threading
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+import FetcherPool as pool_module
+from FetcherPool import FetcherPool, FetcherWorker, heartbeat_key
+from FetcherQueue import FetcherQueue
+from DeadlineScheduler import DeadlineScheduler
+from Threader import Threader
+from util.leases import NODES, lease_key
+from util.metrics import Metrics, COUNTERS
+from settings import FETCHER_RESTART_BACKOFF, FETCHER_RESTART_BACKOFF_CAP
+
+
+def topic(topic_id, user_id=1):
+    return {"id": topic_id, "user_id": user_id, "name": f'topic {topic_id}', "deadline": "30-09-2018",
+            "language": "es"}
+
+
+def commands(redis, key):
+    return [json.loads(command) for command in reversed(redis.lrange(key, 0, -1))]
+
+
+class StubProcess:
+    """
+    Worker process that never forks, alive until terminated or joined
+    """
+    pids = iter(range(1000, 100000))
+
+    def __init__(self, target=None, name=None, daemon=None):
+        self.alive = False
+        self.hangs = False
+        self.terminated = False
+        self.pid = None
+
+    def start(self):
+        self.alive = True
+        self.pid = next(StubProcess.pids)
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.terminated = True
+        self.alive = False
+
+    def join(self, timeout=None):
+        if not self.hangs:
+            self.alive = False
+
+
+class StubFetcher:
+
+    def __init__(self, expired=False, stopped=False):
+        self._expired = expired
+        self.stopped = stopped
+        self.disconnected = False
+        self.flushes = 0
+        self.sampler = SimpleNamespace(limit=0)
+        self._wakeup = threading.Event()
+
+    def expired(self):
+        return self._expired
+
+    def stream(self, track, languages=None):
+        self._wakeup.wait(5)
+
+    def disconnect(self):
+        self.disconnected = True
+        self.stopped = True
+        self._wakeup.set()
+
+    def flush(self):
+        self.flushes += 1
+
+
+class StubThread:
+
+    def __init__(self, alive=False):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        self.alive = False
+
+
+class TestFetcherPool(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.process, pool_module.Process = pool_module.Process, StubProcess
+        self.pool = FetcherPool(size=3, node='a', redis=self.redis, store=object())
+        for worker_id in range(3):
+            self.pool.backoff[worker_id] = FETCHER_RESTART_BACKOFF
+            self.pool._spawn(worker_id)
+
+    def tearDown(self):
+        pool_module.Process = self.process
+
+    def test_assigns_to_least_loaded_worker(self):
+        self.pool.assignments = {1: (0, topic(1)), 2: (0, topic(2)), 3: (1, topic(3))}
+        assert self.pool._assign(topic(4)) == 2
+        assert commands(self.redis, FetcherQueue.worker_key('a', 2)) == [
+            {"command": "start", "topic": topic(4), "limit": 0}]
+        assert self.pool._assign(topic(5)) == 1
+        # Topics already assigned stay where they are
+        assert self.pool._assign(topic(1)) == 0
+
+    def test_health(self):
+        assert self.pool._healthy(0)
+        # Past the grace period a worker is healthy only while it sends heartbeats
+        self.pool.started_at[0] = time.time() - 3600
+        assert not self.pool._healthy(0)
+        self.redis.set(heartbeat_key('a', 0), '{}')
+        assert self.pool._healthy(0)
+        self.pool.processes[0].alive = False
+        assert not self.pool._healthy(0)
+
+    def test_restarts_dead_worker_with_backoff(self):
+        self.pool.assignments = {1: (0, topic(1)), 2: (1, topic(2))}
+        dead = self.pool.processes[0]
+        dead.alive = False
+        self.pool._check_workers()
+        # Waits for its backoff before spawning again
+        assert self.pool.processes[0] is dead and 0 in self.pool.restart_at
+        self.pool.restart_at[0] = 0
+        self.pool._check_workers()
+        assert self.pool.processes[0] is not dead and self.pool.processes[0].is_alive()
+        assert self.pool.backoff[0] == FETCHER_RESTART_BACKOFF * 2
+        # The new process gets back the topics of the slot
+        assert commands(self.redis, FetcherQueue.worker_key('a', 0)) == [
+            {"command": "start", "topic": topic(1), "limit": 0}]
+
+    def test_terminates_worker_without_heartbeats(self):
+        stuck = self.pool.processes[1]
+        self.pool.started_at[1] = time.time() - 3600
+        self.pool._check_workers()
+        assert stuck.terminated and 1 in self.pool.restart_at
+
+    def test_backoff_resets_once_stable(self):
+        self.pool.backoff[2] = 64
+        self.pool.started_at[2] = time.time() - FETCHER_RESTART_BACKOFF_CAP - 1
+        self.redis.set(heartbeat_key('a', 2), '{}')
+        self.pool._check_workers()
+        assert self.pool.backoff[2] == FETCHER_RESTART_BACKOFF
+
+    def test_drain(self):
+        self.pool.leases.heartbeat()
+        self.pool.leases.claim(1)
+        self.pool.assignments = {1: (0, topic(1))}
+        self.pool.processes[2].hangs = True
+        self.pool._drain()
+        for worker_id in range(3):
+            assert commands(self.redis, FetcherQueue.worker_key('a', worker_id)) == [{"command": "drain"}]
+        assert not self.pool.processes[0].terminated and self.pool.processes[2].terminated
+        assert self.redis.get(lease_key(1)) is None
+        assert self.redis.zscore(NODES, 'a') is None
+
+
+class TestFetcherWorker(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.worker = FetcherWorker('a', 0)
+        self.worker.redis = self.redis
+        self.worker.queue = FetcherQueue(self.redis)
+        self.worker.threader = Threader(self.redis)
+        self.worker.scheduler = DeadlineScheduler(self.worker._expire)
+        self.worker.scheduler.start()
+        self.metrics, pool_module.metrics = pool_module.metrics, Metrics(self.redis)
+        pool_module.metrics._pid = os.getpid()
+        pool_module.metrics.inc('fetcher_tweets_in_total', topic=1)
+        pool_module.metrics.flush()
+
+    def tearDown(self):
+        self.worker.scheduler.stop()
+        pool_module.metrics = self.metrics
+
+    def counted(self):
+        pool_module.metrics.flush()
+        return self.redis.hexists(COUNTERS, 'fetcher_tweets_in_total{topic="1"}')
+
+    def run_topic(self, topic_id, fetcher, thread):
+        self.redis.hset(FetcherQueue.TOPICS, topic_id, json.dumps(topic(topic_id)))
+        self.worker.topics[topic_id] = (fetcher, thread, topic(topic_id))
+        self.worker.threader.add_thread(1, {"node": 'a', "worker": 0, "topic": topic(topic_id)})
+
+    def test_reap_finishes_expired_topics(self):
+        fetcher = StubFetcher(expired=True)
+        self.run_topic(1, fetcher, StubThread())
+        self.worker._reap()
+        assert self.worker.topics == {} and fetcher.flushes == 1
+        assert not self.redis.hexists(FetcherQueue.TOPICS, 1)
+        assert self.worker.threader.get_threads(1) == []
+        assert commands(self.redis, FetcherQueue.node_key('a')) == []
+        assert not self.counted()
+
+    def test_reap_restarts_dead_streams(self):
+        self.run_topic(1, StubFetcher(), StubThread())
+        self.worker._reap()
+        assert self.worker.topics == {}
+        assert self.redis.hexists(FetcherQueue.TOPICS, 1)
+        assert commands(self.redis, FetcherQueue.node_key('a')) == [{"command": "restart", "topic_id": 1}]
+        assert self.counted()
+
+    def test_reap_forgets_stopped_streams(self):
+        self.run_topic(1, StubFetcher(stopped=True), StubThread())
+        self.worker._reap()
+        assert self.worker.topics == {}
+        assert commands(self.redis, FetcherQueue.node_key('a')) == []
+        # Moved to another node, where its series keep adding up
+        assert self.counted()
+
+    def test_reap_drops_metrics_of_removed_topics(self):
+        self.run_topic(1, StubFetcher(stopped=True), StubThread())
+        self.redis.hdel(FetcherQueue.TOPICS, 1)
+        self.worker._reap()
+        assert not self.counted()
+
+    def test_reap_keeps_running_streams(self):
+        self.run_topic(1, StubFetcher(), StubThread(alive=True))
+        self.worker._reap()
+        assert 1 in self.worker.topics
+
+    def test_start_after_stop_starts_a_new_stream(self):
+        fetchers = []
+        self.worker._fetcher = lambda topic, deadline: fetchers.append(StubFetcher()) or fetchers[-1]
+        self.worker._start(topic(1), limit=5)
+        first_thread = self.worker.topics[1][1]
+        # The lease was lost and claimed again before the stream of the worker exited
+        self.worker._stop(1)
+        self.worker._start(topic(1), limit=3)
+        assert len(fetchers) == 2 and fetchers[0].disconnected and fetchers[0].flushes == 1
+        fetcher, thread, _ = self.worker.topics[1]
+        assert fetcher is fetchers[1] and fetcher.sampler.limit == 3
+        assert thread is not first_thread and thread.is_alive() and not first_thread.is_alive()
+        # Starting a running topic only updates its limit
+        self.worker._start(topic(1), limit=7)
+        assert len(fetchers) == 2 and fetcher.sampler.limit == 7
+        self.worker._reap()
+        assert 1 in self.worker.topics
+        fetcher.disconnect()
+        thread.join(1)
+
+    def test_drain(self):
+        fetchers = [StubFetcher(), StubFetcher()]
+        for topic_id, fetcher in enumerate(fetchers, 1):
+            self.run_topic(topic_id, fetcher, StubThread(alive=True))
+        self.worker._heartbeat()
+        self.worker._drain()
+        assert all(fetcher.disconnected and fetcher.flushes == 1 for fetcher in fetchers)
+        assert self.worker.threader.get_threads(1) == []
+        assert not self.redis.exists(heartbeat_key('a', 0))
+
+
+class TestFetcherQueue(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.queue = FetcherQueue(self.redis)
+
+    def test_start_topic(self):
+        assert self.queue.start_topic(topic(1))['state'] == 'running'
+        assert self.queue.topics() == {1: topic(1)}
+        assert self.queue.pop() == {"command": "start", "topic_id": 1}
+
+    def test_start_topic_starts_pending_topics_first(self):
+        self.queue.scheduler.capacity = 1
+        self.queue.start_topic(topic(1, user_id=1))
+        assert self.queue.start_topic(topic(2, user_id=2))['state'] == 'queued'
+        self.queue.finish(1)
+        admission = self.queue.start_topic(topic(3, user_id=3))
+        assert admission == {'state': 'queued', 'position': 1, 'reason': 'capacity'}
+        assert list(self.queue.topics()) == [2]
+        assert commands(self.redis, FetcherQueue.COMMANDS) == [{"command": "start", "topic_id": 1},
+                                                               {"command": "start", "topic_id": 2}]
+
+    def test_stop_topic_tells_its_node(self):
+        self.queue.start_topic(topic(1))
+        self.redis.set(lease_key(1), 'b')
+        assert self.queue.stop_topic(1) == 'b'
+        assert self.queue.topics() == {}
+        assert self.queue.pop(FetcherQueue.node_key('b')) == {"command": "stop", "topic_id": 1}
+
+    def test_stop_topic_not_running(self):
+        self.queue.start_topic(topic(1))
+        assert self.queue.stop_topic(1) is None
+        assert self.queue.topics() == {}
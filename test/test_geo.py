@@ -0,0 +1,77 @@
+import sys
+import os
+import random
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.geo import Location, TownIndex, locate, location_keys, towns, from_profile
+
+TOWNS = [(-34.60, -58.38, 'AR', 'Buenos Aires'), (-32.95, -60.64, 'AR', 'Rosario'),
+         (-34.90, -56.19, 'UY', 'Montevideo'), (-16.80, 179.97, 'FJ', 'Taveuni')]
+
+
+def point(lat, lon):
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+
+class TestGeo(TestCase):
+
+    def setUp(self):
+        self.index = TownIndex(TOWNS)
+
+    def test_place(self):
+        city = {"place_type": "city", "name": "Palermo", "full_name": "Palermo, Buenos Aires",
+                "country_code": "AR", "country": "Argentina"}
+        assert locate({"place": city}) == Location('AR', 'Buenos Aires', 'Palermo', 'place')
+        city = dict(city, name="Rosario", full_name="Rosario, Argentina")
+        assert locate({"place": city}) == Location('AR', None, 'Rosario', 'place')
+        admin = {"place_type": "admin", "name": "Cordoba", "full_name": "Cordoba, Argentina", "country_code": "AR"}
+        assert locate({"place": admin}) == Location('AR', 'Cordoba', None, 'place')
+        neighborhood = {"place_type": "neighborhood", "name": "Pocitos", "full_name": "Pocitos, Montevideo",
+                        "country_code": "UY", "country": "Uruguay"}
+        assert locate({"place": neighborhood}) == Location('UY', None, 'Montevideo', 'place')
+
+    def test_place_before_coordinates(self):
+        tweet = {"place": {"place_type": "country", "name": "Uruguay", "country_code": "UY"},
+                 "coordinates": point(-34.60, -58.38)}
+        assert locate(tweet, self.index).country == 'UY'
+        tweet["place"]["country_code"] = ""
+        assert locate(tweet, self.index) == Location('AR', None, 'Buenos Aires', 'coordinates')
+
+    def test_coordinates(self):
+        assert locate({"coordinates": point(-34.70, -58.30)}, self.index) == \
+            Location('AR', None, 'Buenos Aires', 'coordinates')
+        # Nearer to Buenos Aires than to Rosario, but too far to be in the city
+        assert locate({"coordinates": point(-34.0, -59.0)}, self.index) == Location('AR', None, None, 'coordinates')
+        # Deprecated geo field has the latitude first
+        assert locate({"geo": {"type": "Point", "coordinates": [-34.88, -56.2]}}, self.index).country == 'UY'
+        # Middle of the Atlantic
+        assert locate({"coordinates": point(-30.0, -30.0)}, self.index) is None
+        assert locate({"coordinates": None, "geo": None, "place": None}, self.index) is None
+
+    def test_antimeridian(self):
+        assert locate({"coordinates": point(-16.8, -179.9)}, self.index).country == 'FJ'
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(3)
+        cities = [(rng.uniform(-60, 60), rng.uniform(-180, 180), 'XX', str(i)) for i in range(3000)]
+        index = TownIndex(cities)
+        for _ in range(200):
+            lat, lon = rng.uniform(-60, 60), rng.uniform(-180, 180)
+            expected = min(cities, key=lambda town: TownIndex.distance(lat, lon, town[0], town[1]))
+            found = index.nearest(lat, lon, max_distance=500)
+            if TownIndex.distance(lat, lon, expected[0], expected[1]) <= 500:
+                assert found[0] == expected
+            else:
+                assert found is None
+
+    def test_bundled_towns(self):
+        assert locate({"coordinates": point(-31.42, -64.18)}).country == 'AR'
+        assert locate({"coordinates": point(40.42, -3.70)}) == Location('ES', None, 'Madrid', 'coordinates')
+
+    def test_keys(self):
+        assert location_keys(Location('AR', 'Buenos Aires', 'Palermo', 'place')) == \
+            ('AR', 'AR/Buenos Aires', 'AR/Buenos Aires/Palermo')
+        assert location_keys(Location('AR', None, 'Rosario', 'coordinates')) == ('AR', 'AR//Rosario')
+        assert location_keys(from_profile('UN')) == ('UN',)
+        assert from_profile('AR') is from_profile('AR')
+        assert towns() is towns()
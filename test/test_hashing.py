@@ -0,0 +1,86 @@
+import sys
+import os
+import time
+import threading
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.hashing import PasswordHasher, HasherOverloaded
+
+
+class TestPasswordHasher(TestCase):
+
+    def hasher(self, **options):
+        return PasswordHasher(**dict({'rounds': 4}, **options))
+
+    def hold_worker(self, hasher):
+        """
+        Keeps a worker of the hasher busy until the returned event is set
+        """
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        thread = threading.Thread(target=hasher._run, args=(slow,))
+        thread.start()
+        started.wait(5)
+        return release, thread
+
+    def test_hash_and_verify(self):
+        hasher = self.hasher()
+        hashed = hasher.hash("achuras")
+        assert hasher.verify("achuras", hashed)
+        assert not hasher.verify("mondongo", hashed)
+
+    def test_runs_off_the_calling_thread(self):
+        hasher = self.hasher()
+        assert hasher._run(threading.current_thread).name.startswith('hasher')
+
+    def test_needs_rehash_when_cost_changes(self):
+        hashed = self.hasher().hash("achuras")
+        assert not self.hasher().needs_rehash(hashed)
+        assert self.hasher(rounds=5).needs_rehash(hashed)
+
+    def test_sheds_load_when_full(self):
+        hasher = self.hasher(workers=1, queue_limit=0)
+        release, thread = self.hold_worker(hasher)
+        start = time.time()
+        with self.assertRaises(HasherOverloaded):
+            hasher.hash("achuras")
+        assert time.time() - start < 0.5
+        release.set()
+        thread.join()
+        assert hasher.verify("achuras", hasher.hash("achuras"))
+
+    def test_waits_for_a_worker(self):
+        hasher = self.hasher(workers=1, queue_limit=1, timeout=2)
+        release, thread = self.hold_worker(hasher)
+        threading.Timer(0.2, release.set).start()
+        assert hasher.verify("achuras", hasher.hash("achuras"))
+        thread.join()
+
+    def test_gives_up_waiting(self):
+        hasher = self.hasher(workers=1, queue_limit=1, timeout=0.2)
+        release, thread = self.hold_worker(hasher)
+        start = time.time()
+        with self.assertRaises(HasherOverloaded):
+            hasher.hash("achuras")
+        assert 0.1 < time.time() - start < 1
+        # The dropped hash gave its place back, the next one waits again instead of being rejected
+        start = time.time()
+        with self.assertRaises(HasherOverloaded):
+            hasher.hash("achuras")
+        assert time.time() - start > 0.1
+        release.set()
+        thread.join()
+        assert hasher.verify("achuras", hasher.hash("achuras"))
+
+    def test_errors_reach_the_caller(self):
+        hasher = self.hasher(workers=1, queue_limit=0)
+        with self.assertRaises(ValueError):
+            hasher.verify("achuras", "not a hash")
+        assert hasher.verify("achuras", hasher.hash("achuras"))
+
+    def test_measure(self):
+        assert self.hasher().measure() > 0
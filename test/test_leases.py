@@ -0,0 +1,82 @@
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+from util.leases import LeaseManager, rebalance
+
+TOPICS = list(range(1, 11))
+
+
+def keep_order(items):
+    items.sort()
+
+
+class TestRebalance(TestCase):
+
+    def test_first_node_takes_everything(self):
+        claim, release = rebalance('a', [], dict.fromkeys(TOPICS), keep_order)
+        assert claim == TOPICS and release == []
+
+    def test_joining_node(self):
+        owners = dict.fromkeys(TOPICS, 'a')
+        claim, release = rebalance('a', ['a', 'b'], owners, keep_order)
+        assert claim == [] and release == [6, 7, 8, 9, 10]
+        for topic_id in release:
+            owners[topic_id] = None
+        claim, release = rebalance('b', ['a', 'b'], owners, keep_order)
+        assert claim == [6, 7, 8, 9, 10] and release == []
+
+    def test_dead_node(self):
+        # Leases of c expired, its topics are free and split between a and b
+        owners = {1: 'a', 2: 'a', 3: 'b', 4: 'b', 5: None, 6: None}
+        assert rebalance('a', ['a', 'b'], owners, keep_order) == ([5], [])
+        assert rebalance('b', ['a', 'b'], owners, keep_order) == ([5], [])
+
+    def test_balanced_nodes_keep_their_topics(self):
+        owners = {1: 'a', 2: 'a', 3: 'b', 4: 'c', 5: 'c'}
+        for node in 'abc':
+            assert rebalance(node, ['a', 'b', 'c'], owners, keep_order) == ([], [])
+
+    def test_no_topics(self):
+        assert rebalance('a', ['a'], {}) == ([], [])
+
+
+class TestLeaseManager(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.a = LeaseManager(self.redis, 'a', ttl=1)
+        self.b = LeaseManager(self.redis, 'b', ttl=1)
+
+    def test_claim_and_release(self):
+        assert self.a.claim(1)
+        assert self.a.claim(1)
+        assert not self.b.claim(1)
+        assert self.a.owners([1, 2]) == {1: 'a', 2: None}
+        assert not self.b.release(1)
+        assert self.a.release(1)
+        assert self.b.claim(1)
+
+    def test_renew(self):
+        self.a.claim(1)
+        self.a.claim(2)
+        self.b.claim(3)
+        assert self.a.renew([1, 2, 3]) == {3}
+
+    def test_expired_leases_are_free(self):
+        self.a.claim(1)
+        time.sleep(1.1)
+        assert self.a.renew([1]) == {1}
+        assert self.b.claim(1)
+
+    def test_nodes(self):
+        self.a.heartbeat()
+        self.b.heartbeat()
+        assert sorted(self.a.nodes()) == ['a', 'b']
+        self.b.leave()
+        assert self.a.nodes() == ['a']
+        time.sleep(1.1)
+        assert self.b.nodes() == []
@@ -0,0 +1,106 @@
+import sys
+import os
+import threading
+import socketserver
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from flask import Flask
+from flask_mail import Message
+from util.mailers import MailQueue
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server accepting every message but those to refused recipients, counts
+    connections and messages. With drop set, the first connection is closed at that message
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.drop = None
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply("220 stand-in ready")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line.split(" ")[0].upper()
+            if not line or command == "QUIT":
+                self._reply("221 bye")
+                return
+            if command == "RCPT" and "refused" in line:
+                self._reply("550 no such user")
+                continue
+            if command == "DATA":
+                if self.server.connections == 1 and len(self.server.messages) == self.server.drop:
+                    return
+                self._reply("354 go ahead")
+                self.server.messages.append(self._read_data())
+            self._reply("250 ok")
+
+    def _read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline().decode()
+            if line in (".\r\n", ""):
+                return "".join(lines)
+            lines.append(line)
+
+    def _reply(self, message):
+        self.wfile.write((message + "\r\n").encode())
+
+
+class TestMailQueue(TestCase):
+
+    def setUp(self):
+        self.server = SMTPStandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        app = Flask(__name__)
+        app.config["MAIL_SERVER"] = "127.0.0.1"
+        app.config["MAIL_PORT"] = self.server.server_address[1]
+        self.queue = MailQueue(app, batch_size=10, batch_wait=0.2, retries=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sends_batch_over_one_connection(self):
+        for i in range(3):
+            self.queue.enqueue(self._message(i))
+        self.queue.join()
+        assert len(self.server.messages) == 3
+        assert self.server.connections == 1
+
+    def test_enqueue_does_not_wait_for_smtp(self):
+        self.queue.enqueue(self._message(0))
+        assert len(self.server.messages) == 0
+        self.queue.join()
+        assert "Subject: Asunto 0" in self.server.messages[0]
+
+    def test_refused_message_is_skipped(self):
+        for i in range(3):
+            self.queue.enqueue(self._message(i, "refused@fatmail.com" if i == 1 else "eighty@fatmail.com"))
+        self.queue.join()
+        assert ["Asunto 1" in message for message in self.server.messages] == [False, False]
+        assert self.server.connections == 1
+
+    def test_retries_only_unsent_messages(self):
+        self.server.drop = 1
+        self.queue.retries = 1
+        for i in range(3):
+            self.queue.enqueue(self._message(i))
+        self.queue.join()
+        assert [f"Subject: Asunto {i}" in message for i, message in enumerate(self.server.messages)] == [True] * 3
+        assert self.server.connections == 2
+
+    @staticmethod
+    def _message(i, recipient="eighty@fatmail.com"):
+        return Message(subject=f"Asunto {i}", sender="socialcat@example.com",
+                       recipients=[recipient], html="<p>hola</p>")
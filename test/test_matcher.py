@@ -0,0 +1,68 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.matcher import Automaton, TopicMatcher, QueryError, words, tweet_text, validate_terms, search_query
+
+
+def tweet(text, lang="es"):
+    return {"text": text, "lang": lang}
+
+
+class TestMatcher(TestCase):
+
+    def test_words_are_normalized(self):
+        assert words("¡Gol de #Messi en el Atlético!") == ["gol", "de", "messi", "en", "el", "atletico"]
+
+    def test_automaton_finds_overlapping_phrases(self):
+        automaton = Automaton([("copa", "america"), ("america",), ("la", "copa"), ("mundial",)])
+        assert automaton.find(words("la copa america")) == {0, 1, 2}
+        assert automaton.find(words("copa del mundo")) == set()
+
+    def test_automaton_matches_whole_words(self):
+        automaton = Automaton([("messi",)])
+        assert automaton.find(words("messiánico")) == set()
+
+    def test_tweet_text_includes_retweets_and_quotes(self):
+        text = tweet_text({"text": "RT @a: gol", "retweeted_status": {"extended_tweet": {"full_text": "gol de messi"}},
+                           "quoted_status": {"full_text": "final"}})
+        assert "messi" in text and "final" in text
+
+    def test_include_expression(self):
+        matcher = TopicMatcher('messi ("copa america" OR mundial)')
+        assert matcher.matches(tweet("Messi gana la Copa América"))
+        assert matcher.matches(tweet("messi y el mundial"))
+        assert not matcher.matches(tweet("messi en el barcelona"))
+        assert not matcher.matches(tweet("la copa america"))
+
+    def test_exclude_expression(self):
+        matcher = TopicMatcher("messi", "fake OR sorteo")
+        assert matcher.matches(tweet("gol de messi"))
+        assert not matcher.matches(tweet("messi sorteo"))
+
+    def test_not_operators(self):
+        matcher = TopicMatcher("messi -barcelona AND NOT psg")
+        assert matcher.matches(tweet("messi"))
+        assert not matcher.matches(tweet("messi barcelona"))
+        assert not matcher.matches(tweet("messi psg"))
+
+    def test_languages(self):
+        matcher = TopicMatcher(languages=["es", "pt"])
+        assert matcher.matches(tweet("gol", "pt"))
+        assert not matcher.matches(tweet("goal", "en"))
+
+    def test_invalid_expressions(self):
+        for expression in ('messi AND', '(messi', '"messi', 'messi)', '!!!'):
+            with self.assertRaises(QueryError):
+                TopicMatcher(expression)
+
+    def test_terms(self):
+        assert validate_terms([" messi ", "copa america"]) == ["messi", "copa america"]
+        with self.assertRaises(QueryError):
+            validate_terms(["a,b"])
+        with self.assertRaises(QueryError):
+            validate_terms([])
+        for terms in ("messi", ["messi", 10], None):
+            with self.assertRaises(QueryError):
+                validate_terms(terms)
+        assert search_query(["messi", "copa america"]) == "messi OR (copa america)"
@@ -0,0 +1,101 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+from util.metrics import Metrics, render, series, has_labels, COUNTERS, HISTOGRAMS, GAUGES
+
+
+def flushed(redis):
+    """
+    Metrics writing to redis without a flushing thread
+    """
+    metrics = Metrics(redis)
+    metrics._pid = os.getpid()
+    return metrics
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.metrics = flushed(self.redis)
+
+    def values(self):
+        lines = render(self.redis).splitlines()
+        return dict(line.rsplit(' ', 1) for line in lines if line and not line.startswith('#'))
+
+    def test_series(self):
+        assert series('tweets', {}) == 'tweets'
+        assert series('tweets', {'topic': 1, 'reason': 'filter'}) == 'tweets{reason="filter",topic="1"}'
+        assert has_labels('tweets{reason="filter",topic="1"}', {'topic': 1})
+        assert not has_labels('tweets{reason="filter",topic="12"}', {'topic': 1})
+        assert not has_labels('tweets', {'topic': 1})
+
+    def test_counters_add_up_between_processes(self):
+        other = flushed(self.redis)
+        self.metrics.inc('tweets_total', topic=1)
+        self.metrics.inc('tweets_total', 2, topic=1)
+        other.inc('tweets_total', topic=1)
+        other.inc('tweets_total', topic=2)
+        self.metrics.flush()
+        other.flush()
+        assert self.values() == {'tweets_total{topic="1"}': '4', 'tweets_total{topic="2"}': '1'}
+        # What was flushed is not added again
+        self.metrics.flush()
+        assert self.values()['tweets_total{topic="1"}'] == '4'
+        assert '# TYPE tweets_total counter' in render(self.redis)
+
+    def test_histograms(self):
+        for value in (0.003, 0.003, 2):
+            self.metrics.observe('wait_seconds', value, endpoint='search')
+        self.metrics.flush()
+        values = self.values()
+        # Empty buckets are not written
+        assert 'wait_seconds_bucket{endpoint="search",le="0.0025"}' not in values
+        assert values['wait_seconds_bucket{endpoint="search",le="0.005"}'] == '2'
+        assert values['wait_seconds_bucket{endpoint="search",le="2.5"}'] == '3'
+        assert values['wait_seconds_bucket{endpoint="search",le="+Inf"}'] == '3'
+        assert values['wait_seconds_count{endpoint="search"}'] == '3'
+        assert float(values['wait_seconds_sum{endpoint="search"}']) == 2.006
+        assert '# TYPE wait_seconds histogram' in render(self.redis)
+
+    def test_gauges_of_processes_are_added(self):
+        # A process with the same pid in another container
+        other = flushed(self.redis)
+        other.node = 'other'
+        self.metrics.gauge('queued', 3)
+        self.metrics.gauge('queued', 1, topic=1)
+        other.gauge('queued', 2)
+        other.gauge('queued', 1, topic=1)
+        self.metrics.flush()
+        other.flush()
+        assert self.values() == {'queued': '5', 'queued{topic="1"}': '2'}
+        assert all(self.redis.ttl(key) > 0 for key in self.redis.keys(f'{GAUGES}:*'))
+        other.forget(topic=1)
+        other.flush()
+        assert self.values() == {'queued': '5', 'queued{topic="1"}': '1'}
+
+    def test_forget_topic(self):
+        self.metrics.inc('tweets_total', topic=1)
+        self.metrics.inc('tweets_total', topic=12)
+        self.metrics.observe('write_seconds', 0.1, topic=1)
+        self.metrics.gauge('queued', 4, topic=1)
+        self.metrics.flush()
+        # Counted after the topic finished, before the next flush
+        self.metrics.inc('tweets_total', topic=1)
+        self.metrics.forget(topic=1)
+        self.metrics.flush()
+        assert self.values() == {'tweets_total{topic="12"}': '1'}
+        assert all(b'topic="1"' not in field for key in (COUNTERS, HISTOGRAMS)
+                   for field in self.redis.hkeys(key))
+        # Series of the topic of other processes are dropped from the totals too
+        self.redis.hincrbyfloat(COUNTERS, 'tweets_total{topic="12"}', 1)
+        self.metrics.forget(topic=12)
+        self.metrics.flush()
+        assert self.values() == {}
+
+    def test_nothing_to_flush(self):
+        self.metrics.flush()
+        assert self.redis.keys('*') == []
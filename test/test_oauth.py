@@ -0,0 +1,157 @@
+import sys
+import os
+import time
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+import oauth as oauth_module
+from api import app, oauth
+from models.models import db, Client, Token
+from oauth import tokens, clients, invalidation, cleanup_expired
+from util.cache import TTLCache, SharedInvalidation
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSharedInvalidation(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.caches = [TTLCache(10, 60), TTLCache(10, 60)]
+        # One per API process, sharing the channel
+        self.processes = [SharedInvalidation(self.redis, 'test:invalidations', {'tokens': cache})
+                          for cache in self.caches]
+
+    def test_deletions_reach_every_process(self):
+        assert all(wait_for(process.usable) for process in self.processes)
+        for cache in self.caches:
+            cache.set(('access', 'a'), 1)
+            cache.set(('access', 'b'), 2)
+        self.processes[0].publish([('tokens', ('access', 'a'))])
+        assert self.caches[0].get(('access', 'a')) is None
+        assert wait_for(lambda: self.caches[1].get(('access', 'a')) is None)
+        assert self.caches[1].get(('access', 'b')) == 2
+        self.processes[1].publish([('tokens', None)])
+        assert wait_for(lambda: len(self.caches[0]) == 0)
+
+    def test_unused_until_subscribed(self):
+        process = SharedInvalidation(self.redis, 'test:invalidations', {'tokens': TTLCache(10, 60)})
+        assert not process.live
+        version = process.version
+        assert wait_for(process.usable)
+        assert process.version > version
+
+
+class TestOAuthCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database = tempfile.NamedTemporaryFile(suffix='.db')
+        cls.saved_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + cls.database.name
+        invalidation.redis = fakeredis.FakeStrictRedis()
+        invalidation._pid = None
+
+    @classmethod
+    def tearDownClass(cls):
+        app.config['SQLALCHEMY_DATABASE_URI'] = cls.saved_uri
+        cls.database.close()
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        tokens.clear()
+        clients.clear()
+        # Cleanups run only when the tests call them
+        oauth_module._cleanup["next"] = datetime.utcnow() + timedelta(days=1)
+        # Users are inserted directly, creating them hashes their password
+        db.session.execute("INSERT INTO users (id, name, email, password, confirmed) "
+                           "VALUES (1, 'user', 'user@mail.com', 'x', 1)")
+        db.session.add(Client(client_id='client', client_secret='secret', user_id=1, _redirect_uris='',
+                              _default_scopes=''))
+        db.session.commit()
+        self.request = SimpleNamespace(user=SimpleNamespace(id=1), client=SimpleNamespace(client_id='client'))
+        assert wait_for(invalidation.usable)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def set_token(self, access, refresh='refresh', expires_in=3600):
+        oauth._tokensetter({'access_token': access, 'refresh_token': refresh, 'token_type': 'Bearer',
+                            'scope': 'email', 'expires_in': expires_in}, self.request)
+
+    def test_set_token_renews_in_place(self):
+        self.set_token('first')
+        assert oauth._tokengetter(access_token='first').access_token == 'first'
+        assert ('access', 'first') in tokens._entries
+        self.set_token('second', 'refreshed')
+        assert Token.query.count() == 1
+        assert oauth._tokengetter(access_token='first') is None
+        assert oauth._tokengetter(access_token='second').refresh_token == 'refreshed'
+        assert oauth._tokengetter(refresh_token='refresh') is None
+
+    def test_deleted_token_is_evicted(self):
+        self.set_token('first')
+        token = oauth._tokengetter(access_token='first')
+        assert oauth._tokengetter(refresh_token='refresh') is not None
+        token.delete()
+        assert ('access', 'first') not in tokens._entries and ('refresh', 'refresh') not in tokens._entries
+        assert oauth._tokengetter(access_token='first') is None
+
+    def test_deleted_token_is_evicted_by_other_processes(self):
+        self.set_token('first')
+        oauth._tokengetter(access_token='first')
+        # Another process deletes the token and publishes it
+        Token.query.filter_by(access_token='first').delete()
+        db.session.commit()
+        invalidation.redis.publish(invalidation.channel, '[["tokens", ["access", "first"]]]')
+        assert wait_for(lambda: ('access', 'first') not in tokens._entries)
+        assert oauth._tokengetter(access_token='first') is None
+
+    def test_rolled_back_deletions_are_not_published(self):
+        self.set_token('first')
+        token = oauth._tokengetter(access_token='first')
+        db.session.delete(token)
+        db.session.flush()
+        assert db.session.info[oauth_module.PENDING_DELETIONS]
+        db.session.rollback()
+        assert oauth_module.PENDING_DELETIONS not in db.session.info
+        assert oauth._tokengetter(access_token='first') is not None
+
+    def test_changed_client_is_evicted(self):
+        assert oauth._clientgetter('client').name is None
+        client = Client.query.get('client')
+        client.name = 'app'
+        db.session.commit()
+        assert 'client' not in clients._entries
+        assert oauth._clientgetter('client').name == 'app'
+
+    def test_cleanup_expired(self):
+        self.set_token('expired', refresh=None, expires_in=-60)
+        self.request.user.id = 2
+        self.set_token('valid', refresh='valid')
+        oauth._tokengetter(access_token='valid')
+        assert cleanup_expired() == 1
+        assert [token.access_token for token in Token.query.all()] == ['valid']
+        # The whole token cache is dropped, the valid one is loaded again
+        assert len(tokens) == 0
+        assert oauth._tokengetter(access_token='valid') is not None
+
+    def test_cleanup_keeps_refreshable_tokens(self):
+        self.set_token('expired', expires_in=-60)
+        assert cleanup_expired() == 0
+        token = Token.query.one()
+        token.expires = datetime.utcnow() - timedelta(days=365)
+        db.session.commit()
+        assert cleanup_expired() == 1
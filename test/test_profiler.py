@@ -0,0 +1,48 @@
+import sys
+import os
+import tempfile
+import threading
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from util.profiler import SamplingProfiler, collapse
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler('test', directory=self.directory, interval=0.005)
+
+    def test_collapse(self):
+        stack = collapse(sys._getframe(), 'main')
+        assert stack.startswith('main;')
+        assert stack.endswith('test_profiler.py:test_collapse')
+
+    def test_profile_writes_stacks_and_allocations(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy, args=(stop,), name='busy')
+        thread.start()
+        try:
+            report = self.profiler.profile(0.3)
+        finally:
+            stop.set()
+            thread.join()
+        assert report["samples"] > 0
+        with open(report["stacks"]) as stacks:
+            lines = stacks.read().splitlines()
+        assert any(line.startswith('busy;') and 'test_profiler.py:busy' in line for line in lines)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+        with open(report["allocations"]) as allocations:
+            assert 'Traced memory' in allocations.read()
+
+    def test_one_profile_at_a_time(self):
+        reports = []
+        assert self.profiler.start(0.2, reports.append)
+        assert not self.profiler.start(0.2, reports.append)
+        self.profiler.join()
+        assert len(reports) == 1
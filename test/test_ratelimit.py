@@ -0,0 +1,80 @@
+import sys
+import os
+import time
+import threading
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+from util.ratelimit import RateLimiter
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        # 2 calls at once and 2 more spread over the window of 2 seconds
+        self.limiter = RateLimiter(self.redis, 'search', window=2, max_poll=0.05)
+        self.limiter.capacity, self.limiter.rate = 2, 2 / 2000
+
+    def test_burst_then_wait(self):
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            threading.Event().wait(seconds)
+
+        assert self.limiter.acquire(1, sleep=sleep)
+        assert self.limiter.acquire(1, sleep=sleep)
+        assert slept == []
+        assert self.limiter.acquire(1, sleep=sleep)
+        assert sum(slept) > 0.5
+
+    def test_topics_take_turns(self):
+        self.limiter.capacity, self.limiter.rate = 1, 10 / 1000
+        self.limiter.acquire(0)
+        order = []
+
+        def fetch(topic_id):
+            for _ in range(2):
+                self.limiter.acquire(topic_id)
+                order.append(topic_id)
+
+        threads = [threading.Thread(target=fetch, args=(topic_id,)) for topic_id in (1, 2)]
+        for thread in threads:
+            thread.start()
+            threading.Event().wait(0.02)
+        for thread in threads:
+            thread.join()
+        assert order == [1, 2, 1, 2]
+
+    def test_users_take_turns(self):
+        # User a runs topics 1 and 2, user b only topic 3, they still alternate
+        self.limiter.capacity, self.limiter.rate = 1, 10 / 1000
+        self.limiter.acquire(0)
+        order = []
+
+        def fetch(topic_id, user_id):
+            for _ in range(2):
+                self.limiter.acquire(topic_id, user_id=user_id)
+                order.append(user_id)
+
+        threads = [threading.Thread(target=fetch, args=args) for args in ((1, 'a'), (2, 'a'), (3, 'b'))]
+        for thread in threads:
+            thread.start()
+            threading.Event().wait(0.02)
+        for thread in threads:
+            thread.join()
+        assert order == ['a', 'b', 'a', 'b', 'a', 'a']
+
+    def test_give_up_waiting(self):
+        self.limiter.acquire(1)
+        self.limiter.acquire(1)
+        assert not self.limiter.acquire(2, sleep=lambda seconds: True)
+        assert self.redis.zcard(self.limiter.keys[1]) == 0
+
+    def test_drain(self):
+        self.limiter.drain(time.time() + 0.5)
+        start = time.time()
+        assert self.limiter.acquire(1)
+        assert time.time() - start >= 0.5
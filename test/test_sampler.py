@@ -0,0 +1,67 @@
+import sys
+import os
+import random
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from bench.stand_ins import InMemoryRedis
+from util.sampler import AdaptiveSampler, sampling_stats
+
+START = 1538000000
+
+
+class TestAdaptiveSampler(TestCase):
+
+    def setUp(self):
+        self.redis = InMemoryRedis()
+        self.sampler = AdaptiveSampler(1, self.redis, lag_threshold=10, queue_threshold=100, min_rate=1 / 8,
+                                       bucket_seconds=60, interval=1, random=random.Random(1).random)
+
+    def stream(self, seconds, per_second, lag, depth=0, start=START):
+        weights = []
+        for second in range(seconds):
+            now = start + second
+            for _ in range(per_second):
+                weights.append(self.sampler.sample(now - lag, depth, now=now))
+        self.sampler.flush(start + seconds)
+        return weights
+
+    def test_keeps_everything_on_time(self):
+        weights = self.stream(120, 10, lag=1)
+        assert set(weights) == {1}
+        stats = sampling_stats(self.redis, [1])[1]
+        assert stats['seen'] == stats['kept'] == 1200
+        assert stats['rate'] == 1.0 and stats['buckets'] == []
+
+    def test_sheds_when_lagging(self):
+        weights = self.stream(30, 100, lag=60)
+        assert self.sampler.rate == 1 / 8
+        assert set(weights) <= {0, 1, 2, 4, 8}
+        # Kept tweets weighted by the inverse of their rate estimate the tweets seen
+        assert abs(sum(weights) - len(weights)) / len(weights) < 0.05
+
+    def test_sheds_when_writer_backs_up(self):
+        self.stream(5, 10, lag=0, depth=500)
+        assert self.sampler.rate < 1
+
+    def test_recovers(self):
+        self.stream(30, 100, lag=60)
+        self.stream(60, 100, lag=0)
+        assert self.sampler.rate == 1.0
+
+    def test_stats_of_sampled_buckets(self):
+        self.stream(60, 100, lag=60)
+        stats = sampling_stats(self.redis, [1])[1]
+        assert stats['seen'] == 6000 and stats['kept'] < 6000
+        assert stats['buckets']
+        assert sum(bucket['seen'] for bucket in stats['buckets']) == 6000
+        for bucket in stats['buckets']:
+            assert bucket['rate'] == bucket['kept'] / bucket['seen']
+
+    def test_keeps_under_limit(self):
+        self.sampler.limit = 20
+        weights = self.stream(30, 100, lag=0)
+        assert self.sampler.rate == 1 / 8
+        assert sum(1 for weight in weights[-1000:] if weight) / 10 <= 20
+        self.sampler.limit = 0
+        self.stream(10, 100, lag=0, start=START + 30)
+        assert self.sampler.rate == 1.0
@@ -0,0 +1,114 @@
+import sys
+import os
+from collections import namedtuple
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import fakeredis
+from util.scheduler import Scheduler, TOPICS, PENDING, QUEUED, WEIGHTS
+
+Topic = namedtuple('Topic', ['id', 'user_id'])
+
+
+def topic(topic_id, user_id):
+    return {"id": topic_id, "user_id": user_id, "name": f'topic {topic_id}'}
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.scheduler = Scheduler(self.redis, user_topics=2, user_queued=2, capacity=4)
+
+    def test_user_quota(self):
+        assert self.scheduler.admit(topic(1, 1))['state'] == 'running'
+        assert self.scheduler.admit(topic(2, 1))['state'] == 'running'
+        assert self.scheduler.admit(topic(3, 1)) == {'state': 'queued', 'position': 1, 'reason': 'user_quota',
+                                                     'started': []}
+        assert self.scheduler.admit(topic(4, 1))['position'] == 2
+        assert self.scheduler.admit(topic(5, 1))['state'] == 'rejected'
+        # Admitting again does not queue twice
+        assert self.scheduler.admit(topic(3, 1))['position'] == 1
+        assert self.scheduler.admit(topic(6, 2))['state'] == 'running'
+
+    def test_capacity(self):
+        for topic_id in range(4):
+            self.scheduler.admit(topic(topic_id, topic_id))
+        assert self.scheduler.admit(topic(4, 4)) == {'state': 'queued', 'position': 1, 'reason': 'capacity',
+                                                     'started': []}
+        assert self.scheduler.promote() == []
+        self.redis.hdel(TOPICS, 0)
+        assert self.scheduler.promote() == [4]
+        assert self.redis.hexists(TOPICS, 4) and not self.redis.zcard(PENDING)
+
+    def test_pending_topics_start_before_new_ones(self):
+        for topic_id in range(4):
+            self.scheduler.admit(topic(topic_id, topic_id))
+        self.scheduler.admit(topic(4, 4))
+        # A topic finished and the node did not promote yet, the one waiting goes first
+        self.redis.hdel(TOPICS, 0)
+        assert self.scheduler.admit(topic(5, 5)) == {'state': 'queued', 'position': 1, 'reason': 'capacity',
+                                                     'started': [4]}
+        assert self.redis.hexists(TOPICS, 4) and not self.redis.hexists(TOPICS, 5)
+
+    def test_new_topic_may_start_when_pending_ones_do_not_fit(self):
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 1))
+        self.scheduler.admit(topic(3, 1))
+        # Topic 3 waits for the quota of its user, not for capacity
+        assert self.scheduler.admit(topic(4, 2)) == {'state': 'running', 'position': None, 'reason': None,
+                                                     'started': []}
+        assert self.redis.zrank(PENDING, 3) == 0
+
+    def test_new_topic_started_by_promotion(self):
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 1))
+        self.scheduler.admit(topic(3, 1))
+        self.redis.hdel(TOPICS, 1)
+        assert self.scheduler.admit(topic(3, 1)) == {'state': 'running', 'position': None, 'reason': None,
+                                                     'started': [3]}
+
+    def test_users_with_fewer_topics_go_first(self):
+        self.scheduler.user_topics = 3
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 1))
+        self.scheduler.admit(topic(3, 2))
+        self.scheduler.admit(topic(4, 3))
+        self.scheduler.admit(topic(5, 1))
+        self.scheduler.admit(topic(6, 2))
+        self.redis.hdel(TOPICS, 3)
+        # User 1 asked first, but user 2 runs fewer topics
+        assert self.scheduler.promote() == [6]
+        self.redis.hdel(TOPICS, 4)
+        assert self.scheduler.promote() == [5]
+
+    def test_weights(self):
+        self.scheduler.capacity = 3
+        self.scheduler.user_topics = 3
+        self.redis.hset(WEIGHTS, 1, 2)
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 2))
+        self.scheduler.admit(topic(3, 2))
+        self.scheduler.admit(topic(4, 2))
+        self.scheduler.admit(topic(5, 1))
+        self.redis.hdel(TOPICS, 3)
+        # User 1 runs one topic for a weight of 2, less than the two of user 2
+        assert self.scheduler.promote() == [5]
+
+    def test_cancel(self):
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 1))
+        self.scheduler.admit(topic(3, 1))
+        assert self.scheduler.cancel(3)
+        assert not self.scheduler.cancel(3)
+        self.redis.hdel(TOPICS, 1)
+        assert self.scheduler.promote() == []
+
+    def test_admissions(self):
+        self.scheduler.admit(topic(1, 1))
+        self.scheduler.admit(topic(2, 1))
+        self.scheduler.admit(topic(3, 1))
+        admissions = self.scheduler.admissions([Topic(1, 1), Topic(3, 1), Topic(9, 1)])
+        assert admissions[1]['state'] == 'running'
+        assert admissions[3] == {'state': 'queued', 'position': 1, 'reason': 'user_quota'}
+        assert admissions[9]['state'] == 'finished'
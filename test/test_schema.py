@@ -0,0 +1,29 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from sqlalchemy import create_engine, inspect
+from models.models import add_missing_columns
+
+
+class TestSchema(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        with self.engine.begin() as conn:
+            # Topics as created before deadlines with time and multi-term topics
+            conn.execute("CREATE TABLE topics (id INTEGER PRIMARY KEY, user_id INTEGER, name VARCHAR, "
+                         "deadline DATE, language VARCHAR)")
+
+    def test_adds_missing_columns(self):
+        added = add_missing_columns(self.engine)
+        assert sorted(added) == ['topics.deadline_at', 'topics.exclude', 'topics.include', 'topics.languages',
+                                 'topics.terms']
+        columns = {column['name']: column for column in inspect(self.engine).get_columns('topics')}
+        assert str(columns['deadline_at']['type']) == 'DATETIME'
+        with self.engine.begin() as conn:
+            conn.execute("INSERT INTO topics (id, name, terms) VALUES (1, 'messi', 'messi,copa')")
+
+    def test_nothing_to_add(self):
+        add_missing_columns(self.engine)
+        assert add_missing_columns(self.engine) == []
@@ -0,0 +1,66 @@
+import sys
+import os
+import json
+import threading
+import subprocess
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from models import sql_models
+from models.sql_models import get_engine, session
+
+ROOT = os.path.dirname(os.path.realpath(__file__)) + "/../"
+
+
+class TestEngine(TestCase):
+
+    def setUp(self):
+        self.saved = (sql_models.DATABASE_URL, sql_models._engine, sql_models._engine_pid)
+        sql_models.DATABASE_URL, sql_models._engine, sql_models._engine_pid = 'sqlite://', None, None
+        session.remove()
+
+    def tearDown(self):
+        session.remove()
+        sql_models.DATABASE_URL, sql_models._engine, sql_models._engine_pid = self.saved
+
+    def test_created_on_first_use(self):
+        assert sql_models._engine is None
+        engine = get_engine()
+        assert get_engine() is engine
+        engines = []
+        thread = threading.Thread(target=lambda: engines.append(get_engine()))
+        thread.start()
+        thread.join()
+        assert engines == [engine]
+        assert session().bind is engine
+
+    def test_new_engine_after_fork(self):
+        parent = get_engine()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child = get_engine()
+                os.write(write, json.dumps({
+                    'new_engine': child is not parent,
+                    'new_pool': child.pool is not parent.pool,
+                    'kept': get_engine() is child,
+                    'inherited': parent in sql_models._inherited_engines,
+                    'session': session().bind is child,
+                }).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            result = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+        assert result == {'new_engine': True, 'new_pool': True, 'kept': True, 'inherited': True, 'session': True}
+        # The parent keeps using its own engine
+        assert get_engine() is parent
+
+    def test_echo_off_by_default(self):
+        env = {key: value for key, value in os.environ.items() if key != 'SQL_ECHO'}
+        env['DATABASE_URL'] = 'sqlite://'
+        probe = "from models.sql_models import get_engine\nprint(get_engine().echo)"
+        output = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                                check=True).stdout
+        assert output.decode().splitlines()[-1] == 'False'
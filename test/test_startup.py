@@ -0,0 +1,38 @@
+import sys
+import os
+import json
+import tempfile
+import subprocess
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+
+ROOT = os.path.dirname(os.path.realpath(__file__)) + "/../"
+STREAMING = ("tweepy", "twitter", "geotext", "botometer", "TwitterFetcher")
+
+
+def imported_after(module, database='sqlite://'):
+    """
+    Modules loaded by importing module in a fresh interpreter, with an empty database
+    """
+    env = dict(os.environ, DATABASE_URL=database, SECRET_KEY='test', TWITTER_CONSUMER_KEY='test',
+               TWITTER_CONSUMER_SECRET='test', TWITTER_ACCESS_TOKEN='test', TWITTER_ACCESS_TOKEN_SECRET='test')
+    probe = f"import sys, json\nimport {module}\nprint(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                            check=True).stdout
+    return set(json.loads(output.decode().splitlines()[-1]))
+
+
+class TestStartup(TestCase):
+
+    def test_api_does_not_load_streaming(self):
+        modules = imported_after("api")
+        assert not modules.intersection(STREAMING)
+
+    def test_api_import_does_not_create_tables(self):
+        database = os.path.join(tempfile.mkdtemp(), 'test.db')
+        imported_after("api", database=f'sqlite:///{database}')
+        assert not os.path.exists(database) or os.path.getsize(database) == 0
+
+    def test_fetcher_defers_geotext_and_botometer(self):
+        modules = imported_after("TwitterFetcher")
+        assert "geotext" not in modules and "botometer" not in modules
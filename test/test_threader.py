@@ -0,0 +1,66 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+import json
+from unittest import TestCase
+import fakeredis
+from Threader import Threader
+
+
+class TestThreader(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.threader = Threader(self.redis)
+
+    def test_add_and_get_thread(self):
+        self._instantiate_threads()
+        assert self.threader.get_thread(1, 10)["process"] == 100
+        assert self.threader.get_thread(1, 12) == "Topic not found"
+        assert len(self.threader.get_threads(1)) == 2
+
+    def test_delete_thread(self):
+        self._instantiate_threads()
+        deleted = self.threader.delete_thread(1, 10)
+        assert deleted["topic"]["id"] == 10
+        assert self.threader.delete_thread(1, 10) is None
+        assert [th["topic"]["id"] for th in self.threader.get_threads(1)] == [11]
+        assert 10 not in self.threader.get_active()
+
+    def test_active_index(self):
+        self._instantiate_threads()
+        active = self.threader.get_active()
+        assert active[10] == 1
+        assert active[20] == 2
+
+    def test_get_threads_by_topics(self):
+        self._instantiate_threads()
+        threads = self.threader.get_threads_by_topics([10, 20, 30])
+        assert sorted(threads.keys()) == [10, 20]
+        assert threads[20]["process"] == 200
+
+    def test_delete_threads(self):
+        self._instantiate_threads()
+        self.threader.delete_threads(1)
+        assert self.threader.get_threads(1) == []
+        active = self.threader.get_active()
+        assert 10 not in active and 11 not in active
+        assert 20 in active
+        assert not self.redis.exists('threads:user:1')
+
+    def test_migrate_old_keys(self):
+        self.redis.hset('threads:1', 10, json.dumps({"process": 100, "topic": {"id": 10}}))
+        self.redis.hset('threads:1', 11, json.dumps({"process": 101, "topic": {"id": 11}}))
+        # Written under the new key since, it is kept
+        self.threader.add_thread(1, {"process": 102, "topic": {"id": 11}})
+        assert self.threader.migrate() == 2
+        assert sorted(th["process"] for th in self.threader.get_threads(1)) == [100, 102]
+        assert self.threader.get_active() == {10: 1, 11: 1}
+        assert not self.redis.exists('threads:1')
+        assert self.threader.migrate() == 0
+
+    def _instantiate_threads(self):
+        self.threader.add_thread(1, {"process": 100, "topic": {"id": 10}})
+        self.threader.add_thread(1, {"process": 101, "topic": {"id": 11}})
+        self.threader.add_thread(2, {"process": 200, "topic": {"id": 20}})
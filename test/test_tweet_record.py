@@ -0,0 +1,48 @@
+import sys
+import os
+import json
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from models.tweet_record import TopicInfo, TweetRecord
+from util.geo import Location, location_keys
+
+TWEET = {"id": 1, "created_at": "Sun Sep 16 00:00:00 +0000 2018", "text": "gol de messi", "lang": "es",
+         "geo": None, "coordinates": None, "place": None, "truncated": False, "retweet_count": 3,
+         "user": {"id": 2, "name": "user", "location": "Rosario", "followers_count": 10, "screen_name": "user"}}
+
+
+def record(tweet=TWEET, info=TopicInfo("messi", 10, 20)):
+    record = TweetRecord(tweet, info, weight=4)
+    record.location = Location('AR', None, None, 'profile')
+    record.location_keys = location_keys(record.location)
+    record.source = "Android"
+    return record
+
+
+class TestTweetRecord(TestCase):
+
+    def test_to_dict(self):
+        assert json.loads(json.dumps(record().to_dict())) == {
+            "id": 1, "created_at": "Sun Sep 16 00:00:00 +0000 2018", "text": "gol de messi", "lang": "es",
+            "geo": None, "coordinates": None, "place": None,
+            "user": {"id": 2, "name": "user", "location": "Rosario"}, "CC": "AR",
+            "location": {"country": "AR", "province": None, "city": None, "source": "profile", "keys": ["AR"]},
+            "social": {"topic": "messi", "topic_id": 10, "user_id": 20, "weight": 4, "cluster": None,
+                       "copy": False},
+            "source": "Android"}
+
+    def test_copies_without_text(self):
+        assert record().to_dict(text=False)["text"] is None
+
+    def test_searched_tweets_have_full_text(self):
+        tweet = dict(TWEET, full_text="gol de messi en la final")
+        del tweet["text"]
+        assert record(tweet).text == "gol de messi en la final"
+
+    def test_slots(self):
+        info = TopicInfo("messi", 10, 20)
+        first, second = record(info=info), record(info=info)
+        assert first.info is second.info
+        assert not hasattr(first, '__dict__')
+        with self.assertRaises(AttributeError):
+            first.retweet_count = 3
@@ -0,0 +1,116 @@
+import sys
+import os
+import time
+import sqlite3
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+from sqlalchemy import create_engine
+from models.tweet_record import TopicInfo, TweetRecord
+from models.tweet_store import TweetStore, TweetWriter
+from util.geo import Location
+
+INFO = TopicInfo("messi", 10, 20)
+
+
+def record(tweet_id, text="gol de messi"):
+    record = TweetRecord({"id": tweet_id, "created_at": "Sun Sep 16 00:00:00 +0000 2018", "text": text,
+                          "lang": "es", "user": {"id": 2, "name": "user", "location": "Rosario"}}, INFO)
+    record.location = Location('AR', None, None, 'profile')
+    record.source = "Android"
+    return record
+
+
+class FakeStore:
+    """
+    Store keeping the batches it was given, failing for the rows in bad or for all while down
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.bad = set()
+        self.down = False
+
+    def copy(self, rows):
+        if self.down:
+            raise ConnectionError("database is down")
+        if any(row[0] in self.bad for row in rows):
+            raise ValueError("invalid row")
+        self.batches.append(rows)
+
+    def rejects(self, error):
+        return isinstance(error, ValueError)
+
+    def stored(self):
+        return sorted(row[0] for batch in self.batches for row in batch)
+
+
+class TestTweetWriter(TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.writer = TweetWriter(self.store, size=10, interval=3600)
+
+    def add(self, *tweet_ids):
+        for tweet_id in tweet_ids:
+            self.writer.add(record(tweet_id))
+
+    def test_buffers_until_flush(self):
+        self.add(1, 2, 3)
+        assert self.writer.pending() == 3 and self.store.batches == []
+        self.writer.flush()
+        assert len(self.store.batches) == 1 and self.store.stored() == [1, 2, 3]
+        assert self.writer.pending() == 0
+
+    def test_flushes_when_full(self):
+        self.add(*range(10))
+        deadline = time.time() + 2
+        while not self.store.batches and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.store.stored() == list(range(10))
+
+    def test_retries_failed_batches(self):
+        self.add(1, 2, 3)
+        self.store.down = True
+        self.writer.flush()
+        assert self.writer.pending() == 3
+        self.store.down = False
+        self.writer.flush()
+        assert self.store.stored() == [1, 2, 3] and self.writer.pending() == 0
+
+    def test_drops_rejected_rows(self):
+        self.add(1, 2, 3, 4, 5)
+        self.store.bad = {2, 5}
+        self.writer.flush()
+        assert self.store.stored() == [1, 3, 4] and self.writer.pending() == 0
+        self.writer.flush()
+        assert self.store.stored() == [1, 3, 4]
+
+    def test_keeps_rows_when_store_fails_while_isolating(self):
+        self.add(1, 2, 3, 4)
+        self.store.bad = {4}
+        copy = self.store.copy
+
+        def reject_then_fail(rows):
+            self.store.copy = self.fail
+            copy(rows)
+
+        self.store.copy = reject_then_fail
+        self.writer.flush()
+        assert self.writer.pending() == 4
+
+    @staticmethod
+    def fail(rows):
+        raise ConnectionError("database is down")
+
+    def test_strips_nul_characters(self):
+        assert TweetWriter.row(record(1, "gol\x00 de messi"))[5] == "gol de messi"
+
+
+class TestTweetStore(TestCase):
+
+    def test_rejects_data_errors(self):
+        store = TweetStore(create_engine('sqlite://'))
+        assert store.rejects(sqlite3.IntegrityError())
+        assert store.rejects(sqlite3.DataError())
+        assert not store.rejects(sqlite3.OperationalError())
+        assert not store.rejects(ConnectionError())
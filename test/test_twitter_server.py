@@ -0,0 +1,123 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from urllib.parse import parse_qsl, urlencode
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../")
+from unittest import TestCase
+import requests
+from tweepy.streaming import StreamListener
+from mock.twitter_server import Scenario, start, stop, self_signed, snowflake_ms, STREAM_PATH, SEARCH_PATH
+
+
+def read_messages(response):
+    """
+    Parses a length delimited stream until the server closes it
+    """
+    messages = []
+    raw = response.raw
+    while True:
+        line = raw.readline()
+        if not line:
+            return messages
+        if line.strip():
+            messages.append(json.loads(raw.read(int(line)).decode()))
+
+
+class TestTwitterServer(TestCase):
+
+    def setUp(self):
+        self.scenario = Scenario(rate=200, limit_every=0.2, keepalive=0.1, disconnect_after=1, search_spacing=10,
+                                 search_history=600, search_limit=5, seed=1)
+        self.twitter, self.servers = start(self.scenario)
+        self.url = f'http://127.0.0.1:{self.servers[0].server_address[1]}'
+
+    def tearDown(self):
+        stop(self.twitter, self.servers)
+
+    def test_stream(self):
+        response = requests.post(f'{self.url}{STREAM_PATH}?delimited=length',
+                                 data={'track': 'messi,copa america', 'language': 'es'}, stream=True)
+        assert response.headers['Transfer-Encoding'] == 'chunked'
+        messages = read_messages(response)
+        tweets = [message for message in messages if 'id' in message]
+        assert 150 <= len(tweets) <= 250
+        assert all('messi' in tweet['text'] or 'copa america' in tweet['text'] for tweet in tweets)
+        assert len({tweet['id'] for tweet in tweets}) == len(tweets)
+        assert any('limit' in message for message in messages)
+        assert 'disconnect' in messages[-1]
+
+    def test_rejected_connections(self):
+        self.scenario.error_rate, self.scenario.error_status = 1, 420
+        response = requests.post(f'{self.url}{STREAM_PATH}', data={'track': 'messi'})
+        assert response.status_code == 420
+        assert self.twitter.stats['rejected'] == 1
+
+    def test_search_pages(self):
+        params = {'q': 'messi OR (copa america)', 'count': 20}
+        ids = []
+        while params is not None:
+            result = requests.get(f'{self.url}{SEARCH_PATH}?{urlencode(params)}').json()
+            ids.extend(tweet['id'] for tweet in result['statuses'])
+            next_results = result['search_metadata'].get('next_results')
+            params = dict(parse_qsl(next_results.lstrip('?'))) if next_results else None
+        # One tweet every 10 seconds over the last 10 minutes
+        assert 60 <= len(ids) <= 61
+        assert ids == sorted(ids, reverse=True)
+        assert self.twitter.stats['searches'] == (len(ids) + 19) // 20
+
+    def test_search_since_id(self):
+        newest = requests.get(f'{self.url}{SEARCH_PATH}?q=messi&count=100').json()['statuses']
+        since_id = newest[5]['id']
+        result = requests.get(f'{self.url}{SEARCH_PATH}?q=messi&count=100&since_id={since_id}').json()
+        assert [tweet['id'] for tweet in result['statuses']] == [tweet['id'] for tweet in newest[:5]]
+        assert all(snowflake_ms(tweet['id']) == int(tweet['timestamp_ms']) for tweet in newest)
+
+    def test_search_rate_limit(self):
+        for _ in range(5):
+            assert requests.get(f'{self.url}{SEARCH_PATH}?q=messi').status_code == 200
+        response = requests.get(f'{self.url}{SEARCH_PATH}?q=messi')
+        assert response.status_code == 429
+        assert response.headers['x-rate-limit-remaining'] == '0'
+        assert int(response.headers['x-rate-limit-reset']) > self.twitter.started_at
+
+
+class NoAuth:
+
+    def apply_auth(self):
+        return None
+
+
+class Listener(StreamListener):
+
+    def __init__(self):
+        super().__init__()
+        self.connections = 0
+        self.tweets = 0
+
+    def on_connect(self):
+        self.connections += 1
+
+    def on_data(self, data):
+        self.tweets += 'created_at' in data
+        return True
+
+
+@unittest.skipUnless(shutil.which('openssl'), "openssl makes the certificate of the stream")
+class TestClosingStream(TestCase):
+
+    def test_returns_when_twitter_closes(self):
+        from TwitterFetcher import ClosingStream
+        directory = tempfile.mkdtemp()
+        cert, key = self_signed(directory)
+        twitter, servers = start(Scenario(rate=100, disconnect_after=0.5), port=None, tls_port=0, cert=cert, key=key)
+        try:
+            listener = Listener()
+            stream = ClosingStream(NoAuth(), listener, host=f'localhost:{servers[0].server_address[1]}', verify=cert)
+            stream.filter(track=['messi'])
+            assert listener.connections == 1 and listener.tweets > 0
+        finally:
+            stop(twitter, servers)
+            shutil.rmtree(directory)
@@ -0,0 +1,57 @@
+import random
+
+
+class Backoff:
+    """
+    Growing delay between retries with jitter above the current step: each delay is
+    drawn between the step and half again, so it never goes under the minimum wait
+    the step stands for, and never over the cap
+    """
+
+    def __init__(self, start, cap, factor=2, increment=0):
+        self.start = start
+        self.cap = cap
+        self.factor = factor
+        self.increment = increment
+        self.step = start
+
+    def next(self):
+        delay = self.step
+        self.step = min(self.step * self.factor + self.increment, self.cap)
+        return min(self.cap, random.uniform(delay, delay * 1.5))
+
+    def reset(self):
+        self.step = self.start
+
+
+class ReconnectPolicy:
+    """
+    Reconnection delays following Twitter's streaming guidelines: network errors back
+    off linearly from 250ms up to 16s, HTTP errors exponentially from 5s up to 320s,
+    and rate limiting (420/429) exponentially from one minute
+    """
+    RATE_LIMITED = (420, 429)
+
+    def __init__(self):
+        self.network = Backoff(0.25, 16, factor=1, increment=0.25)
+        self.http = Backoff(5, 320)
+        self.rate_limit = Backoff(60, 960)
+
+    def delay(self, status=None):
+        """
+        Delay to wait before the next connection attempt
+
+        @param self:
+        @param status: HTTP status of the failure, None for network errors
+        @return: Seconds to wait
+        """
+        if status is None:
+            return self.network.next()
+        if status in ReconnectPolicy.RATE_LIMITED:
+            return self.rate_limit.next()
+        return self.http.next()
+
+    def reset(self):
+        self.network.reset()
+        self.http.reset()
+        self.rate_limit.reset()
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+from settings import app
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a time to live
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedInvalidation:
+    """
+    Shares the deletions of named TTLCaches between processes through a Redis channel.
+    Every process listens on a daemon thread, started on first use, and applies the
+    deletions published by all of them. Until it is subscribed, and whenever it loses
+    Redis, its caches are cleared and left unused, as it may have missed deletions.
+    version changes on every deletion applied, so a value loaded while a deletion
+    arrived is not cached
+    """
+
+    def __init__(self, redis, channel, caches, retry=1):
+        self.redis = redis
+        self.channel = channel
+        self.caches = caches
+        self.retry = retry
+        self.version = 0
+        self.live = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def usable(self):
+        """
+        Whether the caches of this process are up to date with the deletions of the others
+
+        @param self:
+        @return: True while the listener of this process is subscribed
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.live = False
+                    threading.Thread(target=self._listen, name='cache-invalidation', daemon=True).start()
+                    self._pid = os.getpid()
+        return self.live
+
+    def publish(self, deletions):
+        """
+        Deletes keys from the caches of every process
+
+        @param self:
+        @param deletions: List of (cache name, key) pairs, a None key clears the whole cache
+        @return: None
+        """
+        for name, key in deletions:
+            self._delete(name, key)
+        try:
+            self.redis.publish(self.channel, json.dumps(deletions))
+        except RedisError:
+            # Listeners that lost Redis clear their caches when they subscribe again
+            app.logger.warning("Could not publish cache deletions", exc_info=True)
+
+    def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self._reset(True)
+                    elif message['type'] == 'message':
+                        for name, key in json.loads(message['data']):
+                            self._delete(name, tuple(key) if isinstance(key, list) else key)
+            except Exception:
+                # The thread has to outlive any failure, the caches stay unused until it subscribes again
+                app.logger.warning("Lost the cache invalidation channel", exc_info=True)
+            finally:
+                self._reset(False)
+                pubsub.close()
+            time.sleep(self.retry)
+
+    def _reset(self, live):
+        self.live = live
+        self.version += 1
+        for cache in self.caches.values():
+            cache.clear()
+
+    def _delete(self, name, key):
+        self.version += 1
+        if key is None:
+            self.caches[name].clear()
+        else:
+            self.caches[name].delete(key)
@@ -0,0 +1,224 @@
+import re
+import time
+import zlib
+import random
+from array import array
+from collections import OrderedDict
+
+from settings import DEDUP_WINDOW, DEDUP_WINDOW_SECONDS, DEDUP_THRESHOLD, DEDUP_PERMUTATIONS, DEDUP_BANDS, \
+    DEDUP_TRACKED_CLUSTERS, DEDUP_TOP_CLUSTERS, DEDUP_FLUSH_INTERVAL, TWEET_RETENTION_DAYS
+from util.matcher import words
+
+PRIME = (1 << 61) - 1
+SHINGLE_SIZE = 3
+SAMPLE_LENGTH = 140
+RETWEET = re.compile(r'^RT (@\w+: )?')
+URL = re.compile(r'https?://\S+')
+KINDS = ('retweet', 'exact', 'near')
+
+
+def dedup_key(topic_id):
+    return f'dedup:{topic_id}'
+
+
+def clusters_key(topic_id):
+    return f'dedup:{topic_id}:clusters'
+
+
+def tokens(text):
+    # Links are shortened to a different t.co url in every copy
+    return words(URL.sub(' ', RETWEET.sub('', text)))
+
+
+class MinHash:
+    """
+    Signatures of sets of word shingles: the fraction of equal positions in the
+    signatures of two texts estimates the Jaccard similarity of their shingles
+    """
+
+    def __init__(self, permutations=DEDUP_PERMUTATIONS, seed=1):
+        rng = random.Random(seed)
+        self.params = [(rng.randrange(1, PRIME), rng.randrange(PRIME)) for _ in range(permutations)]
+
+    def signature(self, tokens):
+        hashes = {zlib.crc32(' '.join(tokens[i:i + SHINGLE_SIZE]).encode())
+                  for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+        # One row of permuted hashes per shingle, the signature is the minimum of each column. Kept as
+        # 64 bit integers, a tuple of ints takes five times the memory
+        return array('Q', map(min, zip(*[[(a * value + b) % PRIME for a, b in self.params] for value in hashes])))
+
+
+def similarity(signature, other):
+    return sum(x == y for x, y in zip(signature, other)) / len(signature)
+
+
+class Deduplicator:
+    """
+    Groups the tweets of a topic in clusters of copies of the same text. A retweet
+    joins the cluster of its original tweet, a text seen before joins its cluster,
+    and a text similar enough to a recent one (MinHash signatures with LSH banding,
+    so only the texts sharing a band are compared) joins the cluster of that one.
+    Only the DEDUP_WINDOW clusters seen most recently, and not longer ago than
+    DEDUP_WINDOW_SECONDS, are remembered; texts and bands are kept as hashes, two
+    texts with the same hash are taken as copies and candidates of a band are
+    compared by their signatures anyway. Every
+    DEDUP_FLUSH_INTERVAL seconds the counts of copies are added to the dedup:<topic_id>
+    hash and the largest clusters to the dedup:<topic_id>:clusters sorted set
+    """
+
+    def __init__(self, topic_id, redis, window=DEDUP_WINDOW, threshold=DEDUP_THRESHOLD, minhash=None,
+                 bands=DEDUP_BANDS, tracked=DEDUP_TRACKED_CLUSTERS, interval=DEDUP_FLUSH_INTERVAL,
+                 window_seconds=DEDUP_WINDOW_SECONDS):
+        self.topic_id = topic_id
+        self.redis = redis
+        self.window = window
+        self.window_seconds = window_seconds
+        self.threshold = threshold
+        self.minhash = minhash or MinHash()
+        self.bands = bands
+        self.rows = len(self.minhash.params) // bands
+        self.tracked = tracked
+        self.interval = interval
+        self._flush_at = time.time() + interval
+        # Cluster id to the hash of its text, its signature, a sample of its text and when it was last seen
+        self._clusters = OrderedDict()
+        self._texts = {}
+        self._buckets = {}
+        self._counts = dict.fromkeys(('tweets', 'unique') + KINDS, 0)
+        # Cluster id to its copies since the last flush and its sample
+        self._copies = {}
+
+    def cluster(self, tweet, text, weight=1):
+        """
+        Finds the cluster of a tweet, starting a new one if it is not a copy
+
+        @param self:
+        @param tweet: Raw tweet object
+        @param text: Full text of the tweet
+        @param weight: Amount of tweets this one stands for
+        @return: Tuple of the cluster id and whether the tweet is a copy
+        """
+        now = time.time()
+        if now >= self._flush_at:
+            self.flush()
+        self._counts['tweets'] += weight
+        original = tweet.get('retweeted_status')
+        cluster_id = original['id'] if original else tweet['id']
+        kind = 'retweet' if cluster_id in self._clusters else None
+        if kind is None:
+            text_tokens = tokens(text)
+            key = hash(' '.join(text_tokens)) if text_tokens else None
+            signature = None
+            if key is not None and key in self._texts:
+                cluster_id, kind = self._texts[key], 'exact'
+            elif len(text_tokens) >= SHINGLE_SIZE:
+                signature = self.minhash.signature(text_tokens)
+                similar = self._similar(signature)
+                if similar is not None:
+                    cluster_id, kind = similar, 'near'
+        if kind is None:
+            self._counts['unique'] += weight
+            self._add(cluster_id, key, signature, text, now)
+            return cluster_id, False
+        self._counts[kind] += weight
+        entry = self._clusters[cluster_id]
+        self._clusters[cluster_id] = entry[:3] + (now,)
+        self._clusters.move_to_end(cluster_id)
+        copies = self._copies.get(cluster_id)
+        if copies is None:
+            copies = self._copies[cluster_id] = [0, entry[2]]
+        copies[0] += weight
+        return cluster_id, True
+
+    def _bands(self, signature):
+        data, width = signature.tobytes(), self.rows * signature.itemsize
+        return [hash((band, data[band * width:(band + 1) * width])) for band in range(self.bands)]
+
+    def _similar(self, signature):
+        best, best_similarity = None, self.threshold
+        for band in self._bands(signature):
+            candidate = self._buckets.get(band)
+            if candidate is None:
+                continue
+            candidate_similarity = similarity(signature, self._clusters[candidate][1])
+            if candidate_similarity >= best_similarity:
+                best, best_similarity = candidate, candidate_similarity
+        return best
+
+    def _add(self, cluster_id, key, signature, text, now):
+        self._clusters[cluster_id] = (key, signature, RETWEET.sub('', text)[:SAMPLE_LENGTH], now)
+        if key is not None:
+            self._texts[key] = cluster_id
+        if signature is not None:
+            for band in self._bands(signature):
+                self._buckets[band] = cluster_id
+        oldest = now - self.window_seconds
+        while self._clusters:
+            evicted, (key, signature, _, seen) = next(iter(self._clusters.items()))
+            if len(self._clusters) <= self.window and seen >= oldest:
+                break
+            del self._clusters[evicted]
+            if self._texts.get(key) == evicted:
+                del self._texts[key]
+            if signature is not None:
+                for band in self._bands(signature):
+                    if self._buckets.get(band) == evicted:
+                        del self._buckets[band]
+
+    def flush(self):
+        """
+        Adds the counts since the last flush to the totals of the topic and the copies
+        to the sizes of their clusters, keeping the DEDUP_TRACKED_CLUSTERS largest
+
+        @param self:
+        @return: None
+        """
+        self._flush_at = time.time() + self.interval
+        if not self._counts['tweets']:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        key = dedup_key(self.topic_id)
+        for field, value in self._counts.items():
+            if value:
+                pipe.hincrby(key, field, value)
+        clusters = clusters_key(self.topic_id)
+        for cluster_id, (copies, sample) in self._copies.items():
+            # Arguments of ZINCRBY are in a different order in each version of redis-py
+            pipe.execute_command('ZINCRBY', clusters, copies, f'{cluster_id}\t{sample}')
+        if self._copies:
+            pipe.zremrangebyrank(clusters, 0, -self.tracked - 1)
+        for name in (key, clusters):
+            pipe.expire(name, TWEET_RETENTION_DAYS * 86400)
+        pipe.execute()
+        self._counts = dict.fromkeys(self._counts, 0)
+        self._copies = {}
+
+
+def dedup_stats(redis, topic_ids, top=DEDUP_TOP_CLUSTERS):
+    """
+    Copies found in the tweets of many topics, with their largest clusters
+
+    @param redis: Redis connection
+    @param topic_ids: List of topic ids
+    @param top: Amount of clusters to include
+    @return: Dict from topic id to its counts and largest clusters
+    """
+    pipe = redis.pipeline(transaction=False)
+    for topic_id in topic_ids:
+        pipe.hgetall(dedup_key(topic_id))
+        pipe.zrevrange(clusters_key(topic_id), 0, top - 1, withscores=True)
+    replies = pipe.execute()
+    stats = {}
+    for topic_id, fields, clusters in zip(topic_ids, replies[::2], replies[1::2]):
+        counts = {field.decode(): int(value) for field, value in fields.items()}
+        tweets = counts.get('tweets', 0)
+        copies = sum(counts.get(kind, 0) for kind in KINDS)
+        top_clusters = []
+        for member, score in clusters:
+            cluster_id, sample = member.decode().split('\t', 1)
+            # The original counts as one more tweet of its cluster
+            top_clusters.append({'id': cluster_id, 'tweets': int(score) + 1, 'text': sample})
+        stats[topic_id] = {'tweets': tweets, 'unique': counts.get('unique', 0), 'copies': copies,
+                           'ratio': copies / tweets if tweets else 0.0,
+                           'by': {kind: counts.get(kind, 0) for kind in KINDS}, 'clusters': top_clusters}
+    return stats
@@ -0,0 +1,63 @@
+import io
+import csv
+import json
+import zlib
+import datetime
+
+from settings import EXPORT_CHUNK_SIZE
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _plain(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def encode(columns, rows, format='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Encodes rows lazily, so only one chunk is kept in memory at a time
+
+    @param columns: Names of the values of each row
+    @param rows: Iterable of tuples with the values of columns
+    @param format: One of FORMATS, CSV starts with a header
+    @param chunk_size: Bytes to gather before yielding them
+    @return: Generator of bytes
+    """
+    buffer = io.StringIO()
+    if format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        def write(row):
+            writer.writerow([_plain(value) for value in row])
+    else:
+        def write(row):
+            buffer.write(json.dumps({column: _plain(value) for column, value in zip(columns, row)},
+                                    ensure_ascii=False))
+            buffer.write('\n')
+    for row in rows:
+        write(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def gzipped(chunks, level=6):
+    """
+    Compresses a stream of chunks as a single gzip member
+
+    @param chunks: Iterable of bytes
+    @param level: Compression level
+    @return: Generator of bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
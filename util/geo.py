@@ -0,0 +1,190 @@
+import os
+import math
+import threading
+import functools
+import importlib.util
+from collections import namedtuple
+
+from settings import GEO_MAX_DISTANCE_KM, GEO_CITY_DISTANCE_KM
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+CELL_DEGREES = 1
+SEPARATOR = '/'
+# Sections of cities and abandoned, destroyed or historical places
+SKIPPED_FEATURES = {'PPLX', 'PPLQ', 'PPLW', 'PPLH'}
+UNKNOWN = 'UN'
+
+Location = namedtuple('Location', 'country province city source')
+
+
+@functools.lru_cache(maxsize=4096)
+def location_keys(location):
+    """
+    Keys of the location results a tweet counts for, from the country down to its city.
+    Cities of an unknown province go under an empty one, so every level keeps its depth.
+    Cached, so the tweets of the same place share their keys
+
+    @param location: Location of the tweet
+    @return: Tuple like ('AR', 'AR/Buenos Aires', 'AR/Buenos Aires/Palermo') or ('AR', 'AR//Rosario')
+    """
+    keys = [location.country]
+    if location.country != UNKNOWN:
+        province = (location.province or '').replace(SEPARATOR, ' ')
+        if province:
+            keys.append(location.country + SEPARATOR + province)
+        if location.city:
+            keys.append(location.country + SEPARATOR + province + SEPARATOR + location.city.replace(SEPARATOR, ' '))
+    return tuple(keys)
+
+
+class TownIndex:
+    """
+    Towns of 15000 or more inhabitants of GeoNames (the cities15000 table that comes with
+    geotext) bucketed in cells of CELL_DEGREES. The country of a point is the one of the
+    nearest town, and only the towns of the cells around the point are measured
+    """
+
+    def __init__(self, towns):
+        self._cells = {}
+        for town in towns:
+            self._cells.setdefault(self._cell(town[0], town[1]), []).append(town)
+
+    @staticmethod
+    def _cell(lat, lon):
+        return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lon / CELL_DEGREES))
+
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            # Found without importing geotext, which parses all of its tables on import
+            package = os.path.dirname(importlib.util.find_spec('geotext').origin)
+            path = os.path.join(package, 'data', 'cities15000.txt')
+        towns = []
+        with open(path, encoding='utf-8') as table:
+            for line in table:
+                columns = line.split('\t')
+                if columns[7] in SKIPPED_FEATURES:
+                    continue
+                towns.append((float(columns[4]), float(columns[5]), columns[8], columns[1]))
+        return cls(towns)
+
+    def nearest(self, lat, lon, max_distance=GEO_MAX_DISTANCE_KM):
+        """
+        Nearest town to a point
+
+        @param self:
+        @param lat: Latitude of the point
+        @param lon: Longitude of the point
+        @param max_distance: Kilometers beyond which towns are not considered
+        @return: Tuple of the town (lat, lon, country code, name) and its distance in km, None if none is close
+        """
+        cos_lat = math.cos(math.radians(lat))
+        rows = int(math.ceil(max_distance / (KM_PER_DEGREE * CELL_DEGREES)))
+        columns = min(int(math.ceil(max_distance / (KM_PER_DEGREE * CELL_DEGREES * max(cos_lat, 0.01)))),
+                      180 // CELL_DEGREES)
+        row, column = self._cell(lat, lon)
+        best, best_distance = None, max_distance
+        for cell_row in range(row - rows, row + rows + 1):
+            for cell_column in range(column - columns, column + columns + 1):
+                # Cells wrap around the antimeridian
+                cell = (cell_row, (cell_column + 180 // CELL_DEGREES) % (360 // CELL_DEGREES) - 180 // CELL_DEGREES)
+                for town in self._cells.get(cell, ()):
+                    distance = self.distance(lat, lon, town[0], town[1])
+                    if distance <= best_distance:
+                        best, best_distance = town, distance
+        return (best, best_distance) if best is not None else None
+
+    @staticmethod
+    def distance(lat, lon, other_lat, other_lon):
+        # Equirectangular approximation, precise enough at the distances compared
+        x = math.radians((other_lon - lon + 180) % 360 - 180) * math.cos(math.radians((lat + other_lat) / 2))
+        y = math.radians(other_lat - lat)
+        return EARTH_RADIUS_KM * math.hypot(x, y)
+
+
+_towns = None
+_towns_lock = threading.Lock()
+
+
+def towns():
+    """
+    Index of towns shared by every fetcher of the process, loaded the first time a tweet has coordinates
+    """
+    global _towns
+    if _towns is None:
+        with _towns_lock:
+            if _towns is None:
+                _towns = TownIndex.load()
+    return _towns
+
+
+_profiles = {}
+
+
+def from_profile(country):
+    """
+    Location of a tweet found from the profile of its user, one per country for every tweet
+    """
+    location = _profiles.get(country)
+    if location is None:
+        location = _profiles.setdefault(country, Location(country, None, None, 'profile'))
+    return location
+
+
+def from_place(place):
+    """
+    Location of the place Twitter tags a tweet with. The full name of a city is
+    'City, Province' or 'City, Country', the one of a neighborhood 'Neighborhood, City'
+    """
+    country = (place.get('country_code') or '').upper()
+    if not country:
+        return None
+    place_type, name = place.get('place_type'), place.get('name')
+    parent = (place.get('full_name') or '').rpartition(', ')[2] or None
+    if parent == place.get('country') or parent == name:
+        parent = None
+    if place_type == 'city':
+        return Location(country, parent, name, 'place')
+    if place_type == 'neighborhood':
+        return Location(country, None, parent, 'place')
+    if place_type == 'admin':
+        return Location(country, name, None, 'place')
+    return Location(country, None, None, 'place')
+
+
+def from_coordinates(lat, lon, index=None):
+    """
+    Location of a point, with the city when a town is within GEO_CITY_DISTANCE_KM
+    """
+    nearest = (index or towns()).nearest(lat, lon)
+    if nearest is None:
+        return None
+    (_, _, country, name), distance = nearest
+    return Location(country, None, name if distance <= GEO_CITY_DISTANCE_KM else None, 'coordinates')
+
+
+def locate(tweet, index=None):
+    """
+    Exact location of a tweet: the country of its place, or else the country of its
+    coordinates. Tweets with neither are left to the location of the profile of the user
+
+    @param tweet: Raw tweet object
+    @param index: TownIndex to look up coordinates in, the shared one by default
+    @return: Location or None
+    """
+    place = tweet.get('place')
+    if place:
+        location = from_place(place)
+        if location is not None:
+            return location
+    coordinates = tweet.get('coordinates')
+    if coordinates and coordinates.get('coordinates'):
+        lon, lat = coordinates['coordinates'][:2]
+        return from_coordinates(lat, lon, index)
+    geo = tweet.get('geo')
+    if geo and geo.get('coordinates'):
+        # Deprecated field, with latitude first
+        lat, lon = geo['coordinates'][:2]
+        return from_coordinates(lat, lon, index)
+    return None
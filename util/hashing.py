@@ -0,0 +1,75 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from passlib.hash import bcrypt
+
+from settings import BCRYPT_ROUNDS, HASH_WORKERS, HASH_QUEUE_LIMIT, HASH_TIMEOUT
+
+
+class HasherOverloaded(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a pool of workers threads, off the request threads. Up to queue_limit
+    hashes wait for a free worker, for at most timeout seconds; when that many are
+    already waiting, or the wait runs out, callers get HasherOverloaded instead of
+    tying up their request thread
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT, rounds=BCRYPT_ROUNDS, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.rounds = rounds
+        self.timeout = timeout
+        self.bcrypt = bcrypt.using(rounds=rounds)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        # Hashes running plus waiting, taken before submitting so the executor queue never grows past it
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def hash(self, password):
+        return self._run(self.bcrypt.hash, password)
+
+    def verify(self, password, hashed):
+        return self._run(self.bcrypt.verify, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """
+        Whether a hash was made with a different cost than the configured one
+        """
+        return self.bcrypt.needs_update(hashed)
+
+    def measure(self):
+        """
+        Time taken by one hash with the configured cost, to tune BCRYPT_ROUNDS
+
+        @param self:
+        @return: Seconds taken to hash a password
+        """
+        start = time.perf_counter()
+        self.hash("measure")
+        return time.perf_counter() - start
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherOverloaded()
+        started = threading.Event()
+
+        def call():
+            started.set()
+            return function(*args)
+
+        try:
+            future = self._executor.submit(call)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # A hash that got a worker is waited for, one still queued is dropped when the wait runs out
+        if not started.wait(self.timeout) and future.cancel():
+            raise HasherOverloaded()
+        return future.result()
+
+
+hasher = PasswordHasher()
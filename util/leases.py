@@ -0,0 +1,146 @@
+import math
+import time
+import random
+
+from settings import FETCHER_LEASE_TTL
+
+NODES = 'fetcher:nodes'
+
+# KEYS: leases of the topics. ARGV: node, ttl in ms
+# Extends the leases held by the node, returns 1 for each one extended and 0 for each one lost
+RENEW = """
+local renewed = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+        renewed[i] = 1
+    else
+        renewed[i] = 0
+    end
+end
+return renewed
+"""
+
+# KEYS: lease of a topic. ARGV: node, ttl in ms
+# Takes the lease when it is free or already held by the node
+CLAIM = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+# KEYS: lease of a topic. ARGV: node
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lease_key(topic_id):
+    return f'fetcher:lease:{topic_id}'
+
+
+def live_nodes(redis):
+    """
+    Nodes that sent a heartbeat within the ttl of the leases
+
+    @param redis: Redis connection
+    @return: List of node ids
+    """
+    return [node.decode() for node in redis.zrangebyscore(NODES, int(time.time() * 1000), '+inf')]
+
+
+def owners(redis, topic_ids):
+    """
+    Node holding the lease of each topic
+
+    @param redis: Redis connection
+    @param topic_ids: List of topic ids
+    @return: Dict from topic id to its node, None for the topics nobody holds
+    """
+    if not topic_ids:
+        return {}
+    nodes = redis.mget([lease_key(topic_id) for topic_id in topic_ids])
+    return {topic_id: node.decode() if node is not None else None for topic_id, node in zip(topic_ids, nodes)}
+
+
+def rebalance(node, nodes, topic_owners, shuffle=random.shuffle):
+    """
+    Topics a node should give up and take so that every live node holds at most
+    its fair share, the topics over the amount of nodes rounded up. Nodes only
+    release topics when they hold more than their share, so leases do not move
+    back and forth between nodes with the same load
+
+    @param node: Id of the node
+    @param nodes: Ids of the live nodes
+    @param topic_owners: Dict from the id of every topic to run to the node holding it, or None
+    @param shuffle: Shuffles the free topics in place, so nodes do not race for the same ones
+    @return: Tuple of the list of topic ids to claim and the list to release
+    """
+    share = math.ceil(len(topic_owners) / len(set(nodes) | {node})) if topic_owners else 0
+    held = sorted(topic_id for topic_id, owner in topic_owners.items() if owner == node)
+    release = held[share:]
+    free = [topic_id for topic_id, owner in topic_owners.items() if owner is None]
+    shuffle(free)
+    return free[:max(share - len(held) + len(release), 0)], release
+
+
+class LeaseManager:
+    """
+    Leases of the topics run by one fetcher node. A node holds a topic while it keeps
+    renewing its fetcher:lease:<topic_id> key, which expires FETCHER_LEASE_TTL seconds
+    after the last renewal, so the topics of a node that dies are free to be claimed
+    by the others. Live nodes are kept in the fetcher:nodes sorted set, scored by the
+    time their heartbeat expires
+    """
+
+    def __init__(self, redis, node, ttl=FETCHER_LEASE_TTL):
+        self.redis = redis
+        self.node = node
+        self.ttl = ttl
+        self._renew = redis.register_script(RENEW)
+        self._claim = redis.register_script(CLAIM)
+        self._release = redis.register_script(RELEASE)
+
+    def heartbeat(self):
+        now = int(time.time() * 1000)
+        pipe = self.redis.pipeline()
+        # Arguments of ZADD are in a different order in each version of redis-py
+        pipe.execute_command('ZADD', NODES, now + self.ttl * 1000, self.node)
+        pipe.zremrangebyscore(NODES, '-inf', now)
+        pipe.execute()
+
+    def leave(self):
+        self.redis.zrem(NODES, self.node)
+
+    def nodes(self):
+        return live_nodes(self.redis)
+
+    def owners(self, topic_ids):
+        return owners(self.redis, topic_ids)
+
+    def renew(self, topic_ids):
+        """
+        Extends the leases of the topics run by this node
+
+        @param self:
+        @param topic_ids: List of topic ids
+        @return: Set of the topic ids whose lease was lost to another node or expired
+        """
+        topic_ids = list(topic_ids)
+        if not topic_ids:
+            return set()
+        renewed = self._renew(keys=[lease_key(topic_id) for topic_id in topic_ids],
+                              args=[self.node, self.ttl * 1000])
+        return {topic_id for topic_id, kept in zip(topic_ids, renewed) if not kept}
+
+    def claim(self, topic_id):
+        return bool(self._claim(keys=[lease_key(topic_id)], args=[self.node, self.ttl * 1000]))
+
+    def release(self, topic_id):
+        return bool(self._release(keys=[lease_key(topic_id)], args=[self.node]))
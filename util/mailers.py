@@ -1,16 +1,108 @@
 import os
+import time
+import queue
+import smtplib
+import threading
 from flask_mail import Mail, Message
-from settings import app
+from settings import app, MAIL_BATCH_SIZE, MAIL_BATCH_WAIT, MAIL_RETRIES
+from util.backoff import Backoff
+
+# Failures of one message that leave the connection usable, smtplib resets the transaction after them
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class MailQueue:
+    """
+    Sends emails from a background thread. Messages are taken in batches of up to
+    batch_size, each batch is sent over a single SMTP connection and retried with
+    backoff when the server fails
+    """
+
+    def __init__(self, app, batch_size=MAIL_BATCH_SIZE, batch_wait=MAIL_BATCH_WAIT, retries=MAIL_RETRIES):
+        self.app = app
+        self.mail = Mail(app)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retries = retries
+        self.queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, message):
+        self._ensure_thread()
+        self.queue.put(message)
+
+    def join(self):
+        self.queue.join()
+
+    def _ensure_thread(self):
+        # uWSGI forks its workers after importing the app, so each process starts its own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            size = len(batch)
+            self._send(batch)
+            for _ in range(size):
+                self.queue.task_done()
+
+    def _send(self, batch):
+        """
+        Sends a batch over one connection. A message the server refuses, or that cannot
+        be built, is dropped and the rest go on over the same connection; when the
+        connection fails only the messages not sent yet are retried
+
+        @param self:
+        @param batch: List of flask_mail Messages
+        @return: None
+        """
+        backoff = Backoff(1, 60)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.app.app_context(), self.mail.connect() as connection:
+                    while batch:
+                        self._send_one(connection, batch[0])
+                        batch.pop(0)
+                return
+            except Exception:
+                self.app.logger.exception("Could not send %s emails (attempt %s)", len(batch), attempt + 1)
+                if attempt < self.retries:
+                    time.sleep(backoff.next())
+        self.app.logger.error("Dropped %s emails to %s", len(batch), [m.recipients for m in batch])
+
+    def _send_one(self, connection, message):
+        try:
+            connection.send(message)
+        except Exception as error:
+            # Any other socket or SMTP error is the connection's, the batch is retried
+            if isinstance(error, OSError) and not isinstance(error, MESSAGE_ERRORS):
+                raise
+            self.app.logger.exception("Dropped email to %s", message.recipients)
+
+
+mail_queue = MailQueue(app)
 
 
 class ResetPasswordMailer:
 
     @classmethod
     def send_email(cls, email, subject, html):
-        mail = Mail(app)
-        with app.app_context():
-            msg = Message(subject=subject,
-                          sender=os.getenv("MAIL_USERNAME"),
-                          recipients=[email],
-                          html=html)
-            mail.send(msg)
+        msg = Message(subject=subject,
+                      sender=os.getenv("MAIL_USERNAME"),
+                      recipients=[email],
+                      html=html)
+        mail_queue.enqueue(msg)
@@ -0,0 +1,272 @@
+import re
+import unicodedata
+from collections import deque
+
+WORD = re.compile(r'\w+')
+TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+MAX_TERMS = 400
+MAX_TERM_LENGTH = 60
+
+
+class QueryError(ValueError):
+    pass
+
+
+def words(text):
+    """
+    Lower case words of a text without accents, so "Atlético" matches "atletico" and "#Messi" matches "messi"
+
+    @param text: Text to split
+    @return: List of words
+    """
+    text = text.lower()
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return WORD.findall(text)
+
+
+def tweet_text(tweet):
+    """
+    Full text of a tweet, including the text of the tweets it retweets or quotes
+    """
+    if "extended_tweet" in tweet:
+        texts = [tweet["extended_tweet"]["full_text"]]
+    else:
+        texts = [tweet.get("full_text") or tweet.get("text") or ""]
+    for key in ("retweeted_status", "quoted_status"):
+        if key in tweet:
+            texts.append(tweet_text(tweet[key]))
+    return ' '.join(texts)
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton over words: finds every phrase contained in a list of
+    words in a single pass over it, however many phrases there are
+    """
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        output = [set()]
+        for index, phrase in enumerate(phrases):
+            state = 0
+            for word in phrase:
+                following = self.goto[state].get(word)
+                if following is None:
+                    following = self.goto[state][word] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    output.append(set())
+                state = following
+            output[state].add(index)
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for word, following in self.goto[state].items():
+                pending.append(following)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(word, 0)
+                output[following] |= output[self.fail[following]]
+        self.output = [frozenset(found) for found in output]
+
+    def find(self, text):
+        """
+        Indexes of the phrases contained in text
+
+        @param self:
+        @param text: List of words
+        @return: Set of phrase indexes
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for word in text:
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class Phrase:
+    def __init__(self, index):
+        self.index = index
+
+    def evaluate(self, found):
+        return self.index in found
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, found):
+        return not self.operand.evaluate(found)
+
+
+class And:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def evaluate(self, found):
+        return all(operand.evaluate(found) for operand in self.operands)
+
+
+class Or:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def evaluate(self, found):
+        return any(operand.evaluate(found) for operand in self.operands)
+
+
+class Parser:
+    """
+    Parses boolean expressions of words and "quoted phrases" with AND, OR, NOT, a
+    leading - as NOT and parentheses. Words next to each other are joined with AND:
+
+        messi ("copa america" OR mundial) -fake
+    """
+
+    def __init__(self, phrases):
+        self.phrases = phrases
+
+    def parse(self, expression):
+        """
+        Builds the tree of an expression, adding its phrases to self.phrases
+
+        @param self:
+        @param expression: Expression to parse
+        @return: Root node of the expression
+        """
+        self.tokens = self._tokenize(expression)
+        self.position = 0
+        node = self._or()
+        if self.position < len(self.tokens):
+            raise QueryError(f"Unexpected {self.tokens[self.position][1]!r} in {expression!r}")
+        return node
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = TOKEN.match(expression, position)
+            if match is None:
+                raise QueryError(f"Unbalanced quotes in {expression!r}")
+            position = match.end()
+            opening, closing, quoted, word = match.groups()
+            if opening or closing:
+                tokens.append(('paren', opening or closing))
+            elif quoted is not None:
+                tokens.append(('phrase', quoted))
+            elif word.upper() in ('AND', 'OR', 'NOT'):
+                tokens.append((word.upper(), word))
+            elif word.startswith('-') and len(word) > 1:
+                tokens.extend((('NOT', '-'), ('phrase', word[1:])))
+            else:
+                tokens.append(('phrase', word))
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _or(self):
+        operands = [self._and()]
+        while self._peek()[0] == 'OR':
+            self.position += 1
+            operands.append(self._and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def _and(self):
+        operands = [self._not()]
+        while self._peek()[0] in ('AND', 'NOT', 'phrase') or self._peek() == ('paren', '('):
+            if self._peek()[0] == 'AND':
+                self.position += 1
+            operands.append(self._not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def _not(self):
+        if self._peek()[0] == 'NOT':
+            self.position += 1
+            return Not(self._not())
+        return self._atom()
+
+    def _atom(self):
+        kind, value = self._peek()
+        self.position += 1
+        if (kind, value) == ('paren', '('):
+            node = self._or()
+            if self._peek() != ('paren', ')'):
+                raise QueryError("Missing closing parenthesis")
+            self.position += 1
+            return node
+        if kind != 'phrase':
+            raise QueryError(f"Expected a word or phrase, found {value!r}")
+        phrase = tuple(words(value))
+        if not phrase:
+            raise QueryError(f"{value!r} has no words to match")
+        return Phrase(self.phrases.setdefault(phrase, len(self.phrases)))
+
+
+class TopicMatcher:
+    """
+    Local filter of the tweets of a topic, applied to what the Twitter Stream sends
+    for its track terms. A tweet matches when it is in one of the languages, its
+    text matches the include expression and does not match the exclude expression.
+    Both expressions are compiled into a single automaton
+    """
+
+    def __init__(self, include=None, exclude=None, languages=None):
+        phrases = {}
+        parser = Parser(phrases)
+        self.include = parser.parse(include) if include else None
+        self.exclude = parser.parse(exclude) if exclude else None
+        self.languages = frozenset(languages) if languages else None
+        self.automaton = Automaton(list(phrases))
+
+    @classmethod
+    def from_topic(cls, topic):
+        return cls(topic.get("include"), topic.get("exclude"), topic.get("languages"))
+
+    def matches(self, tweet):
+        if self.languages is not None and tweet.get("lang") not in self.languages:
+            return False
+        if self.include is None and self.exclude is None:
+            return True
+        found = self.automaton.find(words(tweet_text(tweet)))
+        if self.include is not None and not self.include.evaluate(found):
+            return False
+        return self.exclude is None or not self.exclude.evaluate(found)
+
+
+def validate_terms(terms):
+    """
+    Checks track terms against the limits of the Twitter Stream
+
+    @param terms: List of phrases to track
+    @return: List of the stripped terms
+    """
+    if not isinstance(terms, list) or not all(isinstance(term, str) for term in terms):
+        raise QueryError("Terms must be a list of strings")
+    terms = [term.strip() for term in terms]
+    if not terms or len(terms) > MAX_TERMS:
+        raise QueryError(f"Between 1 and {MAX_TERMS} terms are needed")
+    for term in terms:
+        if not term or ',' in term or len(term.encode()) > MAX_TERM_LENGTH:
+            raise QueryError(f"Invalid term {term!r}, terms have up to {MAX_TERM_LENGTH} bytes and no commas")
+    return terms
+
+
+def search_query(terms):
+    """
+    Search API query for tweets matching any of the track terms, whose words must all appear
+    """
+    return ' OR '.join(f'({term})' if ' ' in term else term for term in terms)
@@ -0,0 +1,226 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from redis import StrictRedis
+
+from settings import REDIS_HOST, REDIS_PORT, METRICS_FLUSH_INTERVAL, FETCHER_NODE_ID, app
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTERS = 'metrics:counters'
+HISTOGRAMS = 'metrics:histograms'
+TYPES = 'metrics:types'
+GAUGES = 'metrics:gauges'
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    values = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{values}}}'
+
+
+def has_labels(key, labels):
+    """
+    Whether a series has all the given labels
+
+    @param key: Series name, as made by series
+    @param labels: Dict of labels
+    @return: True when every label is in the series with the same value
+    """
+    if '{' not in key:
+        return not labels
+    pairs = set(key[key.index('{') + 1:-1].split(','))
+    return all(f'{name}="{value}"' in pairs for name, value in labels.items())
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms kept in memory by each process and added to
+    Redis hashes every METRICS_FLUSH_INTERVAL seconds, so every API and fetcher
+    process reports to the same totals. Hash fields are Prometheus series names.
+    Series of things that end, like topics, are removed with forget. Gauges are kept
+    per process, under the node and the pid as pids repeat between containers, and
+    expire when the process stops flushing them
+    """
+
+    def __init__(self, redis=None, interval=METRICS_FLUSH_INTERVAL, node=FETCHER_NODE_ID):
+        self.redis = redis
+        self.interval = interval
+        self.node = node
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+        self._types = {}
+        self._forgotten = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def inc(self, name, value=1, **labels):
+        self._ensure_thread()
+        key = series(name, labels)
+        with self._lock:
+            self._types[name] = 'counter'
+            self._counters[key] += value
+
+    def gauge(self, name, value, **labels):
+        self._ensure_thread()
+        with self._lock:
+            self._types[name] = 'gauge'
+            self._gauges[series(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        self._ensure_thread()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types[name] = 'histogram'
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def forget(self, **labels):
+        """
+        Drops the series with the given labels, like the ones of a finished topic. They are
+        removed from this process now and from the totals in Redis on the next flush, after
+        what the process still had to add
+
+        @param self:
+        @param labels: Labels the series to drop have
+        @return: None
+        """
+        self._ensure_thread()
+        with self._lock:
+            self._forgotten.append(labels)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def flush(self):
+        """
+        Adds what was measured since the last flush to the totals in Redis
+
+        @param self:
+        @return: None
+        """
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(float)
+            histograms, self._histograms = self._histograms, {}
+            forgotten, self._forgotten = self._forgotten, []
+            for labels in forgotten:
+                for key in [key for key in self._gauges if has_labels(key, labels)]:
+                    del self._gauges[key]
+            gauges, types = dict(self._gauges), dict(self._types)
+        if not (counters or histograms or gauges or forgotten):
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        if types:
+            pipe.hmset(TYPES, types)
+        for key, value in counters.items():
+            pipe.hincrbyfloat(COUNTERS, key, value)
+        for (name, labels), histogram in histograms.items():
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                if cumulative:
+                    pipe.hincrby(HISTOGRAMS, series(f'{name}_bucket', dict(labels, le=bound)), cumulative)
+            pipe.hincrby(HISTOGRAMS, series(f'{name}_count', labels), cumulative)
+            pipe.hincrbyfloat(HISTOGRAMS, series(f'{name}_sum', labels), histogram[-1])
+        if gauges:
+            key = self._gauges_key()
+            pipe.hmset(key, gauges)
+            pipe.expire(key, int(self.interval * 3) + 1)
+        pipe.execute()
+        for labels in forgotten:
+            self._delete(labels)
+
+    def _gauges_key(self):
+        return f'{GAUGES}:{self.node}:{os.getpid()}'
+
+    def _delete(self, labels):
+        # Labels are sorted in series names, the pattern only narrows the scan
+        pattern = '*' + '*'.join(f'{name}="{value}"' for name, value in sorted(labels.items())) + '*'
+        for key in (COUNTERS, HISTOGRAMS, self._gauges_key()):
+            fields = [field for field, value in self.redis.hscan_iter(key, match=pattern)
+                      if has_labels(field.decode(), labels)]
+            if fields:
+                self.redis.hdel(key, *fields)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+                self._counters, self._histograms, self._gauges = defaultdict(float), {}, {}
+                threading.Thread(target=self._run, name='metrics', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Could not flush metrics")
+
+
+def render(redis):
+    """
+    Renders the totals of every process in Prometheus text format. Gauges of
+    different processes are added up
+
+    @param redis: Redis connection
+    @return: String in Prometheus text exposition format
+    """
+    types = {name.decode(): kind.decode() for name, kind in redis.hgetall(TYPES).items()}
+    values = defaultdict(float)
+    for key in (COUNTERS, HISTOGRAMS):
+        for field, value in redis.hgetall(key).items():
+            values[field.decode()] = float(value)
+    for key in redis.scan_iter(f'{GAUGES}:*'):
+        for field, value in redis.hgetall(key).items():
+            values[field.decode()] += float(value)
+    families = defaultdict(list)
+    for field, value in values.items():
+        name = field.split('{')[0]
+        for suffix in ('_bucket', '_count', '_sum'):
+            if name.endswith(suffix) and types.get(name[:-len(suffix)]) == 'histogram':
+                name = name[:-len(suffix)]
+        families[name].append(f'{field} {int(value) if value.is_integer() else value}')
+    lines = []
+    for name in sorted(families):
+        lines.append(f'# TYPE {name} {types.get(name, "untyped")}')
+        lines.extend(sorted(families[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(flask_app):
+    """
+    Measures the latency of every request by endpoint, method and status
+    """
+    from flask import g, request
+
+    @flask_app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @flask_app.after_request
+    def observe_latency(response):
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            metrics.observe('api_request_seconds', time.perf_counter() - start, endpoint=request.endpoint,
+                            method=request.method, status=response.status_code)
+        return response
+
+
+metrics = Metrics()
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+from settings import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_MAX_SECONDS, PROFILE_TOP_ALLOCATIONS, app
+
+
+def collapse(frame, thread_name):
+    """
+    Collapsed stack of a frame: its callers from the outermost, separated by semicolons
+
+    @param frame: Innermost frame of the stack
+    @param thread_name: Name of the thread, used as the root of the stack
+    @return: String like "thread;module.py:function;module.py:function"
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of the process from a background thread, so a
+    running fetcher can be looked into without restarting its streams. Writes the
+    samples in collapsed stack format, as read by flamegraph.pl and speedscope, and
+    the allocations traced by tracemalloc during the same window
+    """
+
+    def __init__(self, name, directory=PROFILE_DIR, interval=PROFILE_INTERVAL, top=PROFILE_TOP_ALLOCATIONS):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.top = top
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, on_done=None):
+        """
+        Profiles the process for some seconds in a background thread
+
+        @param self:
+        @param seconds: Duration of the profile, up to PROFILE_MAX_SECONDS
+        @param on_done: Function called with the report once the files are written
+        @return: False if a profile is already running, True otherwise
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(target=self._run, args=(min(seconds, PROFILE_MAX_SECONDS), on_done),
+                                            name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, seconds, on_done):
+        try:
+            report = self.profile(seconds)
+        except Exception:
+            app.logger.exception("Profile of %s failed", self.name)
+            return
+        if on_done is not None:
+            on_done(report)
+
+    def profile(self, seconds):
+        """
+        Samples every thread but the calling one each interval during some seconds
+
+        @param self:
+        @param seconds: Duration of the profile
+        @return: Dict with the pid, amount of samples and paths of the written files
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        started_at = time.time()
+        own = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f'{self.name}-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+        with open(f'{prefix}.collapsed', 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write(f'{stack} {count}\n')
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+        with open(f'{prefix}.allocations.txt', 'w') as output:
+            output.write(f'{self.name} (pid {os.getpid()}), {seconds}s from {time.ctime(started_at)}\n')
+            output.write(f'Traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n')
+            output.write('\nGrowth during the profile:\n')
+            for stat in after.compare_to(before, 'lineno')[:self.top]:
+                output.write(f'{stat}\n')
+            output.write('\nLargest live allocations:\n')
+            for stat in after.statistics('lineno')[:self.top]:
+                output.write(f'{stat}\n')
+        return {"pid": os.getpid(), "started_at": started_at, "seconds": seconds, "samples": samples,
+                "stacks": f'{prefix}.collapsed', "allocations": f'{prefix}.allocations.txt'}
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+
+from settings import RATELIMIT_WINDOW, RATELIMIT_SEARCH_PER_WINDOW, RATELIMIT_SEARCH_BURST, \
+    RATELIMIT_CONNECT_PER_WINDOW, RATELIMIT_CONNECT_BURST, RATELIMIT_MAX_POLL
+from util.metrics import metrics
+
+# Calls allowed per window and how many of them may be spent at once
+BUDGETS = {
+    'search': (RATELIMIT_SEARCH_PER_WINDOW, RATELIMIT_SEARCH_BURST),
+    'connect': (RATELIMIT_CONNECT_PER_WINDOW, RATELIMIT_CONNECT_BURST),
+}
+
+# KEYS: bucket hash, waiters sorted set, last poll of each waiter, virtual finish time of each user
+# ARGV: tokens per ms, capacity, now in ms, waiter, ms until a silent waiter is forgotten, ttl in ms, user, weight
+# Returns 0 when a token was taken, otherwise the ms to wait before asking again
+ACQUIRE = """
+local bucket, queue, polls, users = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local member, stale, ttl = ARGV[4], tonumber(ARGV[5]), tonumber(ARGV[6])
+local user, weight = ARGV[7], tonumber(ARGV[8])
+
+redis.call('HSET', polls, member, now)
+if not redis.call('ZSCORE', queue, member) then
+    -- Waiters are served by the virtual time their user would finish this call, so a
+    -- user with more waiters goes back behind the others after each call it gets
+    local vtime = tonumber(redis.call('HGET', bucket, 'vtime') or 0)
+    local finish = math.max(vtime, tonumber(redis.call('HGET', users, user) or 0)) + 1 / weight
+    redis.call('HSET', users, user, tostring(finish))
+    redis.call('ZADD', queue, tostring(finish), member)
+end
+while true do
+    local head = redis.call('ZRANGE', queue, 0, 0)[1]
+    if head == nil or head == member then break end
+    if tonumber(redis.call('HGET', polls, head) or 0) >= now - stale then break end
+    redis.call('ZREM', queue, head)
+    redis.call('HDEL', polls, head)
+end
+
+local state = redis.call('HMGET', bucket, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local rank = redis.call('ZRANK', queue, member)
+local wait = 0
+if tokens >= rank + 1 then
+    tokens = tokens - 1
+    redis.call('HSET', bucket, 'vtime', redis.call('ZSCORE', queue, member))
+    redis.call('ZREM', queue, member)
+    redis.call('HDEL', polls, member)
+else
+    wait = math.ceil((rank + 1 - tokens) / rate)
+end
+redis.call('HMSET', bucket, 'tokens', tostring(tokens), 'ts', tostring(math.max(now, ts)))
+for _, key in ipairs(KEYS) do
+    redis.call('PEXPIRE', key, ttl)
+end
+return wait
+"""
+
+
+class RateLimiter:
+    """
+    Token bucket kept in Redis, shared by every fetcher process using the same
+    credentials. Tokens are shared between users with weighted fair queuing: each
+    call asked is placed in line by the virtual time its user would finish it, one
+    over the weight of the user after the last call of that user still in line or
+    served, so the budget is split between the users waiting in proportion to their
+    weights, however many topics each of them runs. Users that were idle do not
+    save up calls, they start from the virtual time of the last call served
+    """
+
+    def __init__(self, redis, endpoint, window=RATELIMIT_WINDOW, max_poll=RATELIMIT_MAX_POLL):
+        per_window, burst = BUDGETS[endpoint]
+        self.redis = redis
+        self.endpoint = endpoint
+        self.capacity = burst
+        # Refilling only what is left after a full burst never allows more than per_window calls in a window
+        self.rate = (per_window - burst) / (window * 1000)
+        self.window = window
+        self.max_poll = max_poll
+        self.keys = [f'ratelimit:{endpoint}', f'ratelimit:{endpoint}:queue', f'ratelimit:{endpoint}:polls',
+                     f'ratelimit:{endpoint}:users']
+        self.script = redis.register_script(ACQUIRE)
+
+    def acquire(self, topic_id, sleep=time.sleep, user_id=None, weight=1):
+        """
+        Waits for a token
+
+        @param self:
+        @param topic_id: Id of the topic asking
+        @param sleep: Function waiting some seconds, returning True to give up waiting
+        @param user_id: Owner of the topic, to queue it fairly with the other users. Each topic is its own user by default
+        @param weight: Share of the budget of the user relative to the others
+        @return: Whether a token was taken
+        """
+        member = f'{topic_id}:{os.getpid()}:{threading.get_ident()}'
+        user = f'user:{user_id}' if user_id is not None else f'topic:{topic_id}'
+        start = time.time()
+        while True:
+            wait = self.script(keys=self.keys, args=[self.rate, self.capacity, int(time.time() * 1000), member,
+                                                     int(self.max_poll * 5000), self.window * 2000, user, weight])
+            if not wait:
+                break
+            if sleep(min(wait / 1000, self.max_poll)):
+                self.redis.zrem(self.keys[1], member)
+                self.redis.hdel(self.keys[2], member)
+                return False
+        waited = time.time() - start
+        metrics.observe('ratelimit_wait_seconds', waited, endpoint=self.endpoint)
+        if waited > self.max_poll / 10:
+            metrics.inc('ratelimit_throttled_total', endpoint=self.endpoint)
+        return True
+
+    def drain(self, until):
+        """
+        Empties the bucket until a given time, after Twitter answered that the limit
+        was reached, so no fetcher calls the endpoint before it resets
+
+        @param self:
+        @param until: Timestamp when the limit of the endpoint resets
+        @return: None
+        """
+        self.redis.hmset(self.keys[0], {'tokens': 0, 'ts': int(until * 1000)})
+        self.redis.pexpire(self.keys[0], max(int((until - time.time()) * 1000), 0) + self.window * 2000)
@@ -0,0 +1,158 @@
+import math
+import time
+import random
+import datetime
+
+from settings import SAMPLER_LAG_THRESHOLD, SAMPLER_QUEUE_THRESHOLD, SAMPLER_MIN_RATE, SAMPLER_BUCKET_SECONDS, \
+    SAMPLER_ADJUST_INTERVAL, TWEET_RETENTION_DAYS
+from util.metrics import metrics
+
+SMOOTHING = 0.05
+
+
+def sampling_key(topic_id):
+    return f'sampling:{topic_id}'
+
+
+class AdaptiveSampler:
+    """
+    Sheds load of a topic when its stream falls behind. While the lag of the tweets
+    or the backlog of the tweet writer are over their thresholds, the sampling rate
+    is halved every SAMPLER_ADJUST_INTERVAL seconds, down to SAMPLER_MIN_RATE, and it
+    doubles back once both are under half of them. The same happens while the tweets
+    kept per second are over limit, the share of the ingestion quota of its user
+    given to the topic, 0 for none. Rates are powers of two, so every
+    kept tweet carries an integer weight (the inverse of its rate) and adding the
+    weights gives unbiased counts. The tweets seen and kept per bucket of time are
+    written to the sampling:<topic_id> hash, only for buckets where tweets were shed
+    """
+
+    def __init__(self, topic_id, redis, lag_threshold=SAMPLER_LAG_THRESHOLD, queue_threshold=SAMPLER_QUEUE_THRESHOLD,
+                 min_rate=SAMPLER_MIN_RATE, bucket_seconds=SAMPLER_BUCKET_SECONDS, interval=SAMPLER_ADJUST_INTERVAL,
+                 limit=0, random=random.random):
+        self.topic_id = topic_id
+        self.redis = redis
+        self.lag_threshold = lag_threshold
+        self.queue_threshold = queue_threshold
+        self.max_level = int(math.log2(1 / min_rate))
+        self.bucket_seconds = bucket_seconds
+        self.interval = interval
+        self.limit = limit
+        self.random = random
+        self.level = 0
+        self.lag = 0.0
+        self._adjust_at = 0
+        self._adjusted_at = None
+        self._kept = 0
+        self._buckets = {}
+
+    @property
+    def rate(self):
+        return 1 / (1 << self.level)
+
+    def sample(self, created_at, depth=0, now=None):
+        """
+        Decides whether a tweet goes through the full path
+
+        @param self:
+        @param created_at: Timestamp of the tweet
+        @param depth: Amount of tweets waiting to be written
+        @param now: Current timestamp
+        @return: Weight of the tweet, 0 if it is shed
+        """
+        now = time.time() if now is None else now
+        self.lag += SMOOTHING * (now - created_at - self.lag)
+        if now >= self._adjust_at:
+            self._adjust_at = now + self.interval
+            self._adjust(depth, now)
+            self.flush(now)
+        bucket = int(created_at // self.bucket_seconds * self.bucket_seconds)
+        counts = self._buckets.get(bucket)
+        if counts is None:
+            counts = self._buckets[bucket] = {"seen": 0, "kept": 0, "flushed_seen": 0, "flushed_kept": 0,
+                                              "recorded": False}
+        counts["seen"] += 1
+        if self.level and self.random() >= self.rate:
+            return 0
+        counts["kept"] += 1
+        self._kept += 1
+        return 1 << self.level
+
+    def _adjust(self, depth, now):
+        level = self.level
+        throughput = self._kept / max(now - self._adjusted_at, 1e-3) if self._adjusted_at is not None else 0
+        self._adjusted_at, self._kept = now, 0
+        if self.lag > self.lag_threshold or depth > self.queue_threshold or (self.limit and throughput > self.limit):
+            self.level = min(self.level + 1, self.max_level)
+        elif self.lag < self.lag_threshold / 2 and depth < self.queue_threshold / 2 and \
+                (not self.limit or throughput < self.limit / 2):
+            self.level = max(self.level - 1, 0)
+        if self.level != level:
+            metrics.gauge('fetcher_sampling_rate', self.rate, topic=self.topic_id)
+
+    def flush(self, now=None):
+        """
+        Adds the tweets seen and kept since the last flush to the totals of the topic
+        and to the buckets where tweets were shed, then forgets the finished buckets
+
+        @param self:
+        @param now: Current timestamp
+        @return: None
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        key = sampling_key(self.topic_id)
+        seen = kept = 0
+        for bucket, counts in self._buckets.items():
+            new_seen, new_kept = counts["seen"] - counts["flushed_seen"], counts["kept"] - counts["flushed_kept"]
+            seen, kept = seen + new_seen, kept + new_kept
+            if not counts["recorded"] and counts["kept"] < counts["seen"]:
+                # First time this bucket sheds tweets, its whole count is recorded
+                counts["recorded"] = True
+                new_seen, new_kept = counts["seen"], counts["kept"]
+            if counts["recorded"] and new_seen:
+                pipe.hincrby(key, f'{bucket}:seen', new_seen)
+                pipe.hincrby(key, f'{bucket}:kept', new_kept)
+            counts["flushed_seen"], counts["flushed_kept"] = counts["seen"], counts["kept"]
+        if seen:
+            pipe.hincrby(key, 'seen', seen)
+            pipe.hincrby(key, 'kept', kept)
+        pipe.hset(key, 'rate', self.rate)
+        pipe.expire(key, TWEET_RETENTION_DAYS * 86400)
+        pipe.execute()
+        oldest = (time.time() if now is None else now) - 2 * self.bucket_seconds
+        for bucket in [bucket for bucket in self._buckets if bucket < oldest]:
+            del self._buckets[bucket]
+
+
+def sampling_stats(redis, topic_ids, since=None, until=None):
+    """
+    Sampling state of many topics, with the buckets of time where tweets were shed
+
+    @param redis: Redis connection
+    @param topic_ids: List of topic ids
+    @param since: First day of the buckets to include
+    @param until: Last day of the buckets to include
+    @return: Dict from topic id to its current rate, totals and sampled buckets
+    """
+    pipe = redis.pipeline(transaction=False)
+    for topic_id in topic_ids:
+        pipe.hgetall(sampling_key(topic_id))
+    stats = {}
+    for topic_id, fields in zip(topic_ids, pipe.execute()):
+        fields = {field.decode(): value for field, value in fields.items()}
+        buckets = {}
+        for field, value in fields.items():
+            if ':' in field:
+                bucket, kind = field.split(':')
+                buckets.setdefault(int(bucket), {})[kind] = int(value)
+        sampled = []
+        for bucket, counts in sorted(buckets.items()):
+            start = datetime.datetime.utcfromtimestamp(bucket)
+            if (since and start.date() < since) or (until and start.date() > until):
+                continue
+            seen, kept = counts.get('seen', 0), counts.get('kept', 0)
+            sampled.append({'start': start.strftime('%d-%m-%Y %H:%M'), 'seen': seen, 'kept': kept,
+                            'rate': kept / seen if seen else 1.0})
+        stats[topic_id] = {'rate': float(fields.get('rate', 1)), 'seen': int(fields.get('seen', 0)),
+                           'kept': int(fields.get('kept', 0)), 'buckets': sampled}
+    return stats
@@ -0,0 +1,205 @@
+import json
+import time
+
+from settings import SCHEDULER_USER_TOPICS, SCHEDULER_USER_QUEUED, SCHEDULER_CAPACITY
+
+TOPICS = 'fetcher:topics'
+PENDING = 'scheduler:pending'
+QUEUED = 'scheduler:pending:topics'
+WEIGHTS = 'scheduler:weights'
+
+# Moves pending topics to the topics to run while there is capacity: each time the
+# oldest topic of the user running the fewest topics for their weight among the
+# users under their quota. Returns the ids of the topics started
+PROMOTE_FUNCTION = """
+local function promote(topics, pending, queued, weights, quota, capacity)
+    local counts, total = {}, 0
+    for _, value in ipairs(redis.call('HVALS', topics)) do
+        local user = tostring(cjson.decode(value)['user_id'])
+        counts[user] = (counts[user] or 0) + 1
+        total = total + 1
+    end
+    local started = {}
+    local ids = redis.call('ZRANGE', pending, 0, -1)
+    local users = {}
+    for _, id in ipairs(ids) do
+        local topic = redis.call('HGET', queued, id)
+        if topic then
+            users[id] = tostring(cjson.decode(topic)['user_id'])
+        else
+            redis.call('ZREM', pending, id)
+        end
+    end
+    while capacity <= 0 or total < capacity do
+        local best, best_share
+        for _, id in ipairs(ids) do
+            local user = users[id]
+            if user and (counts[user] or 0) < quota then
+                local share = (counts[user] or 0) / (tonumber(redis.call('HGET', weights, user)) or 1)
+                if best == nil or share < best_share then
+                    best, best_share = id, share
+                end
+            end
+        end
+        if best == nil then break end
+        local user = users[best]
+        redis.call('HSET', topics, best, redis.call('HGET', queued, best))
+        redis.call('HDEL', queued, best)
+        redis.call('ZREM', pending, best)
+        users[best] = nil
+        counts[user] = (counts[user] or 0) + 1
+        total = total + 1
+        started[#started + 1] = best
+    end
+    return started
+end
+"""
+
+# KEYS: topics to run, pending sorted set, pending topics, weights of the users
+# ARGV: topics per user, capacity (0 for none)
+PROMOTE = PROMOTE_FUNCTION + """
+return promote(KEYS[1], KEYS[2], KEYS[3], KEYS[4], tonumber(ARGV[1]), tonumber(ARGV[2]))
+"""
+
+# KEYS: topics to run, pending sorted set, pending topics, weights of the users
+# ARGV: topic id, topic, user id, topics per user, capacity (0 for none), queued topics per user, now in ms
+# Pending topics that fit are started first, so a new topic never takes the place of one
+# that waits. Returns the state of the topic, its place in the queue, why it waits and the
+# ids of the pending topics started
+ADMIT = PROMOTE_FUNCTION + """
+local topics, pending, queued, weights = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local id, topic, user = ARGV[1], ARGV[2], ARGV[3]
+local quota, capacity, max_queued = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+if redis.call('HEXISTS', topics, id) == 1 then
+    return {'running', 0, '', {}}
+end
+local started = promote(topics, pending, queued, weights, quota, capacity)
+if redis.call('HEXISTS', topics, id) == 1 then
+    return {'running', 0, '', started}
+end
+local running, mine, waiting = 0, 0, 0
+for _, value in ipairs(redis.call('HVALS', topics)) do
+    running = running + 1
+    if tostring(cjson.decode(value)['user_id']) == user then mine = mine + 1 end
+end
+local reason = 'capacity'
+if mine >= quota then reason = 'user_quota' end
+local rank = redis.call('ZRANK', pending, id)
+if rank then
+    return {'queued', rank + 1, reason, started}
+end
+if mine < quota and (capacity <= 0 or running < capacity) then
+    redis.call('HSET', topics, id, topic)
+    return {'running', 0, '', started}
+end
+for _, value in ipairs(redis.call('HVALS', queued)) do
+    if tostring(cjson.decode(value)['user_id']) == user then waiting = waiting + 1 end
+end
+if waiting >= max_queued then
+    return {'rejected', 0, reason, started}
+end
+redis.call('ZADD', pending, ARGV[7], id)
+redis.call('HSET', queued, id, topic)
+return {'queued', redis.call('ZRANK', pending, id) + 1, reason, started}
+"""
+
+
+def user_weight(redis, user_id):
+    """
+    Weight of a user in the fair sharing of the fetch capacity, 1 unless set in scheduler:weights
+    """
+    weight = redis.hget(WEIGHTS, user_id)
+    return float(weight) if weight is not None else 1.0
+
+
+class Scheduler:
+    """
+    Admission of topics into fetcher:topics, the topics the fetcher nodes run. A user
+    runs at most SCHEDULER_USER_TOPICS topics at once and, when SCHEDULER_CAPACITY is
+    set, all users together at most that many. Topics over those limits wait in the
+    scheduler:pending queue, up to SCHEDULER_USER_QUEUED per user, and are started as
+    running topics finish: first the ones of the users running the fewest topics for
+    their weight (scheduler:weights, 1 by default), in order of arrival for each user
+    """
+
+    def __init__(self, redis, user_topics=SCHEDULER_USER_TOPICS, user_queued=SCHEDULER_USER_QUEUED,
+                 capacity=SCHEDULER_CAPACITY):
+        self.redis = redis
+        self.user_topics = user_topics
+        self.user_queued = user_queued
+        self.capacity = capacity
+        self._admit = redis.register_script(ADMIT)
+        self._promote = redis.register_script(PROMOTE)
+
+    def admit(self, topic):
+        """
+        Starts a topic or queues it when its user or the fetchers are at their limit, after
+        starting the pending topics that fit
+
+        @param self:
+        @param topic: Dict representation of the topic
+        @return: Dict with the state ('running', 'queued' or 'rejected'), the position in the queue, the reason
+                 and the ids of the pending topics started before it, under 'started'
+        """
+        state, position, reason, started = self._admit(
+            keys=[TOPICS, PENDING, QUEUED, WEIGHTS],
+            args=[topic["id"], json.dumps(topic), topic["user_id"], self.user_topics, self.capacity,
+                  self.user_queued, int(time.time() * 1000)])
+        return dict(self._admission(state.decode(), position, reason.decode()),
+                    started=[int(topic_id) for topic_id in started])
+
+    def promote(self):
+        """
+        Starts pending topics while there is capacity
+
+        @param self:
+        @return: List of the ids of the topics started
+        """
+        return [int(topic_id) for topic_id in self._promote(keys=[TOPICS, PENDING, QUEUED, WEIGHTS],
+                                                            args=[self.user_topics, self.capacity])]
+
+    def cancel(self, topic_id):
+        """
+        Takes a topic out of the queue
+
+        @param self:
+        @param topic_id: Id of the topic
+        @return: Whether the topic was waiting
+        """
+        removed, _ = self.redis.pipeline().zrem(PENDING, topic_id).hdel(QUEUED, topic_id).execute()
+        return bool(removed)
+
+    def admissions(self, topics):
+        """
+        Admission state of many topics
+
+        @param self:
+        @param topics: List of topics
+        @return: Dict from topic id to its admission, 'finished' for the topics neither running nor waiting
+        """
+        if not topics:
+            return {}
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hvals(TOPICS)
+        for topic in topics:
+            pipe.hexists(TOPICS, topic.id)
+            pipe.zrank(PENDING, topic.id)
+        replies = pipe.execute()
+        running = {}
+        for value in replies[0]:
+            user_id = json.loads(value)["user_id"]
+            running[user_id] = running.get(user_id, 0) + 1
+        admissions = {}
+        for topic, is_running, rank in zip(topics, replies[1::2], replies[2::2]):
+            if is_running:
+                admissions[topic.id] = self._admission('running')
+            elif rank is not None:
+                reason = 'user_quota' if running.get(topic.user_id, 0) >= self.user_topics else 'capacity'
+                admissions[topic.id] = self._admission('queued', rank + 1, reason)
+            else:
+                admissions[topic.id] = self._admission('finished')
+        return admissions
+
+    @staticmethod
+    def _admission(state, position=0, reason=''):
+        return {'state': state, 'position': position or None, 'reason': reason or None}